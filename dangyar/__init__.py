@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+# Non-GUI helpers for the dangyar app (storage backends and friends).
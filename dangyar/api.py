@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# Local HTTP API for members, so they can pay from their phones instead of
+# queueing at the kiosk:
+#
+#   GET      /api/search?q=NAME&page=0&size=10   ranked name search
+#   GET      /api/users/<id>                     debt and payment state
+#   POST     /api/users/<id>/cash                "paid in cash" request
+#   PUT|POST /api/users/<id>/receipt             card receipt; the body is the
+#                                                image (Content-Type image/png,
+#                                                image/jpeg, ...)
+#   GET      /api/health
+#
+# Replies are JSON; errors are {"error": code, "message": Persian text}.
+# The payment rules are the user panel's (user_click_paid): nothing once
+# paid or while a request is pending, and the change itself is the same
+# store transition (request_cash / attach_receipt), so a request that
+# lost a race is turned down rather than applied twice.
+#
+# One asyncio loop speaks HTTP/1.1 (keep-alive, Content-Length bodies) on
+# the stdlib alone. Store calls block (file locks, fsync) and run on a
+# small thread pool; they go through the same store the manager GUI
+# reads, which picks them up like changes from any other process.
+# Memory stays bounded whatever the load: at most MAX_CONNECTIONS open
+# connections (more get 503), request heads up to HEAD_LIMIT, and
+# receipts streamed to disk CHUNK bytes at a time, up to MAX_RECEIPT.
+import asyncio, http, json, sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from dangyar.core import STATUS_TEXT, attach_receipt, request_cash, user_status
+
+HOST = "127.0.0.1"
+PORT = 8765
+MAX_CONNECTIONS = 1000
+WORKERS = 8
+HEAD_LIMIT = 16 * 1024
+BODY_LIMIT = 4 * 1024        # bodies of requests that don't need one are read and dropped
+MAX_RECEIPT = 10 * 1024 * 1024
+CHUNK = 64 * 1024
+IDLE_TIMEOUT = 30            # seconds a kept-alive connection may sit idle
+BODY_TIMEOUT = 30            # seconds to wait for the next piece of a body
+PAGE_SIZE, MAX_PAGE_SIZE = 10, 50
+FLUSH_EVERY = 60             # seconds between ledger index flushes
+RECEIPT_TYPES = {"image/png": ".png", "image/jpeg": ".jpg", "image/jpg": ".jpg", "image/gif": ".gif", "image/bmp": ".bmp"}
+
+MSG_NOT_FOUND = "کاربر یافت نشد."
+MSG_PAID = "بدهی شما قبلاً پرداخت شده است."
+MSG_PENDING = "درخواست پرداخت شما قبلاً ثبت شده است و در انتظار تأیید مدیر است."
+
+
+class ApiError(Exception):
+    def __init__(self, status, code, message="", close=False):
+        super().__init__(message or code)
+        self.status = status
+        self.code = code
+        self.message = message
+        self.close = close  # the request body was not read: the connection can't be reused
+
+
+def user_view(u):
+    status = user_status(u)
+    return {"id": u["id"], "name": u.get("name", ""), "debt": u.get("debt", 0), "status": status,
+            "status_text": STATUS_TEXT[status], "pending_cash": bool(u.get("pending_cash")),
+            "pending_card": bool(u.get("pending_card")), "payment_time": u.get("payment_time", "")}
+
+
+def check_can_pay(u, close=False):
+    # user_click_paid's rules, before anything is written
+    if u is None:
+        raise ApiError(404, "not_found", MSG_NOT_FOUND, close)
+    if u.get("paid"):
+        raise ApiError(409, "already_paid", MSG_PAID, close)
+    if u.get("pending_cash") or u.get("pending_card"):
+        raise ApiError(409, "already_pending", MSG_PENDING, close)
+
+
+def response(status, payload, keep_alive):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode("ascii") + body
+
+
+class Api:
+    def __init__(self, core, workers=WORKERS, max_connections=MAX_CONNECTIONS):
+        self.core = core
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dangyar-api")
+        self.max_connections = max_connections
+        self.active = 0
+        self.served = 0
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    # ---------- connection ----------
+    async def handle(self, reader, writer):
+        if self.active >= self.max_connections:
+            writer.write(response(503, {"error": "busy", "message": "سرور مشغول است؛ کمی بعد دوباره تلاش کنید."}, False))
+            await self._close(writer)
+            return
+        self.active += 1
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(response(431, {"error": "head_too_large"}, False))
+                    break
+                keep_alive = False
+                try:
+                    method, target, keep_alive, headers = self._parse_head(head)
+                    status, payload = await self._dispatch(method, target, headers, reader, writer)
+                except ApiError as e:
+                    status, payload = e.status, {"error": e.code, "message": e.message}
+                    keep_alive = keep_alive and not e.close
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except Exception as e:
+                    print(f"dangyar api: {e!r}", file=sys.stderr)
+                    status, payload, keep_alive = 500, {"error": "internal"}, False
+                self.served += 1
+                writer.write(response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.active -= 1
+            await self._close(writer)
+
+    async def _close(self, writer):
+        try:
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    def _parse_head(self, head):
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            raise ApiError(400, "bad_request", close=True)
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+        conn = headers.get("connection", "").lower()
+        keep_alive = conn == "keep-alive" if version == "HTTP/1.0" else conn != "close"
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise ApiError(411, "length_required", "Content-Length لازم است.", close=True)
+        try:
+            headers["content-length"] = int(headers.get("content-length", 0))
+        except ValueError:
+            headers["content-length"] = -1
+        if headers["content-length"] < 0:
+            raise ApiError(400, "bad_length", close=True)
+        return method, target, keep_alive, headers
+
+    async def _drop_body(self, headers, reader):
+        n = headers["content-length"]
+        if n > BODY_LIMIT:
+            raise ApiError(413, "body_too_large", close=True)
+        if n:
+            await asyncio.wait_for(reader.readexactly(n), BODY_TIMEOUT)
+
+    # ---------- routes ----------
+    async def _dispatch(self, method, target, headers, reader, writer):
+        url = urlsplit(target)
+        parts = [unquote(p) for p in url.path.strip("/").split("/")]
+        if parts[:1] != ["api"]:
+            raise ApiError(404, "no_route", close=bool(headers["content-length"]))
+        route = parts[1:]
+        if route[:1] == ["users"] and len(route) == 3 and route[2] == "receipt":
+            if method not in ("PUT", "POST"):
+                raise ApiError(405, "method_not_allowed", close=bool(headers["content-length"]))
+            return await self.upload_receipt(route[1], headers, reader, writer)
+        await self._drop_body(headers, reader)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if route == ["health"] and method == "GET":
+            return 200, {"ok": True, "ledger": self.core.ledgers.name(self.core.ledger), "connections": self.active}
+        if route == ["search"] and method == "GET":
+            return await self.search(query)
+        if route[:1] == ["users"] and len(route) == 2 and method == "GET":
+            return await self.balance(route[1])
+        if route[:1] == ["users"] and len(route) == 3 and route[2] == "cash" and method == "POST":
+            return await self.request_cash(route[1])
+        raise ApiError(404, "no_route")
+
+    async def search(self, query):
+        q = query.get("q", "").strip()
+        try:
+            page = max(0, int(query.get("page", 0)))
+            size = min(MAX_PAGE_SIZE, max(1, int(query.get("size", PAGE_SIZE))))
+        except ValueError:
+            raise ApiError(400, "bad_page")
+        if not q:
+            return 200, {"total": 0, "page": 0, "pages": 0, "results": []}
+
+        def find():
+            matches = self.core.search_users(q)
+            return len(matches), matches.pages(size), self.core.match_page(matches, page, size)
+        total, pages, users = await self._run(find)
+        return 200, {"total": total, "page": page, "pages": pages if total else 0,
+                     "results": [{"id": u["id"], "name": u["name"], "debt": u.get("debt", 0)} for u in users]}
+
+    async def balance(self, uid):
+        u = await self._run(self.core.store.get_user, uid)
+        if u is None:
+            raise ApiError(404, "not_found", MSG_NOT_FOUND)
+        return 200, user_view(u)
+
+    async def request_cash(self, uid):
+        check_can_pay(await self._run(self.core.store.get_user, uid))
+        fields = await self._run(self.core.store.modify_user, uid, request_cash)
+        if fields is None:
+            raise ApiError(409, "already_pending", MSG_PENDING)
+        return 200, user_view(await self._run(self.core.store.get_user, uid))
+
+    async def upload_receipt(self, uid, headers, reader, writer):
+        ext = RECEIPT_TYPES.get(headers.get("content-type", "").split(";")[0].strip().lower())
+        if ext is None:
+            raise ApiError(415, "bad_type", "فقط تصویر رسید (png، jpg، gif، bmp) پذیرفته می‌شود.", close=True)
+        length = headers["content-length"]
+        if not length:
+            raise ApiError(411, "length_required", "Content-Length لازم است.", close=True)
+        if length > MAX_RECEIPT:
+            raise ApiError(413, "too_large", f"حداکثر حجم رسید {MAX_RECEIPT // (1024 * 1024)} مگابایت است.", close=True)
+        # before the body is read: a refused upload costs nothing
+        check_can_pay(await self._run(self.core.store.get_user, uid), close=True)
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+        receipts = self.core.receipts
+        up = await self._run(receipts.upload, ext)
+        try:
+            # the file writes run on the pool, a CHUNK at a time, not on the loop
+            left, buf = length, bytearray()
+            while left:
+                chunk = await asyncio.wait_for(reader.read(min(CHUNK, left)), BODY_TIMEOUT)
+                if not chunk:
+                    raise ConnectionError("upload cut short")
+                buf += chunk
+                left -= len(chunk)
+                if len(buf) >= CHUNK or not left:
+                    await self._run(up.write, buf)
+                    buf = bytearray()
+            dest = await self._run(up.commit)
+        finally:
+            await self._run(up.abort)
+        try:
+            fields = await self._run(self.core.store.modify_user, uid, attach_receipt(dest))
+        except Exception:
+            # not attached (member deleted, kept changing): drop our reference
+            await self._run(receipts.release, dest)
+            raise
+        if fields is None:
+            # someone else registered a payment meanwhile; drop our reference
+            await self._run(receipts.release, dest)
+            raise ApiError(409, "already_pending", MSG_PENDING)
+        if receipts.can_thumbnail(dest):
+            self.pool.submit(receipts.make_thumbnail, dest)  # ready before the manager opens it
+        return 200, user_view(await self._run(self.core.store.get_user, uid))
+
+    # ---------- server ----------
+    async def _flush_loop(self):
+        # keep the ledger totals and member index in step, as the GUI does on close
+        while True:
+            await asyncio.sleep(FLUSH_EVERY)
+            try:
+                await self._run(self.core.flush, True)
+            except Exception as e:
+                print(f"dangyar api: ledger index not updated: {e}", file=sys.stderr)
+
+    async def serve(self, host=HOST, port=PORT, ready=None):
+        server = await asyncio.start_server(self.handle, host, port, limit=HEAD_LIMIT, backlog=1024)
+        flusher = asyncio.ensure_future(self._flush_loop())
+        if ready:
+            ready([s.getsockname()[:2] for s in server.sockets])
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            flusher.cancel()
+            self.pool.shutdown(wait=True)
+
+
+def run(core, host=HOST, port=PORT, ready=None, max_connections=MAX_CONNECTIONS):
+    """Serve until interrupted; ready(addresses) is called once listening."""
+    try:
+        asyncio.run(Api(core, max_connections=max_connections).serve(host, port, ready))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+# Incremental backups of the ledgers, with restore to any backup.
+#
+#   backups/
+#     receipts/<hash><ext>      receipt images, stored once per content
+#     <ledger>/index.json       the ledger's backups, oldest first
+#     <ledger>/<id>.json.gz     one backup
+#     <ledger>/state.json       checksums of every record in the latest backup
+#
+# A backup holds only the users and expenses that were added, changed or
+# deleted since the previous one of the same ledger ("changed" / "deleted",
+# in roster order); its "parent" points at that previous backup. A backup
+# without a parent is full. Every FULL_EVERY-th backup is full again, so
+# restoring never replays a long chain; so is the one taken right after a
+# restore, whose roster order an incremental one could not express.
+#
+# Finding what changed costs a checksum per record, so BackupChanges (a
+# store observer) notes the ids touched since this process last backed the
+# ledger up; the next backup then only looks at those. After a full load
+# (another process rewrote the ledger, a restore) everything is compared.
+#
+# Receipts are copied into backups/receipts the first time a backup sees
+# them. Managed receipts are already named by their sha256 (see
+# dangyar/receipts.py), so that name is reused without reading the file and
+# an image is never stored twice; older plain receipt files are hashed once
+# and the path -> object mapping is kept with the backups. A hard link is
+# used where the file system allows it, so stored receipts take no extra
+# space.
+#
+# prune() applies a retention policy (the newest N, plus one a day and one
+# a week for a while). A pruned backup's changes are folded into the next
+# backup of its chain first, so every remaining backup still restores.
+# Receipt objects no remaining backup refers to are then deleted.
+import datetime, gzip, hashlib, json, os, shutil, uuid, zlib
+
+from dangyar.locking import FileLock
+from dangyar.metrics import io, timed
+from dangyar.storage import read_json_file, write_json_file, write_file_atomic
+
+FULL_EVERY = 20
+KEEP_LAST = 10
+KEEP_DAILY = 7
+KEEP_WEEKLY = 4
+
+
+def record_crc(r):
+    # The same record read back from the columnar snapshot (a compacted
+    # journal) has its keys in another order and missing fields filled in
+    # ("rev": 0, "receipt": "", ...), so the checksum skips empty values and
+    # sorts the rest by key. Nested values keep their order: an expense's
+    # shares decide who gets the leftover toman.
+    return zlib.crc32(repr(sorted(kv for kv in r.items() if kv[1])).encode("utf-8"))
+
+
+def _diff(records, key, old):
+    # -> (changed {key: record} in order, deleted [keys], new checksums)
+    crcs, changed = {}, {}
+    for r in records:
+        k = r.get(key)
+        if k is None:
+            continue
+        c = crcs[k] = record_crc(r)
+        if old.get(k) != c:
+            changed[k] = r
+    deleted = [k for k in old if k not in crcs]
+    return changed, deleted, crcs
+
+
+def _diff_some(records, keys, old):
+    # _diff() when only the records with these keys can have changed;
+    # records holds those of them that still exist
+    crcs, changed = dict(old), {}
+    for r in records:
+        c = crcs[r["id"]] = record_crc(r)
+        if old.get(r["id"]) != c:
+            changed[r["id"]] = r
+    present = {r["id"] for r in records}
+    deleted = [k for k in keys if k not in present and k in old]
+    for k in deleted:
+        del crcs[k]
+    return changed, deleted, crcs
+
+
+def _replay(records, key, delta):
+    # apply one backup's changed/deleted to an ordered {key: record}
+    for k in delta["deleted"]:
+        records.pop(k, None)
+    records.update(delta["changed"])
+
+
+def _merge(older, newer):
+    # one delta equal to applying older, then newer
+    changed = {k: r for k, r in older["changed"].items() if k not in newer["deleted"]}
+    changed.update(newer["changed"])
+    deleted = [k for k in dict.fromkeys(older["deleted"] + newer["deleted"]) if k not in newer["changed"]]
+    return {"changed": changed, "deleted": deleted}
+
+
+def _receipt_paths(users):
+    return {u["receipt"] for u in users if u.get("receipt")}
+
+
+class BackupChanges:
+    """Store observer: ids of the users and expenses changed since base,
+    the backup this process last made of the ledger (None: unknown)."""
+
+    def __init__(self):
+        self.data = None
+        self.base = None
+        self.users = set()
+        self.expenses = set()
+
+    def rebuild(self, data):
+        self.data = data
+        self.base = None
+
+    def observe(self, change, data, record):
+        if data is not self.data:
+            return
+        op = change["op"]
+        if op == "add":
+            self.users.add(change["user"]["id"])
+        elif op in ("update", "delete"):
+            self.users.add(change["id"])
+        elif op == "expense_add":
+            self.expenses.add(change["expense"]["id"])
+        elif op in ("expense_update", "expense_delete"):
+            self.expenses.add(change["eid"])
+        elif op == "clear":
+            self.base = None
+
+    def take(self, last, whole=False):
+        # (user ids, expense ids) changed since backup last, or None if we
+        # can't tell (or whole); either way counting starts again from last
+        dirty = (self.users, self.expenses) if not whole and last is not None and self.base == last else None
+        self.users, self.expenses = set(), set()
+        self.base = last
+        return dirty
+
+
+class Backups:
+    def __init__(self, root, receipts):
+        self.root = root
+        self.receipts = receipts  # the ReceiptStore whose files are backed up
+        self.object_dir = os.path.join(root, "receipts")
+        self.lock = None
+
+    def _lock(self):
+        if self.lock is None:
+            os.makedirs(self.root, exist_ok=True)
+            self.lock = FileLock(os.path.join(self.root, ".lock"))
+        return self.lock
+
+    def _dir(self, lid):
+        return os.path.join(self.root, lid)
+
+    def _path(self, lid, sid):
+        return os.path.join(self._dir(lid), sid + ".json.gz")
+
+    def _index(self, lid):
+        try:
+            return read_json_file(os.path.join(self._dir(lid), "index.json"))
+        except FileNotFoundError:
+            return []
+
+    def _write_index(self, lid, index):
+        write_json_file(os.path.join(self._dir(lid), "index.json"), index)
+
+    def _read(self, lid, sid):
+        with open(self._path(lid, sid), "rb") as f:
+            raw = f.read()
+        io(read=len(raw))
+        return json.loads(gzip.decompress(raw))
+
+    def _write(self, lid, snap):
+        payload = gzip.compress(json.dumps(snap, ensure_ascii=False).encode("utf-8"), 1)  # fast; backups are rarely read
+        write_file_atomic(self._path(lid, snap["id"]), payload)
+        return len(payload)
+
+    def ledgers(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d for d in os.listdir(self.root) if os.path.isfile(os.path.join(self.root, d, "index.json")))
+
+    def list(self, lid):
+        """Backups of a ledger, newest first (dicts from the index)."""
+        return list(reversed(self._index(lid)))
+
+    # ---- receipts ----
+    def _object_name(self, path, known):
+        if path in known:
+            return known[path]
+        if self.receipts.is_managed(path):
+            return os.path.basename(path)
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest() + os.path.splitext(path)[1].lower()
+
+    def _store_object(self, path, name):
+        dest = os.path.join(self.object_dir, name)
+        if os.path.exists(dest):
+            return 0
+        os.makedirs(self.object_dir, exist_ok=True)
+        tmp = f"{dest}.{os.getpid()}.tmp"
+        try:
+            os.link(path, tmp)
+        except OSError:
+            shutil.copyfile(path, tmp)
+        os.replace(tmp, dest)
+        return 1
+
+    def object_path(self, name):
+        return os.path.join(self.object_dir, name)
+
+    # ---- backup ----
+    @timed("backup.create", records=lambda r, self, lid, capture, reason="", full=False: r and r["changed"] + r["deleted"])
+    def create(self, lid, capture, reason="", full=False):
+        """Back up ledger lid if anything changed since its last backup (or
+        completely, with full); returns the new index entry or None. reason
+        is shown in the list.
+
+        capture(last, whole) is called under the backup lock with the id of
+        the ledger's latest backup and returns (data, dirty): a private copy
+        of the ledger and either None, or - unless whole is set - the (user
+        ids, expense ids) changed since last, data then only holding those
+        of them that still exist.
+        """
+        with self._lock().exclusive():
+            os.makedirs(self._dir(lid), exist_ok=True)
+            index = self._index(lid)
+            state_path = os.path.join(self._dir(lid), "state.json")
+            try:
+                state = read_json_file(state_path)
+            except FileNotFoundError:
+                state = {}
+            last = index[-1] if index else None
+            if last is None or state.get("last") != last["id"]:
+                state = {}  # no usable base: this one is full
+            since_full = 0
+            for s in reversed(index):
+                if not s.get("parent"):
+                    break
+                since_full += 1
+            forced, full = full, full or not state or since_full >= FULL_EVERY - 1
+            data, dirty = capture(last and last["id"], full)
+            if dirty is not None:
+                users, udel, ucrc = _diff_some(data["users"], dirty[0], state["users"])
+                expenses, edel, ecrc = _diff_some(data["expenses"], dirty[1], state["expenses"])
+            else:
+                users, udel, ucrc = _diff(data["users"], "id", state.get("users", {}))
+                expenses, edel, ecrc = _diff(data.get("expenses", ()), "id", state.get("expenses", {}))
+            if state and not forced and not (users or udel or expenses or edel) and data.get("password") == state.get("password"):
+                return None  # nothing new since the last backup
+            if full:
+                users = {u["id"]: u for u in data["users"] if u.get("id")}
+                expenses = {e["id"]: e for e in data.get("expenses", ()) if e.get("id")}
+                udel, edel, state = [], [], {}
+            # receipts of the changed records; content already stored is skipped
+            objects, new_objects, stored = dict(state.get("objects", {})), {}, 0
+            for path in _receipt_paths(users.values()):
+                if not os.path.exists(path):
+                    continue
+                name = self._object_name(path, objects)
+                stored += self._store_object(path, name)
+                if path not in objects and not self.receipts.is_managed(path):
+                    new_objects[path] = name
+                objects[path] = name
+            now = datetime.datetime.now()
+            sid = now.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+            snap = {"id": sid, "time": now.isoformat(sep=" ", timespec="seconds"), "ledger": lid,
+                    "parent": None if full else last["id"], "reason": reason, "password": data.get("password"),
+                    "users": {"changed": users, "deleted": udel}, "expenses": {"changed": expenses, "deleted": edel},
+                    "objects": new_objects}
+            size = self._write(lid, snap)
+            entry = {"id": sid, "time": snap["time"], "parent": snap["parent"], "reason": reason,
+                     "users": len(ucrc), "changed": len(users), "deleted": len(udel), "receipts": stored, "size": size}
+            index.append(entry)
+            self._write_index(lid, index)
+            write_json_file(state_path, {"last": sid, "password": data.get("password"), "users": ucrc,
+                                         "expenses": ecrc, "objects": objects}, indent=None)
+            return entry
+
+    # ---- restore ----
+    def _chain(self, lid, sid):
+        # snapshot dicts from the full one up to sid
+        chain = []
+        while sid:
+            snap = self._read(lid, sid)
+            chain.append(snap)
+            sid = snap.get("parent")
+        return chain[::-1]
+
+    @timed("backup.materialize")
+    def materialize(self, lid, sid):
+        """The data of ledger lid as it was at backup sid, plus the
+        path -> object mapping for its older plain receipt files."""
+        if sid not in {s["id"] for s in self._index(lid)}:
+            raise FileNotFoundError(f"no backup {sid} of ledger {lid}")
+        users, expenses, objects, password = {}, {}, {}, None
+        for snap in self._chain(lid, sid):
+            _replay(users, "id", snap["users"])
+            _replay(expenses, "id", snap["expenses"])
+            objects.update(snap.get("objects", {}))
+            password = snap.get("password")
+        return {"password": password, "users": list(users.values()), "expenses": list(expenses.values())}, objects
+
+    def restore_receipts(self, users, objects):
+        """Put the receipt files users refer to back in place where they
+        are missing; returns how many were copied."""
+        n = 0
+        for path in _receipt_paths(users):
+            if os.path.exists(path):
+                continue
+            name = objects.get(path) or os.path.basename(path)
+            src = self.object_path(name)
+            if not os.path.exists(src):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, path)
+            n += 1
+        return n
+
+    # ---- retention ----
+    @staticmethod
+    def keep_set(index, keep_last=KEEP_LAST, keep_daily=KEEP_DAILY, keep_weekly=KEEP_WEEKLY):
+        # ids to keep: the newest keep_last, then the newest of each of the
+        # last keep_daily days and keep_weekly ISO weeks that have backups
+        keep = {s["id"] for s in index[-keep_last:]} if keep_last else set()
+        days, weeks = {}, {}
+        for s in reversed(index):
+            t = datetime.datetime.fromisoformat(s["time"])
+            day, week = t.date(), t.isocalendar()[:2]
+            if day not in days and len(days) < keep_daily:
+                days[day] = s["id"]
+            if week not in weeks and len(weeks) < keep_weekly:
+                weeks[week] = s["id"]
+        keep.update(days.values(), weeks.values())
+        if index:
+            keep.add(index[-1]["id"])  # the base of the next incremental
+        return keep
+
+    @timed("backup.prune")
+    def prune(self, keep_last=KEEP_LAST, keep_daily=KEEP_DAILY, keep_weekly=KEEP_WEEKLY):
+        """Drop the backups the policy doesn't keep, in every ledger, and the
+        receipt objects nothing refers to any more. Returns how many
+        backups were removed."""
+        removed = 0
+        with self._lock().exclusive():
+            for lid in self.ledgers():
+                index = self._index(lid)
+                keep = self.keep_set(index, keep_last, keep_daily, keep_weekly)
+                out = []
+                for i, s in enumerate(index):
+                    if s["id"] in keep:
+                        out.append(s)
+                        continue
+                    # fold it into the next backup of the chain before it goes
+                    nxt = index[i + 1] if i + 1 < len(index) else None
+                    if nxt is not None and nxt.get("parent") == s["id"]:
+                        older, newer = self._read(lid, s["id"]), self._read(lid, nxt["id"])
+                        newer["parent"] = older.get("parent")
+                        newer["users"] = _merge(older["users"], newer["users"])
+                        newer["expenses"] = _merge(older["expenses"], newer["expenses"])
+                        newer["objects"] = dict(older.get("objects", {}), **newer.get("objects", {}))
+                        if newer["parent"] is None:  # it is full now: nothing to delete from
+                            newer["users"]["deleted"], newer["expenses"]["deleted"] = [], []
+                        nxt["size"] = self._write(lid, newer)
+                        nxt["parent"] = newer["parent"]
+                        nxt["changed"] = len(newer["users"]["changed"])
+                        nxt["deleted"] = len(newer["users"]["deleted"])
+                    os.remove(self._path(lid, s["id"]))
+                    removed += 1
+                if len(out) != len(index):
+                    self._write_index(lid, out)
+            if removed:
+                self._sweep_objects()
+        return removed
+
+    def _sweep_objects(self):
+        # receipts referred to by any state some backup restores to
+        used = set()
+        for lid in self.ledgers():
+            users, objects = {}, {}
+            for s in self._index(lid):
+                snap = self._read(lid, s["id"])
+                if not snap.get("parent"):
+                    users, objects = {}, {}
+                _replay(users, "id", snap["users"])
+                objects.update(snap.get("objects", {}))
+                for path in _receipt_paths(users.values()):
+                    used.add(objects.get(path) or os.path.basename(path))
+        if not os.path.isdir(self.object_dir):
+            return
+        for name in os.listdir(self.object_dir):
+            if name not in used and not name.endswith(".tmp"):
+                os.remove(os.path.join(self.object_dir, name))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Streaming roster import/export, CSV, JSON lines or a JSON array.
+#
+# CSV and JSON-lines files are read and written one row at a time; a .json
+# file is one document (a list of rows, or {"users": [...]}) and is parsed
+# whole. Imported rows get the same
+# checks as the add dialog (parse_user_fields) and are committed in batches
+# of BATCH_SIZE, each a single store write; bad rows are skipped and
+# reported with their line number.
+import csv, json, os
+
+from dangyar.core import new_user, parse_user_fields, user_status
+
+BATCH_SIZE = 1000
+# accepted column names, English or Persian
+NAME_KEYS = ("name", "نام")
+DEBT_KEYS = ("debt", "بدهی")
+EXPORT_FIELDS = ("id", "name", "debt", "status", "payment_time", "approved_by", "receipt")
+
+
+def file_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".json":
+        return "json"
+    return "jsonl" if ext in (".jsonl", ".ndjson") else "csv"
+
+
+def _pick(row, keys):
+    for k in keys:
+        if k in row:
+            return row[k]
+    return None
+
+
+def read_rows(path, fmt=None):
+    """Yield (line number, row dict or None if unreadable) from path."""
+    fmt = fmt or file_format(path)
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, {k.strip().lower(): v for k, v in row.items() if k}
+        elif fmt == "json":
+            try:
+                doc = json.load(f)
+            except ValueError as e:
+                raise ValueError(f"فایل JSON خوانا نیست: {e}")
+            rows = doc.get("users") if isinstance(doc, dict) else doc
+            if not isinstance(rows, list):
+                raise ValueError('فایل JSON باید فهرستی از افراد یا {"users": [...]} باشد.')
+            # numbered by position in the list, there are no lines to point at
+            for n, row in enumerate(rows, 1):
+                yield n, row if isinstance(row, dict) else None
+        else:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield n, row if isinstance(row, dict) else None
+
+
+def import_users(store, path, fmt=None, batch_size=BATCH_SIZE, progress=None):
+    """Add every valid row of path to store.
+
+    Returns (added, errors) where errors lists (line number, message);
+    for a .json file the number is the row's position in the list.
+    progress(added) is called after each committed batch. A file that is
+    not rows at all raises ValueError before anything is added.
+    """
+    added, errors, batch = 0, [], []
+    for line, row in read_rows(path, fmt):
+        try:
+            if row is None:
+                raise ValueError("سطر قابل خواندن نیست.")
+            name, debt = parse_user_fields(_pick(row, NAME_KEYS), _pick(row, DEBT_KEYS))
+        except ValueError as e:
+            errors.append((line, str(e)))
+            continue
+        batch.append(new_user(name, debt))
+        if len(batch) >= batch_size:
+            added += len(store.add_users(batch))
+            batch = []
+            if progress:
+                progress(added)
+    if batch:
+        added += len(store.add_users(batch))
+        if progress:
+            progress(added)
+    return added, errors
+
+
+def export_row(u):
+    return {"id": u.get("id", ""), "name": u.get("name", ""), "debt": u.get("debt", 0),
+            "status": user_status(u), "payment_time": u.get("payment_time", ""),
+            "approved_by": u.get("approved_by", ""), "receipt": u.get("receipt", "")}
+
+
+def write_users(users, out, fmt="csv"):
+    # users may be any iterable; returns how many were written
+    n = 0
+    if fmt == "csv":
+        w = csv.DictWriter(out, EXPORT_FIELDS)
+        w.writeheader()
+        for u in users:
+            w.writerow(export_row(u))
+            n += 1
+    elif fmt == "json":
+        out.write("[")
+        for u in users:
+            out.write(("\n" if n == 0 else ",\n") + json.dumps(export_row(u), ensure_ascii=False))
+            n += 1
+        out.write("\n]\n")
+    else:
+        for u in users:
+            out.write(json.dumps(export_row(u), ensure_ascii=False) + "\n")
+            n += 1
+    return n
+
+
+def export_users(users, path, fmt=None):
+    fmt = fmt or file_format(path)
+    # the BOM lets spreadsheet programs pick up the Persian text in a CSV
+    with open(path, "w", encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="") as f:
+        return write_users(users, f, fmt)
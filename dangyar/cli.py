@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+# Command line for batch work on a data directory, without the GUI:
+#
+#   python -m dangyar list --status pending --format csv > pending.csv
+#   python -m dangyar approve --all --method cash
+#   python -m dangyar approve --ids-from approved.txt
+#   python -m dangyar report
+#   python -m dangyar dashboard
+#   python -m dangyar events --user "علی رضایی"
+#   python -m dangyar import roster.csv
+#   python -m dangyar export --status unpaid unpaid.jsonl
+#   python -m dangyar ledgers
+#   python -m dangyar --ledger "سفر شمال" list
+#   python -m dangyar find-member رضایی
+#   python -m dangyar expense-add --payer "علی رضایی" --amount 1200000 --title شام --all
+#   python -m dangyar settle
+#   python -m dangyar dump-json backup.json
+#   python -m dangyar backup --reason "before the trip"
+#   python -m dangyar restore 20250101-120000-abc123
+#   python -m dangyar remind --all-ledgers --outbox dir --to outbox/ --loop 600
+#   python -m dangyar serve --host 0.0.0.0 --port 8765
+#
+# Everything runs in one process on the same store the GUI uses, so
+# thousands of records are listed or approved in a single invocation.
+import argparse, json, os, sys, time
+
+from dangyar.backups import KEEP_DAILY, KEEP_LAST, KEEP_WEEKLY
+from dangyar.core import DangYarCore, DEFAULT_APP_DIR, STATUS_TEXT, APPROVALS, APPROVER, user_status
+from dangyar.ledgers import Ledgers
+from dangyar.splitting import SPLITS, SPLIT_TEXT
+from dangyar.bulk import BATCH_SIZE, export_users, import_users, write_users
+from dangyar.metrics import METRICS
+from dangyar.money import to_toman
+from dangyar.payments import EVENT_TEXT
+from dangyar.reminders import BATCH, OUTBOXES, QUIET_HOURS, REMIND_EVERY_H, parse_quiet
+from dangyar.storage import export_json
+
+
+def write_rows(users, fmt, out):
+    if fmt in ("csv", "jsonl"):
+        write_users(users, out, fmt)
+    else:
+        for u in users:
+            out.write(f"{u.get('id', '')}\t{u.get('name', '')}\t{u.get('debt', 0):,}\t{STATUS_TEXT[user_status(u)]}\n")
+
+
+def cmd_list(core, args):
+    write_rows(core.users(args.status, args.min_debt), args.format, sys.stdout)
+    return 0
+
+
+def cmd_search(core, args):
+    write_rows(core.find_users_by_name(args.query, limit=args.limit), args.format, sys.stdout)
+    return 0
+
+
+def _read_ids(path):
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        return [line.strip() for line in f if line.strip()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def cmd_approve(core, args):
+    if args.all:
+        uids = [u["id"] for u in core.users("pending") if APPROVALS[args.method](u)]
+    else:
+        uids = list(args.id or [])
+        if args.ids_from:
+            uids += _read_ids(args.ids_from)
+    if not uids:
+        print("nothing to approve", file=sys.stderr)
+        return 0
+    approved, skipped = core.approve(uids, args.method, args.by)
+    print(f"approved {len(approved)}, skipped {len(skipped)}", file=sys.stderr)
+    for uid in skipped:
+        print(f"skipped {uid}", file=sys.stderr)
+    return 0 if not skipped or args.all else 1
+
+
+def cmd_reject(core, args):
+    uids = list(args.id or [])
+    if args.ids_from:
+        uids += _read_ids(args.ids_from)
+    rejected, skipped = core.reject(uids)
+    print(f"rejected {len(rejected)}, skipped {len(skipped)}", file=sys.stderr)
+    return 0 if not skipped else 1
+
+
+def cmd_dashboard(core, args):
+    totals = core.dashboard()
+    if args.format == "json":
+        print(json.dumps(totals, ensure_ascii=False))
+    else:
+        for key, v in totals.items():
+            print(f"{key}\t{v:,}")
+    return 0
+
+
+def cmd_events(core, args):
+    try:
+        uid = core.resolve_user(args.user)["id"] if args.user else None
+    except ValueError as e:
+        print(f"dangyar: {e}", file=sys.stderr)
+        return 1
+    events = core.history(uid, args.limit)
+    if args.format == "jsonl":
+        for e in events:
+            print(json.dumps(e, ensure_ascii=False))
+        return 0
+    for e in events:
+        print(f"{e.get('time', '')}\t{EVENT_TEXT.get(e['event'], e['event'])}\t{e.get('name', e.get('backup', ''))}\t"
+              f"{e.get('amount', 0):,}\t{e.get('method', '')}\t{e.get('by', '')}")
+    return 0
+
+
+def cmd_import(core, args):
+    try:
+        added, errors = import_users(core.store, args.file, args.format, args.batch_size)
+    except ValueError as e:
+        print(f"dangyar: {args.file}: {e}", file=sys.stderr)
+        return 1
+    for line, msg in errors:
+        print(f"{args.file}:{line}: {msg}", file=sys.stderr)
+    print(f"added {added}, rejected {len(errors)}", file=sys.stderr)
+    return 1 if errors else 0
+
+
+def cmd_export(core, args):
+    n = export_users(core.users(args.status, args.min_debt), args.file, args.format)
+    print(f"exported {n}", file=sys.stderr)
+    return 0
+
+
+def cmd_dump_json(core, args):
+    export_json(core.store, args.file)
+    return 0
+
+
+def cmd_backup(core, args):
+    entry = core.backup(args.reason)
+    if entry is None:
+        print("no changes since the last backup", file=sys.stderr)
+    else:
+        print(entry["id"])
+    return 0
+
+
+def cmd_backups(core, args):
+    for b in core.list_backups():
+        kind = "incr" if b.get("parent") else "full"
+        print(f"{b['id']}\t{b['time']}\t{kind}\t{b['users']}\t+{b['changed']} -{b['deleted']}\t"
+              f"{b['size']:,}\t{b.get('reason', '')}")
+    return 0
+
+
+def cmd_restore(core, args):
+    try:
+        data = core.restore(args.id)
+    except FileNotFoundError:
+        print(f"dangyar: no backup {args.id} in this ledger", file=sys.stderr)
+        return 1
+    print(f"restored {len(data['users'])} users from {args.id}")
+    return 0
+
+
+def cmd_prune(core, args):
+    n = core.prune_backups(keep_last=args.keep_last, keep_daily=args.keep_daily, keep_weekly=args.keep_weekly)
+    print(f"removed {n} backups")
+    return 0
+
+
+def cmd_remind(core, args):
+    outbox = OUTBOXES[args.outbox](args.to or os.path.join(core.app_dir, "outbox.jsonl" if args.outbox == "file" else "outbox"))
+    home = core.ledger
+    lids = [lid for lid, _ in core.ledgers.list()] if args.all_ledgers else [home]
+    try:
+        while True:
+            for lid in lids:
+                if lid != core.ledger:
+                    core.switch_ledger(lid, make_current=False)
+                r = core.remind(outbox, every=args.every, quiet=args.quiet, batch=args.batch, dry_run=args.dry_run)
+                if args.dry_run:
+                    for m in r["messages"]:
+                        print(f"{m['uid']}\t{m['name']}\t{m['debt']:,}\t{m['count']}")
+                note = " (quiet hours)" if r["quiet"] else ""
+                print(f"{core.ledgers.name(lid)}: checked {r['checked']}{' (full scan)' if r['full'] else ''}, "
+                      f"sent {r['sent']}, still due {r['due']}, scheduled {r['scheduled']}{note}", file=sys.stderr)
+            if not args.loop:
+                return 0
+            time.sleep(args.loop)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        if core.ledger != home:
+            core.switch_ledger(home, make_current=False)
+
+
+def cmd_serve(core, args):
+    from dangyar import api  # asyncio and the HTTP bits only when serving
+
+    def ready(addresses):
+        for host, port in addresses:
+            print(f"serving {core.ledgers.name(core.ledger)} on http://{host}:{port}/api/", flush=True)
+    api.run(core, args.host, args.port, ready, args.max_connections)
+    return 0
+
+
+def cmd_ledgers(core, args):
+    # totals come from the ledger list; no shard is opened
+    for lid, info in core.ledgers.list():
+        t = info.get("totals") or {}
+        mark = "*" if lid == core.ledger else " "
+        print(f"{mark} {lid}\t{info.get('name', '')}\t{t.get('users', 0)}\t{t.get('debt', 0):,}\t"
+              f"{t.get('paid', 0)} {STATUS_TEXT['paid']}\t{t.get('pending', 0)} {STATUS_TEXT['pending']}")
+    return 0
+
+
+def cmd_ledger_new(core, args):
+    lid = core.create_ledger(args.name)
+    if args.use:
+        core.ledgers.set_current(lid)
+    print(lid)
+    return 0
+
+
+def cmd_find_member(core, args):
+    for m in core.find_member(args.query, args.limit):
+        print(f"{m['ledger_name']}\t{m['id']}\t{m['name']}\t{m['debt']:,}\t{STATUS_TEXT[m['status']]}")
+    return 0
+
+
+def _names(core):
+    with core.store.lock:
+        return {u["id"]: u["name"] for u in core.load_data()["users"]}
+
+
+def cmd_expense_add(core, args):
+    try:
+        payer = core.resolve_user(args.payer)["id"]
+        participants, shares = None, None
+        if args.all:
+            participants = [u["id"] for u in core.users()]
+        elif args.split == "equal":
+            participants = [core.resolve_user(w)["id"] for w in args.with_ or ()]
+        else:
+            shares = {}
+            for w in args.with_ or ():
+                key, _, value = w.rpartition("=")
+                if not key:
+                    raise ValueError(f"«{w}»: سهم را به صورت نام=مقدار بدهید.")
+                shares[core.resolve_user(key)["id"]] = value
+        eid = core.add_expense(args.title, payer, args.amount, args.split, participants, shares)
+    except ValueError as e:
+        print(f"dangyar: {e}", file=sys.stderr)
+        return 1
+    print(eid)
+    return 0
+
+
+def cmd_expenses(core, args):
+    names = _names(core)
+    for e in core.expenses():
+        n = len(e.get("with") or e.get("shares") or ())
+        print(f"{e['id']}\t{e.get('time', '')}\t{e.get('title', '')}\t{names.get(e['payer'], e['payer'])}\t"
+              f"{e['amount']:,}\t{SPLIT_TEXT.get(e.get('split'), '')}\t{n}")
+    return 0
+
+
+def cmd_balances(core, args):
+    names = _names(core)
+    for uid, v in sorted(core.net_balances().items(), key=lambda kv: kv[1]):
+        print(f"{uid}\t{names.get(uid, '?')}\t{v:,}")
+    return 0
+
+
+def cmd_settle(core, args):
+    names = _names(core)
+    transfers = core.settlement()
+    for src, dst, amount in transfers:
+        print(f"{names.get(src, src)}\t->\t{names.get(dst, dst)}\t{amount:,}")
+    print(f"{len(transfers)} transfers", file=sys.stderr)
+    return 0
+
+
+def cmd_apply_balances(core, args):
+    try:
+        changes = core.balance_changes()
+    except ValueError as e:
+        print(f"dangyar: {e}", file=sys.stderr)
+        return 1
+    for u, debt in changes:
+        print(f"{u['id']}\t{u.get('name', '')}\t{u.get('debt', 0):,}\t->\t{debt:,}")
+    if not changes:
+        print("no debts to change", file=sys.stderr)
+        return 0
+    if not args.yes:
+        if not sys.stdin.isatty():
+            print(f"dangyar: {len(changes)} debts would be overwritten; pass --yes to apply", file=sys.stderr)
+            return 1
+        if input(f"overwrite {len(changes)} debts? [y/N] ").strip().lower() not in ("y", "yes"):
+            return 1
+    print(f"updated {core.apply_balances(changes)} debts", file=sys.stderr)
+    return 0
+
+
+def resolve_ledger(ledgers, key):
+    # a ledger id or its name
+    for lid, info in ledgers.list():
+        if key in (lid, info.get("name")):
+            return lid
+    raise SystemExit(f"dangyar: no ledger {key!r}")
+
+
+def cmd_report(core, args):
+    users = core.users()
+    counts = {s: 0 for s in STATUS_TEXT}
+    sums = {s: 0 for s in STATUS_TEXT}
+    for u in users:
+        s = user_status(u)
+        counts[s] += 1
+        sums[s] += u.get("debt", 0)
+    report = {"users": len(users), "count": counts, "debt": sums}
+    if args.format == "jsonl":
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        print(f"users\t{len(users)}")
+        for s, label in STATUS_TEXT.items():
+            print(f"{label}\t{counts[s]}\t{sums[s]:,}")
+    return 0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="dangyar", description="batch operations on a dangyar data directory")
+    ap.add_argument("--data-dir", help="directory with the data files (default: next to the app, or $DANGYAR_HOME)")
+    ap.add_argument("--backend", help="storage backend (default: $DANGYAR_STORAGE or journal)")
+    ap.add_argument("--metrics", metavar="FILE", help="time the run and dump the metrics here (.json or .prom)")
+    ap.add_argument("--ledger", help="ledger id or name (default: the current one)")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("list", help="print the roster")
+    p.add_argument("--status", choices=tuple(STATUS_TEXT))
+    p.add_argument("--min-debt", type=to_toman)
+    p.add_argument("--format", choices=("table", "csv", "jsonl"), default="table")
+    p.set_defaults(func=cmd_list)
+
+    p = sub.add_parser("search", help="find users by name")
+    p.add_argument("query")
+    p.add_argument("--limit", type=int, default=50)
+    p.add_argument("--format", choices=("table", "csv", "jsonl"), default="table")
+    p.set_defaults(func=cmd_search)
+
+    p = sub.add_parser("approve", help="approve pending payments")
+    g = p.add_mutually_exclusive_group(required=True)
+    g.add_argument("--all", action="store_true", help="every pending request")
+    g.add_argument("--id", action="append", help="user id (repeatable)")
+    g.add_argument("--ids-from", metavar="FILE", help="file with one user id per line, - for stdin")
+    p.add_argument("--method", choices=tuple(APPROVALS), default="any")
+    p.add_argument("--by", default=APPROVER, help="recorded as approved_by")
+    p.set_defaults(func=cmd_approve)
+
+    p = sub.add_parser("reject", help="turn down pending payment requests")
+    g = p.add_mutually_exclusive_group(required=True)
+    g.add_argument("--id", action="append", help="user id (repeatable)")
+    g.add_argument("--ids-from", metavar="FILE", help="file with one user id per line, - for stdin")
+    p.set_defaults(func=cmd_reject)
+
+    p = sub.add_parser("dashboard", help="outstanding and collected totals, pending counts by method")
+    p.add_argument("--format", choices=("text", "json"), default="text")
+    p.set_defaults(func=cmd_dashboard)
+
+    p = sub.add_parser("events", help="payment history, newest first")
+    p.add_argument("--user", help="name or id; default: everybody")
+    p.add_argument("--limit", type=int, default=50)
+    p.add_argument("--format", choices=("text", "jsonl"), default="text")
+    p.set_defaults(func=cmd_events)
+
+    p = sub.add_parser("import", help="add users from a CSV (name,debt), JSON-lines or JSON file")
+    p.add_argument("file")
+    p.add_argument("--format", choices=("csv", "jsonl", "json"), help="default: from the file extension")
+    p.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser("export", help="write the roster to a CSV, JSON-lines or JSON file")
+    p.add_argument("file")
+    p.add_argument("--status", choices=tuple(STATUS_TEXT))
+    p.add_argument("--min-debt", type=to_toman)
+    p.add_argument("--format", choices=("csv", "jsonl", "json"), help="default: from the file extension")
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser("dump-json", help="write the whole ledger (users, expenses, password) as data.json-style JSON")
+    p.add_argument("file")
+    p.set_defaults(func=cmd_dump_json)
+
+    p = sub.add_parser("backup", help="back up the ledger (only what changed since its last backup)")
+    p.add_argument("--reason", default="")
+    p.set_defaults(func=cmd_backup)
+
+    p = sub.add_parser("backups", help="list the ledger's backups, newest first")
+    p.set_defaults(func=cmd_backups)
+
+    p = sub.add_parser("restore", help="bring the ledger back to a backup (the current state is backed up first)")
+    p.add_argument("id")
+    p.set_defaults(func=cmd_restore)
+
+    p = sub.add_parser("prune", help="drop old backups of every ledger")
+    p.add_argument("--keep-last", type=int, default=KEEP_LAST)
+    p.add_argument("--keep-daily", type=int, default=KEEP_DAILY, help="also keep the newest backup of this many days")
+    p.add_argument("--keep-weekly", type=int, default=KEEP_WEEKLY, help="and of this many weeks")
+    p.set_defaults(func=cmd_prune)
+
+    p = sub.add_parser("remind", help="send payment reminders to unpaid members (rate limited, quiet hours)")
+    p.add_argument("--outbox", choices=sorted(OUTBOXES), default="file",
+                   help="file: append JSON lines; dir: one message file each, for a mail relay")
+    p.add_argument("--to", help="outbox file or directory (default: outbox.jsonl / outbox/ in the data directory)")
+    p.add_argument("--every", type=float, default=REMIND_EVERY_H, help="hours between reminders to one member")
+    p.add_argument("--quiet", type=parse_quiet, default=QUIET_HOURS, metavar="FROM-TO",
+                   help="no messages between these hours, e.g. 22-8 (default); 'none' to turn off")
+    p.add_argument("--batch", type=int, default=BATCH, help="messages per run at most")
+    p.add_argument("--all-ledgers", action="store_true")
+    p.add_argument("--dry-run", action="store_true", help="print what would be sent, record nothing")
+    p.add_argument("--loop", type=float, metavar="SECONDS", help="keep running, once every SECONDS")
+    p.set_defaults(func=cmd_remind)
+
+    p = sub.add_parser("serve", help="HTTP API for members' phones: search, balance, cash requests, receipts")
+    p.add_argument("--host", default="127.0.0.1", help="0.0.0.0 to accept phones on the local network")
+    p.add_argument("--port", type=int, default=8765, help="0 picks a free port")
+    p.add_argument("--max-connections", type=int, default=1000)
+    p.set_defaults(func=cmd_serve)
+
+    p = sub.add_parser("ledgers", help="list the ledgers with their totals")
+    p.set_defaults(func=cmd_ledgers)
+
+    p = sub.add_parser("ledger-new", help="create a ledger")
+    p.add_argument("name")
+    p.add_argument("--use", action="store_true", help="make it the current ledger")
+    p.set_defaults(func=cmd_ledger_new)
+
+    p = sub.add_parser("find-member", help="find a name in every ledger")
+    p.add_argument("query")
+    p.add_argument("--limit", type=int, default=50)
+    p.set_defaults(func=cmd_find_member)
+
+    p = sub.add_parser("expense-add", help="record a shared expense")
+    p.add_argument("--payer", required=True, help="name or id of who paid")
+    p.add_argument("--amount", required=True)
+    p.add_argument("--title", default="")
+    p.add_argument("--split", choices=SPLITS, default="equal")
+    g = p.add_mutually_exclusive_group(required=True)
+    g.add_argument("--all", action="store_true", help="split equally between everyone in the ledger")
+    g.add_argument("--with", dest="with_", action="append", metavar="NAME[=N]",
+                   help="participant (repeatable); NAME=weight or NAME=toman for weight/exact splits")
+    p.set_defaults(func=cmd_expense_add)
+
+    p = sub.add_parser("expenses", help="list the expenses")
+    p.set_defaults(func=cmd_expenses)
+
+    p = sub.add_parser("balances", help="net balance per member (negative: owes)")
+    p.set_defaults(func=cmd_balances)
+
+    p = sub.add_parser("settle", help="transfers that settle every balance")
+    p.set_defaults(func=cmd_settle)
+
+    p = sub.add_parser("apply-balances", help="set unpaid members' debts from the expenses")
+    p.add_argument("--yes", action="store_true", help="apply without asking; the debts to change are listed first")
+    p.set_defaults(func=cmd_apply_balances)
+
+    p = sub.add_parser("report", help="counts and totals per payment status")
+    p.add_argument("--format", choices=("table", "jsonl"), default="table")
+    p.set_defaults(func=cmd_report)
+
+    args = ap.parse_args(argv)
+    if args.metrics:
+        METRICS.enabled = True
+    ledger = resolve_ledger(Ledgers(args.data_dir or DEFAULT_APP_DIR), args.ledger) if args.ledger else None
+    core = DangYarCore(args.data_dir, args.backend, ledger)
+    for u, old in core.ensure_storage():
+        print(f"dangyar: debt of {u.get('name', '')} ({u.get('id')}) was {old!r}, stored as {u['debt']}", file=sys.stderr)
+    try:
+        return args.func(core, args)
+    finally:
+        # keep the ledger totals and member index in step with what we wrote
+        core.flush(only_if_changed=True)
+        if args.metrics:
+            METRICS.dump(args.metrics)
@@ -0,0 +1,505 @@
+# -*- coding: utf-8 -*-
+# Everything the app does that is not drawing windows: the data directory,
+# the store, name search and the payment state machine. The GUI and the
+# command line (dangyar/cli.py) both sit on top of this; it never imports
+# tkinter, so scripts and servers can use it without a display.
+import datetime, os
+
+from dangyar.storage import open_store, import_json, assign_ids, CachedStore, InUseError
+from dangyar.money import to_toman, int_amounts
+from dangyar.ledgers import Ledgers, LedgerChanges
+from dangyar.payments import PaymentLog
+from dangyar.backups import BackupChanges, Backups
+from dangyar.reminders import Reminders
+from dangyar.splitting import Balances, make_expense, settle
+from dangyar.search import NameIndex, normalize_name
+from dangyar.receipts import ReceiptStore
+from dangyar.metrics import timed
+
+# the directory holding "python dangyar.py"; DANGYAR_HOME points elsewhere
+DEFAULT_APP_DIR = os.environ.get("DANGYAR_HOME") or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PASSWORD = "1357"
+APPROVER = "مدیر"
+
+# ---------- Payment state ----------
+STATUS_TEXT = {"paid": "پرداخت شده", "pending": "در انتظار تأیید", "unpaid": "پرداخت نشده"}
+STATUS_RANK = {"pending": 0, "unpaid": 1, "paid": 2}
+
+
+def user_status(u):
+    if u.get("paid"):
+        return "paid"
+    if u.get("pending_cash") or u.get("pending_card"):
+        return "pending"
+    return "unpaid"
+
+
+# Each transition takes the current user record and returns the fields to
+# change, or None when the step no longer applies (e.g. another kiosk got
+# there first). They are run through store.modify_user, which re-runs them
+# if another process changed the record in between.
+def now_str():
+    return datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
+
+
+def request_cash(u):
+    if u.get("paid") or u.get("pending_cash") or u.get("pending_card"):
+        return None
+    return {"pending_cash": True, "pending_card": False, "receipt": ""}
+
+
+def attach_receipt(path):
+    def step(u):
+        if u.get("paid") or u.get("pending_cash") or u.get("pending_card"):
+            return None
+        return {"pending_card": True, "pending_cash": False, "receipt": path}
+    return step
+
+
+def approve_cash(u, by=APPROVER):
+    if not u.get("pending_cash"):
+        return None
+    return {"paid": True, "pending_cash": False, "payment_time": now_str(), "approved_by": by}
+
+
+def approve_card(u, by=APPROVER):
+    if not u.get("pending_card"):
+        return None
+    return {"paid": True, "pending_card": False, "payment_time": now_str(), "approved_by": by}
+
+
+def approve_any(u, by=APPROVER):
+    # whichever request is pending
+    return approve_cash(u, by) or approve_card(u, by)
+
+
+def reject_payment(u):
+    # the manager turns a request down; the user can ask again
+    if u.get("paid") or not (u.get("pending_cash") or u.get("pending_card")):
+        return None
+    return {"pending_cash": False, "pending_card": False, "receipt": ""}
+
+
+APPROVALS = {"cash": approve_cash, "card": approve_card, "any": approve_any}
+
+
+# ---------- Records ----------
+def parse_user_fields(name, debt):
+    # the checks of the add/edit dialog; ValueError carries the message to show
+    name = (name or "").strip()
+    if not name:
+        raise ValueError("نام نباید خالی باشد.")
+    try:
+        d = to_toman(debt if debt is not None else "")
+        if d < 0:
+            raise ValueError
+    except ValueError:
+        raise ValueError("مقدار بدهی نامعتبر است (عدد صحیح تومان).") from None
+    return name, d
+
+
+def new_user(name, debt):
+    return {
+        "name": name,
+        "debt": to_toman(debt),
+        "paid": False,
+        "pending_cash": False,
+        "pending_card": False,
+        "receipt": "",
+        "payment_time": "",
+        "approved_by": ""
+    }
+
+
+# ---------- Data directory ----------
+class DangYarCore:
+    """One data directory: the open ledger's store and name index, the
+    ledger list and the receipts (shared by all ledgers).
+
+    load_data() returns the store's shared in-memory copy, which is only
+    re-read when another process changed the files; change it through
+    ``store``, not in place.
+    """
+
+    def __init__(self, app_dir=None, backend=None, ledger=None):
+        self.app_dir = app_dir or DEFAULT_APP_DIR
+        # backend is picked with DANGYAR_STORAGE=json|journal|sqlite (default: journal)
+        self.backend = backend
+        self.receipt_dir = os.path.join(self.app_dir, "receipts")
+        # uploaded receipts, stored once per distinct content (see dangyar/receipts.py)
+        self.receipts = ReceiptStore(self.receipt_dir)
+        # incremental backups of every ledger (see dangyar/backups.py)
+        self.backups = Backups(os.path.join(self.app_dir, "backups"), self.receipts)
+        self.ledgers = Ledgers(self.app_dir)
+        self._open(ledger or self.ledgers.current())
+
+    def _open(self, lid):
+        self.ledger = lid
+        self.ledger_dir = self.ledgers.path(lid)
+        self.data_file = os.path.join(self.ledger_dir, "data.json")
+        self.store = CachedStore(open_store(self.ledger_dir, self.backend))
+        self.names = NameIndex()
+        self.changes = LedgerChanges()
+        self.balances = Balances()
+        # payment history and the dashboard totals (dangyar/payments.py)
+        self.payments = PaymentLog(os.path.join(self.ledger_dir, "payments.log"))
+        self.backup_changes = BackupChanges()
+        # kept open so repeated runs (remind --loop) only look at what changed
+        self.reminders = Reminders(self.store, self.payments, os.path.join(self.ledger_dir, "reminders.json"))
+        self.store.observers += [self.names, self.changes, self.balances, self.payments, self.backup_changes]
+
+    def ensure_storage(self, password=DEFAULT_PASSWORD):
+        """Create or migrate the open ledger's store. Returns [(user, old
+        debt)] for legacy debts that were not whole toman and got rounded."""
+        if not os.path.exists(self.receipt_dir):
+            os.makedirs(self.receipt_dir)
+        if not self.store.exists():
+            if os.path.exists(self.data_file):
+                # existing installs: pull the old data.json into the new backend
+                import_json(self.store, self.data_file)
+            else:
+                data = {
+                    "password": password,
+                    "users": []  # each: {id, name, debt, paid, pending_cash, pending_card, receipt, payment_time, approved_by}
+                }
+                self.save_data(data)
+        # older data has no user ids and float debts; fix both once and keep it
+        data = self.load_data()
+        rounded = []
+        if assign_ids(data) + int_amounts(data, rounded):
+            self.save_data(data)
+        return rounded
+
+    def warm_up(self):
+        # build what a full load leaves for first use (name bigrams,
+        # balances), e.g. from a background thread once the data is open
+        with self.store.lock:
+            data = self.load_data()
+            if self.names.data is not data:
+                self.names.rebuild(data)
+            len(self.names)
+            self.balances.net
+            self.payments.totals()
+
+    @timed("load_data", records=lambda data, self: len(data["users"]))
+    def load_data(self):
+        return self.store.load()
+
+    @timed("save_data", records=lambda r, self, data: len(data["users"]))
+    def save_data(self, data):
+        self.store.save(data)
+
+    @timed("search", records=lambda found, *a, **kw: len(found))
+    def find_users_by_name(self, query, data=None, limit=None):
+        # normalized substring match, best matches first (see dangyar/search.py)
+        with self.store.lock:
+            if data is None:
+                data = self.load_data()
+            if self.names.data is not data:
+                self.names.rebuild(data)
+            return self.names.search(query, limit)
+
+    def search_users(self, query):
+        """Matches for query, best first; read them with match_page()."""
+        with self.store.lock:
+            data = self.load_data()
+            if self.names.data is not data:
+                self.names.rebuild(data)
+            return self.names.matches(query)
+
+    def match_page(self, matches, page, size):
+        # under the store lock: the index may be changing underneath. Copies,
+        # so a caller on another thread can read them without the lock
+        with self.store.lock:
+            return [dict(u) for u in matches.page(page, size)]
+
+    def get_user(self, uid):
+        # a copy of one record, or None
+        with self.store.lock:
+            u = self.store.get_user(uid)
+            return dict(u) if u is not None else None
+
+    def roster(self):
+        """Password and copies of the user records, for the GUI.
+
+        The store thread updates the loaded records in place and may hold
+        the store lock for a long time (another station's file lock, an
+        fsync, a compaction), so the Tk thread reads these copies instead
+        and fetches new ones from a worker after each write.
+        """
+        with self.store.lock:
+            data = self.load_data()
+            return {"password": data.get("password", DEFAULT_PASSWORD), "users": [dict(u) for u in data["users"]]}
+
+    def users(self, status=None, min_debt=None):
+        # snapshot of the roster, optionally filtered like the manager panel
+        with self.store.lock:
+            users = list(self.load_data()["users"])
+        if status:
+            users = [u for u in users if user_status(u) == status]
+        if min_debt is not None:
+            users = [u for u in users if u.get("debt", 0) >= min_debt]
+        return users
+
+    @timed("approve", records=lambda r, *a, **kw: len(r[0]))
+    def approve(self, uids, method="any", by=APPROVER):
+        """Approve the pending payment of each user in uids.
+
+        Returns (approved, skipped): skipped holds ids that had nothing
+        pending for that method or no longer exist.
+        """
+        fn = APPROVALS[method]
+        # one batch write however many there are
+        changed = self.store.modify_users(uids, lambda u: fn(u, by))
+        approved = [uid for uid in uids if uid in changed]
+        skipped = [uid for uid in uids if uid not in changed]
+        return approved, skipped
+
+    @timed("reject", records=lambda r, *a, **kw: len(r[0]))
+    def reject(self, uids):
+        """Turn down the pending requests of uids; their receipts are released.
+
+        Returns (rejected, skipped) like approve().
+        """
+        receipts = []
+        def step(u):
+            # runs under the write lock, so u is the record being changed
+            fields = reject_payment(u)
+            if fields and u.get("receipt"):
+                receipts.append(u["receipt"])
+            return fields
+        changed = self.store.modify_users(uids, step)
+        self.release_receipts(receipts)
+        rejected = [uid for uid in uids if uid in changed]
+        return rejected, [uid for uid in uids if uid not in changed]
+
+    def delete_user(self, uid, reason=""):
+        """Back up the ledger, then delete one member.
+
+        ValueError while the member pays for or shares in an expense: the
+        balances would keep a debt nobody can settle. Those expenses have
+        to be edited or deleted first.
+        """
+        with self.store.lock:
+            self.load_data()
+            u = self.store.get_user(uid)
+            if u is None:
+                raise KeyError(uid)
+            in_use = self.store.index.expenses_of(uid)
+        if not in_use:
+            # the store checks again under its write lock, after the backup
+            self.backup(reason)
+            try:
+                self.store.delete_user(uid)
+                return
+            except InUseError as e:
+                in_use = e.expenses
+        titles = "، ".join(e.get("title") or "بی‌عنوان" for e in in_use[:3])
+        more = f" و {len(in_use) - 3} هزینهٔ دیگر" if len(in_use) > 3 else ""
+        raise ValueError(f"«{u['name']}» در هزینه‌های {titles}{more} آمده است؛ "
+                         "ابتدا آن هزینه‌ها را ویرایش یا حذف کنید.")
+
+    def dashboard(self):
+        # counts and toman per payment state, kept up to date incrementally
+        with self.store.lock:
+            self.load_data()
+            return self.payments.totals()
+
+    def history(self, uid=None, limit=100):
+        return self.payments.events(uid, limit)
+
+    def resolve_user(self, key):
+        """A user by id or by exact (normalized) name; ValueError if none or several."""
+        u = self.store.get_user(key)
+        if u is not None:
+            return u
+        q = normalize_name(key)
+        found = [u for u in self.find_users_by_name(key) if normalize_name(u["name"]) == q]
+        if not found:
+            raise ValueError(f"«{key}» در فهرست نیست.")
+        if len(found) > 1:
+            raise ValueError(f"چند نفر با نام «{key}» هست؛ شناسه را بدهید.")
+        return found[0]
+
+    # ---- expenses ----
+    def add_expense(self, title, payer, amount, split="equal", participants=None, shares=None):
+        e = make_expense(title, payer, amount, split, participants, shares)
+        return self.store.add_expenses([e])[0]
+
+    def update_expense(self, eid, title, payer, amount, split="equal", participants=None, shares=None):
+        # balances only move by the difference this one expense makes
+        e = make_expense(title, payer, amount, split, participants, shares)
+        fields = {k: e[k] for k in ("title", "payer", "amount", "split")}
+        fields["with" if split == "equal" else "shares"] = e.get("with") or e.get("shares")
+        self.store.update_expense(eid, fields)
+
+    def expenses(self):
+        with self.store.lock:
+            return list(self.load_data().get("expenses", ()))
+
+    def net_balances(self):
+        with self.store.lock:
+            self.load_data()
+            return {uid: v for uid, v in self.balances.net.items() if v}
+
+    def settlement(self):
+        # [(from uid, to uid, toman)]
+        return settle(self.net_balances())
+
+    def expense_view(self):
+        # what the expenses dialog shows, read in one go: ({uid: name}, expenses, settlement)
+        with self.store.lock:
+            names = {u["id"]: u["name"] for u in self.load_data()["users"]}
+            return names, [dict(e) for e in self.expenses()], self.settlement()
+
+    def balance_changes(self):
+        """[(user, new debt)] that apply_balances() would write.
+
+        Only unpaid members who take part in an expense are listed, and
+        only when their debt differs; everyone else keeps a debt that may
+        have been entered by hand. ValueError if there are no expenses.
+        """
+        with self.store.lock:
+            data = self.load_data()
+            if not data.get("expenses"):
+                raise ValueError("هیچ هزینه‌ای ثبت نشده است؛ بدهی‌ها تغییر نکرد.")
+            out = []
+            for uid, v in self.balances.net.items():
+                u = self.store.index.get(uid)
+                if u is None or u.get("paid") or u.get("pending_cash") or u.get("pending_card"):
+                    continue
+                debt = max(0, -v)
+                if debt != u.get("debt", 0):
+                    out.append((u, debt))
+            return out
+
+    def apply_balances(self, changes=None):
+        """Write balance_changes(), or the list the manager confirmed.
+
+        A member whose debt or payment state moved since the list was made
+        is left alone. One write; returns how many debts changed.
+        """
+        if changes is None:
+            changes = self.balance_changes()
+        planned = {u["id"]: (u.get("debt", 0), debt) for u, debt in changes}
+        def step(u):
+            old, debt = planned[u["id"]]
+            if u.get("paid") or u.get("pending_cash") or u.get("pending_card") or u.get("debt", 0) != old:
+                return None
+            return {"debt": debt}
+        return len(self.store.modify_users(list(planned), step))
+
+    # ---- ledgers ----
+    def flush(self, only_if_changed=False):
+        # update the ledger list totals and the cross-ledger member index
+        if only_if_changed and self.changes.base is not None and not self.changes.changed and not self.changes.deleted:
+            return None
+        if not self.store.exists():
+            return None
+        return self.ledgers.flush(self.ledger, self.store, self.changes, self.payments)
+
+    def switch_ledger(self, lid, make_current=True):
+        """Close the open ledger and open lid; only its shard is loaded."""
+        if lid not in dict(self.ledgers.list()):
+            raise KeyError(lid)
+        password = self.load_data().get("password", DEFAULT_PASSWORD)
+        self.flush()
+        self._open(lid)
+        self.ensure_storage(password)
+        if make_current:
+            self.ledgers.set_current(lid)
+        return self.load_data()
+
+    def create_ledger(self, name):
+        # new ledgers start with the manager password of the open one
+        lid = self.ledgers.create(name)
+        store = open_store(self.ledgers.path(lid), self.backend)
+        store.save({"password": self.load_data().get("password", DEFAULT_PASSWORD), "users": []})
+        return lid
+
+    def set_password(self, value):
+        # one manager password for every ledger
+        self.store.set_password(value)
+        for lid, _ in self.ledgers.list():
+            if lid != self.ledger:
+                store = open_store(self.ledgers.path(lid), self.backend)
+                if store.exists():
+                    store.set_password(value)
+
+    def find_member(self, query, limit=50):
+        # across all ledgers, through the shared member index
+        return self.ledgers.find_member(query, limit)
+
+    # ---------- Backups ----------
+    def backup(self, reason="", full=False):
+        """Back up the open ledger if it changed since its last backup;
+        returns the new backup's entry or None."""
+        store, lid, tracker = self.store, self.ledger, self.backup_changes
+
+        def capture(last, whole):
+            with store.lock:
+                data = store.load()
+                users, expenses = data["users"], data.get("expenses", ())
+                dirty = tracker.take(last, whole)
+                if dirty is not None:
+                    users = [u for u in users if u["id"] in dirty[0]]
+                    expenses = [e for e in expenses if e["id"] in dirty[1]]
+                # copies, so the diff can run while the store keeps changing
+                return {"password": data.get("password"), "users": [dict(u) for u in users],
+                        "expenses": [dict(e) for e in expenses]}, dirty
+
+        try:
+            entry = self.backups.create(lid, capture, reason, full)
+        except BaseException:
+            tracker.base = None
+            raise
+        if entry is not None:
+            tracker.base = entry["id"]
+        return entry
+
+    def list_backups(self):
+        return self.backups.list(self.ledger)
+
+    def restore(self, sid):
+        """Bring the open ledger back to backup sid.
+
+        The current state is backed up first, so a restore can be undone
+        the same way. Receipt files the backup refers to are put back.
+        """
+        data, objects = self.backups.materialize(self.ledger, sid)
+        self.backup("قبل از بازگردانی")
+        self.backups.restore_receipts(data["users"], objects)
+        restored = {u["receipt"] for u in data["users"] if u.get("receipt")}
+        with self.store.lock:
+            current = self.load_data()
+            if data.get("password") is None:
+                data["password"] = current.get("password", DEFAULT_PASSWORD)
+            old = [u["receipt"] for u in current["users"] if u.get("receipt")]
+            # the restored records take their references before the old ones let go
+            for u in data["users"]:
+                if u.get("receipt"):
+                    self.receipts.retain(u["receipt"])
+            self.save_data(data)
+        self.release_receipts([p for p in old if self.receipts.is_managed(p) or p not in restored])
+        # a full backup of the result: the roster order it brings back is not
+        # something the next incremental one could express
+        self.backup("بازگردانی " + sid, full=True)
+        self.payments.note("restore", backup=sid, users=len(data["users"]))
+        return data
+
+    def prune_backups(self, **policy):
+        # keep_last / keep_daily / keep_weekly, see dangyar/backups.py
+        return self.backups.prune(**policy)
+
+    # ---------- Reminders ----------
+    def remind(self, outbox, **policy):
+        """One reminder run over the open ledger (see dangyar/reminders.py);
+        policy: now, every, quiet, batch, dry_run."""
+        self.reminders.ledger_name = self.ledgers.name(self.ledger)
+        return self.reminders.run(outbox, **policy)
+
+    def release_receipts(self, paths):
+        # shared receipt files are only deleted once nobody references them
+        for p in paths:
+            try: self.receipts.release(p)
+            except: pass
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# Ledgers: separate rosters for trips, events, months...
+#
+# Each ledger is a shard with its own store files. The original data in the
+# app directory is the "default" ledger; the others live in
+# ledgers/<id>/. Opening a ledger loads only its shard.
+#
+# Two shared indexes sit next to the shards and are brought up to date
+# from the open ledger by flush() (on switching ledgers and on exit), so
+# nothing has to open every shard:
+#   ledgers.json  - the ledger list with per-ledger totals (small, JSON)
+#   members.db    - every member of every ledger, for cross-ledger lookup
+#                   (SQLite, queried without loading anything into memory)
+#
+# find_member() goes through two full-text indexes of the normalized names:
+# trigrams for queries of three or more letters (any substring), word
+# prefixes for shorter ones. Only the matching members are read; SQLite
+# ranks them and stops at the limit. flush() updates the indexes with the
+# members table, a statement per index rather than per row. Without FTS5
+# in the sqlite3 module, all members are scanned.
+import datetime, hashlib, json, os, sqlite3, threading, uuid
+
+from dangyar.locking import FileLock
+from dangyar.payments import payment_kind, payment_totals
+from dangyar.search import normalize_name
+from dangyar.storage import read_json_file, write_json_file
+
+DEFAULT_LEDGER = "default"
+DEFAULT_LEDGER_NAME = "دفتر اصلی"
+# lower is better, as search._rank: exact, whole-name prefix, word prefix, substring
+_RANK_SQL = ("CASE WHEN m.norm = :q THEN 0 WHEN substr(m.norm, 1, length(:q)) = :q THEN 1 "
+             "WHEN instr(m.norm, ' ' || :q) > 0 THEN 2 ELSE 3 END")
+_FTS = ("members_tri", "members_words")
+_FTS_SQL = ("CREATE VIRTUAL TABLE members_tri USING fts5(norm, content='members', tokenize='trigram')",
+            "CREATE VIRTUAL TABLE members_words USING fts5(norm, content='members', "
+            "tokenize='unicode61 remove_diacritics 0', prefix='1 2')")
+
+
+def fingerprint(data):
+    # changes whenever a user is added, removed or updated (rev bump). One
+    # hash over the roster in store order, not crc32s xor'ed together: crc32
+    # is linear, so an even number of rev bumps could cancel out and flush
+    # would skip the update.
+    h = hashlib.blake2b(digest_size=8)
+    for u in data["users"]:
+        h.update(f"{u.get('id')}:{u.get('rev', 0)}\n".encode("utf-8"))
+    return f"{len(data['users'])}:{h.hexdigest()}"
+
+
+def ledger_totals(users):
+    return payment_totals(users)
+
+
+class LedgerChanges:
+    """Store observer: which users of the open ledger changed since the
+    shared indexes were last brought up to date."""
+
+    def __init__(self):
+        self.data = None
+        self.base = None
+        self.changed = set()
+        self.deleted = set()
+
+    def rebuild(self, data):
+        self.data = data
+        self.base = fingerprint(data)
+        self.changed.clear()
+        self.deleted.clear()
+
+    def observe(self, change, data, user):
+        op = change["op"]
+        if op == "add":
+            self.changed.add(change["user"]["id"])
+            self.deleted.discard(change["user"]["id"])
+        elif op == "update":
+            self.changed.add(change["id"])
+        elif op == "delete":
+            self.changed.discard(change["id"])
+            self.deleted.add(change["id"])
+        elif op == "clear":
+            self.base = None  # forces a full resync
+
+
+class Ledgers:
+    def __init__(self, app_dir):
+        self.app_dir = app_dir
+        self.root = os.path.join(app_dir, "ledgers")
+        self.index_path = os.path.join(self.root, "ledgers.json")
+        self.members_path = os.path.join(self.root, "members.db")
+        self.lock = None
+        self._db = None
+        self._fts = False
+        self._db_lock = threading.RLock()  # the GUI flushes and searches from worker threads
+
+    def _lock(self):
+        if self.lock is None:
+            os.makedirs(self.root, exist_ok=True)
+            self.lock = FileLock(self.index_path + ".lock")
+        return self.lock
+
+    # ---- ledger list ----
+    def _read(self):
+        try:
+            index = read_json_file(self.index_path)
+        except FileNotFoundError:
+            index = {"current": DEFAULT_LEDGER, "ledgers": {}}
+        index["ledgers"].setdefault(DEFAULT_LEDGER, {"name": DEFAULT_LEDGER_NAME, "created": "", "totals": {}})
+        return index
+
+    def _update(self, fn):
+        with self._lock().exclusive():
+            index = self._read()
+            result = fn(index)
+            write_json_file(self.index_path, index)
+            return result
+
+    def list(self):
+        # [(id, info)] oldest first; info has name, created and totals
+        return sorted(self._read()["ledgers"].items(), key=lambda kv: (kv[0] != DEFAULT_LEDGER, kv[1].get("created", "")))
+
+    def current(self):
+        index = self._read()
+        cur = index.get("current", DEFAULT_LEDGER)
+        return cur if cur in index["ledgers"] else DEFAULT_LEDGER
+
+    def set_current(self, lid):
+        def f(index):
+            if lid not in index["ledgers"]:
+                raise KeyError(lid)
+            index["current"] = lid
+        self._update(f)
+
+    def name(self, lid):
+        return self._read()["ledgers"].get(lid, {}).get("name", lid)
+
+    def path(self, lid):
+        # the data directory of a ledger's shard
+        if lid == DEFAULT_LEDGER:
+            return self.app_dir
+        return os.path.join(self.root, lid)
+
+    def create(self, name):
+        lid = uuid.uuid4().hex[:12]
+        os.makedirs(self.path(lid), exist_ok=True)
+        def f(index):
+            index["ledgers"][lid] = {"name": name, "created": datetime.datetime.now().isoformat(sep=" ", timespec="seconds"),
+                                     "totals": ledger_totals([])}
+        self._update(f)
+        return lid
+
+    def rename(self, lid, name):
+        self._update(lambda index: index["ledgers"][lid].update(name=name))
+
+    # ---- shared member index ----
+    def _members(self):
+        if self._db is None:
+            os.makedirs(self.root, exist_ok=True)
+            db = sqlite3.connect(self.members_path, timeout=30, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS members (ledger TEXT, uid TEXT, name TEXT, norm TEXT, doc TEXT, "
+                       "PRIMARY KEY (ledger, uid))")
+            db.execute("CREATE TABLE IF NOT EXISTS synced (ledger TEXT PRIMARY KEY, fp TEXT)")
+            db.commit()
+            self._fts = db.execute("SELECT 1 FROM sqlite_master WHERE name='members_tri'").fetchone() is not None
+            if not self._fts:
+                # a new members.db, or one from before the name indexes
+                try:
+                    with db:
+                        for sql in _FTS_SQL:
+                            db.execute(sql)
+                        for t in _FTS:
+                            db.execute(f"INSERT INTO {t} ({t}) VALUES ('rebuild')")
+                    self._fts = True
+                except sqlite3.OperationalError:
+                    pass  # no FTS5 (or no trigram tokenizer, SQLite < 3.34): find_member scans
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def _member_row(lid, u):
+        kind = payment_kind(u)
+        doc = {"debt": u.get("debt", 0), "status": "pending" if kind in ("cash", "card") else kind}
+        return (lid, u["id"], u.get("name", ""), normalize_name(u.get("name", "")), json.dumps(doc, ensure_ascii=False))
+
+    def flush(self, lid, store, changes, payments=None):
+        """Bring ledgers.json totals and members.db up to date with the open
+        ledger. store is its CachedStore, changes its LedgerChanges and
+        payments its PaymentLog (for the totals, without a scan)."""
+        with store.lock:
+            data = store.load()
+            fp = fingerprint(data)
+            totals = payments.totals() if payments is not None else ledger_totals(data["users"])
+            db = self._members()
+            with self._db_lock:
+                row = db.execute("SELECT fp FROM synced WHERE ledger=?", (lid,)).fetchone()
+            synced = row[0] if row else None
+            if synced == fp:
+                rows, deleted, full = None, (), False
+            elif synced is not None and synced == changes.base:
+                get = store.index.get
+                rows = [self._member_row(lid, get(uid)) for uid in changes.changed if get(uid) is not None]
+                deleted, full = list(changes.deleted), False
+            else:
+                rows = [self._member_row(lid, u) for u in data["users"] if u.get("id")]
+                deleted, full = (), True
+            changes.base = fp
+            changes.changed.clear()
+            changes.deleted.clear()
+        if rows is not None:
+            with self._db_lock, db:
+                if full:
+                    where, keys = "ledger=?", [(lid,)]
+                else:
+                    where, keys = "ledger=? AND uid=?", [(lid, uid) for uid in deleted] + [(lid, r[1]) for r in rows]
+                self._unindex(db, where, keys)
+                if full:
+                    db.execute("DELETE FROM members WHERE ledger=?", (lid,))
+                db.executemany("DELETE FROM members WHERE ledger=? AND uid=?", [(lid, uid) for uid in deleted])
+                db.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)", rows)
+                self._index(db, where, keys)
+                db.execute("INSERT OR REPLACE INTO synced VALUES (?, ?)", (lid, fp))
+        def f(index):
+            if lid in index["ledgers"]:
+                index["ledgers"][lid]["totals"] = totals
+        self._update(f)
+        return totals
+
+    def _index(self, db, where, keys):
+        # add the members matching where to the name indexes
+        if self._fts:
+            for t in _FTS:
+                db.executemany(f"INSERT INTO {t} (rowid, norm) SELECT rowid, norm FROM members WHERE {where}", keys)
+
+    def _unindex(self, db, where, keys):
+        # take them out again, while their rows still hold the indexed names
+        if self._fts:
+            for t in _FTS:
+                db.executemany(f"INSERT INTO {t} ({t}, rowid, norm) SELECT 'delete', rowid, norm FROM members "
+                               f"WHERE {where}", keys)
+
+    def find_member(self, query, limit=50):
+        """Members of every ledger whose name contains query, best first.
+
+        A query of one or two letters matches the start of a word. Returns
+        dicts with ledger, ledger_name, id, name, debt and status.
+        """
+        q = normalize_name(query)
+        if not q:
+            return []
+        params = {"q": q, "limit": limit}
+        with self._db_lock:
+            db = self._members()
+            if not self._fts:
+                found = "1"
+            elif len(q) >= 3:
+                found = "m.rowid IN (SELECT rowid FROM members_tri WHERE members_tri MATCH :match)"
+                params["match"] = '"' + q.replace('"', '""') + '"'
+            else:
+                found = "m.rowid IN (SELECT rowid FROM members_words WHERE members_words MATCH :match)"
+                params["match"] = '"' + q.replace('"', '""') + '"*'
+            rows = db.execute(f"SELECT m.ledger, m.uid, m.name, m.doc FROM members m WHERE {found} "
+                              f"AND instr(m.norm, :q) > 0 ORDER BY {_RANK_SQL}, length(m.norm), m.rowid LIMIT :limit",
+                              params).fetchall()
+        names = {lid: info.get("name", lid) for lid, info in self.list()}
+        out = []
+        for lid, uid, name, doc in rows:
+            out.append(dict(json.loads(doc), ledger=lid, ledger_name=names.get(lid, lid), id=uid, name=name))
+        return out
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Advisory file lock shared by every process using the same data directory.
+#
+# flock() on POSIX (shared or exclusive), msvcrt byte-range locking on
+# Windows (exclusive only). The lock is re-entrant within a process: a
+# nested acquire while it is already held is a no-op, so a store method
+# holding the write lock may call load() without deadlocking.
+import os, threading, time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._depth = 0
+        self._mode = None
+        self._tlock = threading.RLock()
+
+    def acquire(self, exclusive=True):
+        self._tlock.acquire()
+        if self._depth:
+            if exclusive and self._mode == "shared":
+                self._tlock.release()
+                raise RuntimeError("cannot upgrade a shared file lock")
+            self._depth += 1
+            return
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                else:
+                    while True:
+                        try:
+                            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:  # LK_LOCK gives up after ~10s
+                            time.sleep(0.05)
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            self._tlock.release()
+            raise
+        self._fd = fd
+        self._mode = "exclusive" if exclusive else "shared"
+        self._depth = 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fd, self._fd, self._mode = self._fd, None, None
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                else:
+                    os.lseek(fd, 0, 0)
+                    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            finally:
+                os.close(fd)
+        self._tlock.release()
+
+    def exclusive(self):
+        return _Held(self, True)
+
+    def shared(self):
+        return _Held(self, False)
+
+
+class _Held:
+    def __init__(self, lock, exclusive):
+        self.lock = lock
+        self.exclusive = exclusive
+
+    def __enter__(self):
+        self.lock.acquire(self.exclusive)
+        return self.lock
+
+    def __exit__(self, *exc):
+        self.lock.release()
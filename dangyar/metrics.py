@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# Operation timing for "why is it slow?" questions.
+#
+# Functions wrapped with @timed("name") record wall time, bytes read and
+# written and how many records they handled, per operation name. Storage
+# code reports file I/O with io(read=, written=); the bytes are added to
+# every timed operation running on that thread, so an approval shows the
+# journal append it caused. Operations slower than slow_ms are kept for the
+# diagnostics view and appended to the slow log.
+#
+# Off by default. While off, a wrapped call costs one attribute check and
+# io() returns straight away. Configuration:
+#   DANGYAR_METRICS=1         record from startup (the GUI can switch it on too)
+#   DANGYAR_SLOW_MS=250       slow-operation threshold in milliseconds
+#   DANGYAR_SLOW_LOG=path     append slow operations here as JSON lines
+#   DANGYAR_METRICS_FILE=path write a dump at exit (.prom/.txt: Prometheus text, else JSON)
+import atexit, collections, functools, json, os, threading, time
+
+
+class _Op:
+    __slots__ = ("name", "start", "bytes_read", "bytes_written", "records")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.records = None
+
+
+class _Stat:
+    __slots__ = ("calls", "errors", "total", "max", "bytes_read", "bytes_written", "records")
+
+    def __init__(self):
+        self.calls = self.errors = self.bytes_read = self.bytes_written = self.records = 0
+        self.total = self.max = 0.0
+
+    def as_dict(self):
+        return {"calls": self.calls, "errors": self.errors, "total_s": round(self.total, 6),
+                "avg_ms": round(self.total * 1000 / self.calls, 3) if self.calls else 0.0,
+                "max_ms": round(self.max * 1000, 3), "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written, "records": self.records}
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = os.environ.get("DANGYAR_METRICS", "").lower() in ("1", "true", "yes", "on")
+        self.slow_ms = float(os.environ.get("DANGYAR_SLOW_MS") or 250)
+        self.slow_log = os.environ.get("DANGYAR_SLOW_LOG") or None
+        self.started = time.time()
+        self.stats = {}
+        self.slow = collections.deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def begin(self, name):
+        op = _Op(name)
+        self._stack().append(op)
+        return op
+
+    def end(self, op, error=False):
+        elapsed = time.perf_counter() - op.start
+        stack = self._stack()
+        if stack and stack[-1] is op:
+            stack.pop()
+        with self._lock:
+            st = self.stats.get(op.name)
+            if st is None:
+                st = self.stats[op.name] = _Stat()
+            st.calls += 1
+            st.errors += error
+            st.total += elapsed
+            st.max = max(st.max, elapsed)
+            st.bytes_read += op.bytes_read
+            st.bytes_written += op.bytes_written
+            st.records += op.records or 0
+        if elapsed * 1000 >= self.slow_ms:
+            self._slow(op, elapsed)
+
+    def _slow(self, op, elapsed):
+        entry = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "op": op.name, "ms": round(elapsed * 1000, 1),
+                 "bytes_read": op.bytes_read, "bytes_written": op.bytes_written, "records": op.records,
+                 "thread": threading.current_thread().name}
+        self.slow.append(entry)
+        if self.slow_log:
+            try:
+                with open(self.slow_log, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError:
+                pass
+
+    def io(self, read=0, written=0):
+        if not self.enabled:
+            return
+        for op in getattr(self._local, "stack", ()):
+            op.bytes_read += read
+            op.bytes_written += written
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+            self.slow.clear()
+            self.started = time.time()
+
+    # ---- dumps ----
+    def snapshot(self):
+        with self._lock:
+            ops = {name: st.as_dict() for name, st in sorted(self.stats.items())}
+        return {"enabled": self.enabled, "since": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+                "slow_ms": self.slow_ms, "ops": ops, "slow": list(self.slow)}
+
+    def prometheus(self):
+        ops = self.snapshot()["ops"]
+        lines = []
+        for metric, key, kind, scale in (
+                ("dangyar_op_calls_total", "calls", "counter", 1),
+                ("dangyar_op_errors_total", "errors", "counter", 1),
+                ("dangyar_op_seconds_total", "total_s", "counter", 1),
+                ("dangyar_op_max_seconds", "max_ms", "gauge", 0.001),
+                ("dangyar_op_read_bytes_total", "bytes_read", "counter", 1),
+                ("dangyar_op_written_bytes_total", "bytes_written", "counter", 1),
+                ("dangyar_op_records_total", "records", "counter", 1)):
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, d in ops.items():
+                lines.append(f'{metric}{{op="{name}"}} {d[key] * scale:g}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        if os.path.splitext(path)[1].lower() in (".prom", ".txt"):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+
+METRICS = Metrics()
+
+
+class _NoOp:
+    records = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoOp()
+
+
+class _Timing:
+    __slots__ = ("name", "op")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.op = METRICS.begin(self.name)
+        return self.op
+
+    def __exit__(self, exc_type, exc, tb):
+        METRICS.end(self.op, error=exc_type is not None)
+        return False
+
+
+def measure(name):
+    """with measure("x") as op: ... ; set op.records if it means something."""
+    if not METRICS.enabled:
+        return _NOOP
+    return _Timing(name)
+
+
+def timed(name, records=None):
+    # records(result, *args, **kw) -> how many records the call handled
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kw):
+            if not METRICS.enabled:
+                return fn(*args, **kw)
+            op = METRICS.begin(name)
+            try:
+                result = fn(*args, **kw)
+            except BaseException:
+                METRICS.end(op, error=True)
+                raise
+            if records is not None:
+                try:
+                    op.records = records(result, *args, **kw)
+                except Exception:
+                    pass
+            METRICS.end(op)
+            return result
+        return wrapper
+    return deco
+
+
+def io(read=0, written=0):
+    if METRICS.enabled:
+        METRICS.io(read, written)
+
+
+_dump_file = os.environ.get("DANGYAR_METRICS_FILE")
+if _dump_file:
+    atexit.register(lambda: METRICS.dump(_dump_file))
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Amounts are whole toman, kept as int everywhere: stored, summed and
+# shown without float rounding. Older data stored debts as floats
+# (1000.0); int_amounts() converts them once when the store is opened
+# and reports the ones that were not whole.
+
+# debts and expenses above this are refused (fits the snapshot's int64 columns)
+MAX_TOMAN = 10 ** 15
+
+# Persian and Arabic-Indic digits as typed on Persian keyboards
+_DIGITS = str.maketrans("۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩", "01234567890123456789")
+
+
+def to_toman(value):
+    """int toman from user input or stored data; ValueError if it isn't one.
+
+    Accepts ints, integral floats (1000.0) and text with thousands
+    separators or Persian digits ("۱٬۲۰۰٬۰۰۰").
+    """
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, int):
+        n = value
+    elif isinstance(value, float):
+        if value != value or value in (float("inf"), float("-inf")) or value != int(value):
+            raise ValueError(value)
+        n = int(value)
+    else:
+        text = str(value).translate(_DIGITS).replace(",", "").replace("٬", "").replace("،", "").strip()
+        try:
+            n = int(text)
+        except ValueError:
+            f = float(text)  # "1200.0"
+            if f != f or f in (float("inf"), float("-inf")) or f != int(f):
+                raise ValueError(value) from None
+            n = int(f)
+    if abs(n) > MAX_TOMAN:
+        raise ValueError(value)
+    return n
+
+
+def int_amounts(data, rounded=None):
+    # migrate float debts to int; returns how many changed. Debts to_toman
+    # refuses (1000.4, NaN, text) are rounded or zeroed, and each such
+    # (user, old debt) is appended to rounded so the caller can report it.
+    n = 0
+    for u in data["users"]:
+        d = u.get("debt", 0)
+        if type(d) is not int:
+            try:
+                u["debt"] = to_toman(d)
+            except ValueError:
+                u["debt"] = int(round(float(d))) if isinstance(d, float) and d == d and abs(d) <= MAX_TOMAN else 0
+                if rounded is not None:
+                    rounded.append((u, d))
+            n += 1
+    return n
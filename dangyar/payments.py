@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# Payment history and dashboard totals for one ledger.
+#
+# The user record only holds a payment's current state (pending_cash,
+# pending_card, paid, ...). PaymentLog keeps the rest:
+#
+#   payments.log  append-only JSON lines, one event per step:
+#                 add, request (cash), upload (card receipt), approve,
+#                 reject, edit (name/debt), delete, clear, restore
+#   totals        counts and toman per state (unpaid / pending cash /
+#                 pending card / paid), kept up to date one change at a
+#                 time so the dashboard reads them without a scan
+#
+# It is a store observer. Events are derived from each change and the
+# record it replaces, and only written for changes made through this
+# process's store (observe_local/committed); other processes log their
+# own. Totals follow every change, including ones read back from others.
+import datetime, json, os
+
+from dangyar.metrics import io
+
+EVENTS = ("add", "request", "upload", "approve", "reject", "edit", "delete", "clear", "restore")
+EVENT_TEXT = {"add": "افزودن", "request": "درخواست نقدی", "upload": "آپلود رسید", "approve": "تأیید",
+              "reject": "رد درخواست", "edit": "ویرایش", "delete": "حذف", "clear": "حذف همه",
+              "restore": "بازگردانی از پشتیبان"}
+KINDS = ("unpaid", "cash", "card", "paid")
+
+
+def payment_kind(u):
+    # finer than core.user_status: which request is pending
+    if u.get("paid"):
+        return "paid"
+    if u.get("pending_cash"):
+        return "cash"
+    if u.get("pending_card"):
+        return "card"
+    return "unpaid"
+
+
+def compose_totals(counts, amounts):
+    pending = counts["cash"] + counts["card"]
+    return {"users": sum(counts.values()), "debt": sum(amounts.values()),
+            "paid": counts["paid"], "paid_amount": amounts["paid"],
+            "pending": pending, "unpaid_amount": sum(amounts.values()) - amounts["paid"],
+            "unpaid": counts["unpaid"], "pending_cash": counts["cash"], "pending_cash_amount": amounts["cash"],
+            "pending_card": counts["card"], "pending_card_amount": amounts["card"]}
+
+
+def payment_totals(users):
+    # the same numbers by a full scan
+    counts, amounts = dict.fromkeys(KINDS, 0), dict.fromkeys(KINDS, 0)
+    for u in users:
+        k = payment_kind(u)
+        counts[k] += 1
+        amounts[k] += u.get("debt", 0)
+    return compose_totals(counts, amounts)
+
+
+def events_for(change, user):
+    """[(event, fields)] for one store change; user is the record before it."""
+    op = change["op"]
+    if op == "add":
+        u = change["user"]
+        return [("add", {"uid": u["id"], "name": u.get("name", ""), "amount": u.get("debt", 0)})]
+    if op == "delete":
+        return [("delete", {"uid": user["id"], "name": user.get("name", ""), "amount": user.get("debt", 0),
+                            "state": payment_kind(user)})]
+    if op == "clear":
+        return [("clear", {})]
+    if op != "update":
+        return []
+    f = change["fields"]
+    after = dict(user, **f)
+    before_kind, after_kind = payment_kind(user), payment_kind(after)
+    base = {"uid": user["id"], "name": after.get("name", ""), "amount": after.get("debt", 0)}
+    out = []
+    if before_kind != after_kind:
+        if after_kind == "cash":
+            out.append(("request", dict(base, method="cash")))
+        elif after_kind == "card":
+            out.append(("upload", dict(base, method="card", receipt=os.path.basename(after.get("receipt") or ""))))
+        elif after_kind == "paid":
+            out.append(("approve", dict(base, method=before_kind if before_kind != "unpaid" else "manual",
+                                        by=after.get("approved_by", ""))))
+        elif before_kind in ("cash", "card"):
+            out.append(("reject", dict(base, method=before_kind)))
+        else:
+            out.append(("edit", dict(base, state="unpaid")))  # a payment taken back
+    if f.get("debt", user.get("debt", 0)) != user.get("debt", 0) or f.get("name", user.get("name")) != user.get("name"):
+        out.append(("edit", dict(base, old_amount=user.get("debt", 0), old_name=user.get("name", ""))))
+    return out
+
+
+class PaymentLog:
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self._counts = None
+        self._amounts = None
+        self._pending = []
+
+    # ---- totals ----
+    def rebuild(self, data):
+        self.data = data
+        self._counts = None  # counted on first use
+
+    def _count(self):
+        if self._counts is None:
+            counts, amounts = dict.fromkeys(KINDS, 0), dict.fromkeys(KINDS, 0)
+            for u in self.data["users"]:
+                k = payment_kind(u)
+                counts[k] += 1
+                amounts[k] += u.get("debt", 0)
+            self._counts, self._amounts = counts, amounts
+
+    def _move(self, u, sign):
+        k = payment_kind(u)
+        self._counts[k] += sign
+        self._amounts[k] += sign * u.get("debt", 0)
+
+    def observe(self, change, data, user):
+        if data is not self.data or self._counts is None:
+            return
+        op = change["op"]
+        if op == "add":
+            self._move(change["user"], 1)
+        elif op == "update":
+            self._move(user, -1)
+            self._move(dict(user, **change["fields"]), 1)
+        elif op == "delete":
+            self._move(user, -1)
+        elif op == "clear":
+            self._counts, self._amounts = dict.fromkeys(KINDS, 0), dict.fromkeys(KINDS, 0)
+
+    def totals(self):
+        """Dashboard numbers; O(1) once counted."""
+        if self.data is None:
+            return compose_totals(dict.fromkeys(KINDS, 0), dict.fromkeys(KINDS, 0))
+        self._count()
+        return compose_totals(self._counts, self._amounts)
+
+    # ---- event log ----
+    def observe_local(self, change, data, user):
+        now = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
+        for event, fields in events_for(change, user):
+            self._pending.append(dict(fields, time=now, event=event))
+
+    def note(self, event, **fields):
+        # an event that is not a store change (e.g. a restore)
+        self._pending.append(dict(fields, time=datetime.datetime.now().isoformat(sep=" ", timespec="seconds"), event=event))
+        self.committed()
+
+    def committed(self):
+        # one append for everything a (batch) write produced
+        if not self._pending:
+            return
+        lines = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in self._pending).encode("utf-8")
+        self._pending = []
+        with open(self.path, "ab") as f:
+            f.write(lines)
+        io(written=len(lines))
+
+    def read_from(self, offset):
+        """Events appended at or after byte offset, oldest first, and the
+        offset to continue from (a line still being written is left for
+        next time). None instead of the list if the log was started over."""
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return (None if offset else []), 0
+        with f:
+            size = f.seek(0, os.SEEK_END)
+            if size < offset:
+                return None, 0
+            f.seek(offset)
+            chunk = f.read(size - offset)
+        io(read=len(chunk))
+        end = chunk.rfind(b"\n") + 1
+        out = []
+        for line in chunk[:end].split(b"\n"):
+            if line.strip():
+                try:
+                    out.append(json.loads(line))
+                except ValueError:
+                    continue
+        return out, offset + end
+
+    def events(self, uid=None, limit=100):
+        """The newest events first; uid limits them to one user."""
+        if limit is not None and limit <= 0:
+            return []
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+        out = []
+        with f:
+            # read backwards in blocks so recent history costs the same on a long log
+            end = f.seek(0, os.SEEK_END)
+            rest = b""
+            while end > 0 and (limit is None or len(out) < limit):
+                start = max(0, end - 65536)
+                f.seek(start)
+                chunk = f.read(end - start) + rest
+                io(read=end - start)
+                lines = chunk.split(b"\n")
+                rest = lines.pop(0) if start > 0 else b""
+                for line in reversed(lines):
+                    if not line.strip():
+                        continue
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    if uid is None or e.get("uid") == uid:
+                        out.append(e)
+                        if limit is not None and len(out) >= limit:
+                            break
+                end = start
+        return out
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Content-addressed receipt storage.
+#
+# An uploaded receipt is hashed (sha256) while it is copied, and stored as
+# receipts/<2 hex>/<hash><ext>. Uploading the same image twice keeps one
+# file; a <hash>.refs sidecar counts how many records point at it, and the
+# file is removed when the last one lets go. Downscaled PNG previews live in
+# receipts/thumbs/ and are made in the background when Pillow is installed.
+import hashlib, os, threading, uuid
+
+from dangyar.locking import FileLock
+from dangyar.storage import write_file_atomic
+
+try:
+    from PIL import Image
+except ImportError:  # previews fall back to what Tk can read itself
+    Image = None
+
+CHUNK = 1 << 20
+THUMB_SIZE = (480, 480)
+# formats Tk's PhotoImage reads without Pillow
+TK_FORMATS = (".png", ".gif")
+
+
+class ReceiptStore:
+    def __init__(self, root):
+        self.root = root
+        self.thumb_dir = os.path.join(root, "thumbs")
+        self.lock = FileLock(os.path.join(root, ".lock"))
+
+    def is_managed(self, path):
+        # receipts uploaded before this store existed are plain files
+        name = os.path.splitext(os.path.basename(path or ""))[0]
+        parent = os.path.basename(os.path.dirname(path or ""))
+        return len(name) == 64 and parent == name[:2]
+
+    def _refs_path(self, path):
+        return os.path.splitext(path)[0] + ".refs"
+
+    def refs(self, path):
+        try:
+            with open(self._refs_path(path), "r", encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _set_refs(self, path, n):
+        write_file_atomic(self._refs_path(path), str(n).encode("ascii"))
+
+    def put(self, src):
+        """Copy src into the store and return the stored path.
+
+        The file is hashed while it streams into a temp file, so it is read
+        only once; if the content is already stored the copy is dropped.
+        """
+        up = self.upload(os.path.splitext(src)[1])
+        try:
+            with open(src, "rb") as fin:
+                while True:
+                    chunk = fin.read(CHUNK)
+                    if not chunk:
+                        break
+                    up.write(chunk)
+            return up.commit()
+        finally:
+            up.abort()
+
+    def upload(self, ext):
+        # a receipt arriving in pieces (e.g. an HTTP body), see ReceiptUpload
+        return ReceiptUpload(self, ext)
+
+    def retain(self, path):
+        # one more record points at an already stored receipt (e.g. a restore)
+        if not path or not self.is_managed(path):
+            return
+        with self.lock.exclusive():
+            self._set_refs(path, self.refs(path) + 1)
+
+    def release(self, path):
+        """Drop one reference to path; the file goes when nothing uses it."""
+        if not path:
+            return
+        if not self.is_managed(path):
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with self.lock.exclusive():
+            n = self.refs(path) - 1
+            if n > 0:
+                self._set_refs(path, n)
+                return
+            for p in (path, self._refs_path(path), self.thumbnail_path(path)):
+                if os.path.exists(p):
+                    os.remove(p)
+
+    # ---- previews ----
+    def thumbnail_path(self, path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(self.thumb_dir, stem + ".png")
+
+    def can_thumbnail(self, path):
+        return Image is not None
+
+    def make_thumbnail(self, path):
+        """Write a downscaled PNG of path (safe to call off the Tk thread).
+
+        Returns the preview's path, or None without Pillow or if the file
+        is not an image it can read.
+        """
+        thumb = self.thumbnail_path(path)
+        if os.path.exists(thumb):
+            return thumb
+        if Image is None or not os.path.exists(path):
+            return None
+        os.makedirs(self.thumb_dir, exist_ok=True)
+        tmp = f"{thumb}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with Image.open(path) as img:
+                img.thumbnail(THUMB_SIZE)
+                if img.mode not in ("RGB", "RGBA", "L", "P"):
+                    img = img.convert("RGB")
+                img.save(tmp, "PNG")
+            os.replace(tmp, thumb)
+        except (OSError, ValueError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+        return thumb
+
+
+class ReceiptUpload:
+    """write() the content piece by piece, then commit() for the stored path;
+    abort() drops it (a no-op after commit)."""
+
+    def __init__(self, store, ext):
+        os.makedirs(store.root, exist_ok=True)
+        self.store = store
+        self.ext = ext.lower()
+        self.size = 0
+        self.tmp = os.path.join(store.root, f".upload-{os.getpid()}-{uuid.uuid4().hex}.tmp")
+        self._h = hashlib.sha256()
+        self._f = open(self.tmp, "wb")
+
+    def write(self, chunk):
+        self._h.update(chunk)
+        self._f.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        store, digest = self.store, self._h.hexdigest()
+        dest = os.path.join(store.root, digest[:2], digest + self.ext)
+        with store.lock.exclusive():
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if os.path.exists(dest):
+                os.remove(self.tmp)
+            else:
+                os.replace(self.tmp, dest)
+            store._set_refs(dest, store.refs(dest) + 1)
+        return dest
+
+    def abort(self):
+        self._f.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
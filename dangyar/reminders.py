@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# Payment reminders for unpaid members, sent in batches to an outbox.
+#
+#   reminders.json   per ledger: how far payments.log has been read, when
+#                    each unpaid member is next due and what they were sent
+#   reminders.log    what each run changed since reminders.json was written,
+#                    one JSON line per run
+#
+# A run reads payments.log (dangyar/payments.py) on from where the last
+# one stopped; only the members named in the new events are looked at
+# again, plus the ones whose next reminder has come due. The first run -
+# and one after a restore, a reset or a log that was started over - scans
+# the roster once instead.
+#
+# The state stays in memory between runs (the --loop of the CLI), with the
+# due times also kept as a sorted list, so a run finds who is due by
+# bisection and writes only the entries it changed to reminders.log. Once
+# the log outgrows reminders.json it is folded into it. Both carry a
+# generation, so a log left over from before a rewrite is never replayed.
+#
+# A member is reminded while unpaid (no request pending) with a positive
+# debt, at most once every `every` hours and never in quiet hours; a run
+# sends at most `batch` messages and the rest stay due for the next one.
+#
+# Outboxes are pluggable: anything with send(messages). FileOutbox appends
+# JSON lines, DirOutbox writes one mail-like file per message - a pickup
+# directory an SMTP relay can drain.
+import bisect, datetime, json, os, uuid
+
+from dangyar.locking import FileLock
+from dangyar.metrics import io, timed
+from dangyar.payments import payment_kind
+from dangyar.storage import read_json_file, write_file_atomic, write_json_file
+
+REMIND_EVERY_H = 72
+QUIET_HOURS = (22, 8)  # no messages from 22:00 until 08:00
+BATCH = 500
+SUBJECT = "یادآوری بدهی"
+TEXT = "یادآوری دنگ‌یار: {name} عزیز، {debt:,} تومان بدهی در «{ledger}» دارید. لطفاً پرداخت کنید."
+FULL_SCAN_EVENTS = ("clear", "restore")
+COMPACT_BYTES = 64 * 1024  # reminders.log is folded into reminders.json past this and the json's size
+_LAST = chr(0x10FFFF)      # sorts after every uid: (t, _LAST) bounds all entries due at t
+
+
+def parse_quiet(text):
+    # "22-8" -> (22, 8); "" or "none" -> None
+    if not text or text.strip().lower() == "none":
+        return None
+    start, end = (int(x) for x in text.split("-"))
+    if not (0 <= start < 24 and 0 <= end < 24):
+        raise ValueError(f"quiet hours out of range: {text}")
+    return start, end
+
+
+def in_quiet_hours(t, quiet):
+    if not quiet or quiet[0] == quiet[1]:
+        return False
+    start, end = quiet
+    if start < end:
+        return start <= t.hour < end
+    return t.hour >= start or t.hour < end
+
+
+def needs_reminder(u):
+    return payment_kind(u) == "unpaid" and u.get("debt", 0) > 0
+
+
+# ---------- outboxes ----------
+class FileOutbox:
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, messages):
+        payload = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages).encode("utf-8")
+        with open(self.path, "ab") as f:
+            f.write(payload)
+        io(written=len(payload))
+        return len(messages)
+
+
+class DirOutbox:
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, messages):
+        os.makedirs(self.path, exist_ok=True)
+        for m in messages:
+            body = (f"To: {m['name']} <{m['uid']}>\nSubject: {SUBJECT}\nDate: {m['time']}\n"
+                    f"X-Dangyar-Ledger: {m['ledger']}\n\n{m['text']}\n").encode("utf-8")
+            stamp = m["time"].replace("-", "").replace(":", "").replace(" ", "")
+            write_file_atomic(os.path.join(self.path, f"{stamp}-{m['uid']}-{m['count']}.msg"), body)
+            io(written=len(body))
+        return len(messages)
+
+
+OUTBOXES = {"file": FileOutbox, "dir": DirOutbox}
+
+
+# ---------- scheduler ----------
+class Reminders:
+    def __init__(self, store, payments, state_path, ledger_name=""):
+        self.store = store
+        self.payments = payments  # the ledger's PaymentLog: its log is the change feed
+        self.state_path = state_path
+        self.log_path = os.path.splitext(state_path)[0] + ".log"
+        self.ledger_name = ledger_name
+        self.lock = FileLock(state_path + ".lock")
+        self.state = None    # {"gen", "offset", "due": {uid: time}, "sent": {uid: [time, count]}}
+        self.queue = []      # sorted [(time, uid)] of state["due"]
+        self._seen = None    # (reminders.json signature, bytes of reminders.log applied)
+        self._clean = True   # reminders.log ends with a whole line
+        self._stale = True   # reminders.log has no header for this reminders.json (yet)
+        self._changed = None
+
+    # ---- state ----
+    def _sig(self):
+        try:
+            st = os.stat(self.state_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _load(self):
+        # bring self.state up to what is on disk: reread reminders.json only
+        # when another process rewrote it, else apply new log lines
+        sig = self._sig()
+        try:
+            size = os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            size = 0
+        if self.state is None or self._seen[0] != sig or size < self._seen[1]:
+            try:
+                self.state = read_json_file(self.state_path) if sig else None
+            except ValueError:
+                self.state = None
+            self.queue = sorted((t, uid) for uid, t in self.state["due"].items()) if self.state else []
+            self._seen, self._clean, self._stale = (sig, 0), True, True
+        if size > self._seen[1]:
+            with open(self.log_path, "rb") as f:
+                f.seek(self._seen[1])
+                chunk = f.read(size - self._seen[1])
+            io(read=len(chunk))
+            end = chunk.rfind(b"\n") + 1
+            self._clean = end == len(chunk)
+            for line in chunk[:end].split(b"\n"):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    self._clean = False
+                    continue
+                self._replay(entry)
+            self._seen = (sig, self._seen[1] + end)
+
+    def _replay(self, entry):
+        if "gen" in entry:
+            # the log's first line: it belongs to this reminders.json, or to one
+            # replaced since (a rewrite cut short) and is ignored
+            self._stale = self.state is None or entry["gen"] != self.state.get("gen")
+            return
+        if self._stale:
+            return
+        self.state["offset"] = entry["offset"]
+        for uid, t in entry["due"].items():
+            self._set_due(uid, t)
+        for uid, v in entry["sent"].items():
+            self._set_sent(uid, v)
+
+    def _set_due(self, uid, t):
+        due = self.state["due"]
+        old = due.get(uid)
+        if old == t:
+            return
+        if old is not None:
+            del self.queue[bisect.bisect_left(self.queue, (old, uid))]
+            del due[uid]
+        if t is not None:
+            bisect.insort(self.queue, (t, uid))
+            due[uid] = t
+        if self._changed is not None:
+            self._changed["due"][uid] = t
+
+    def _set_sent(self, uid, v):
+        sent = self.state["sent"]
+        if v is None:
+            if sent.pop(uid, None) is None:
+                return
+        else:
+            sent[uid] = v
+        if self._changed is not None:
+            self._changed["sent"][uid] = v
+
+    def _next_due(self, uid, now, every):
+        last = self.state["sent"].get(uid)
+        return max(now, last[0] + every * 3600) if last else now
+
+    def _save(self, full):
+        # the whole state when it was rebuilt, the log has grown or can't be
+        # appended to; else one log line
+        json_size = self._seen[0][1] if self._seen[0] else 0
+        if full or not self._clean or self._stale or self._seen[1] > max(COMPACT_BYTES, json_size):
+            self.state["gen"] = uuid.uuid4().hex
+            write_json_file(self.state_path, self.state, indent=None)
+            header = (json.dumps({"gen": self.state["gen"]}) + "\n").encode("utf-8")
+            write_file_atomic(self.log_path, header)
+            self._seen, self._clean, self._stale = (self._sig(), len(header)), True, False
+            return
+        line = (json.dumps(dict(self._changed, offset=self.state["offset"]), ensure_ascii=False) + "\n").encode("utf-8")
+        with open(self.log_path, "ab") as f:
+            f.write(line)
+        io(written=len(line))
+        self._seen = (self._seen[0], self._seen[1] + len(line))
+
+    # ---- run ----
+    @timed("reminders.run", records=lambda r, *a, **k: r["checked"])
+    def run(self, outbox, now=None, every=REMIND_EVERY_H, quiet=QUIET_HOURS, batch=BATCH, dry_run=False):
+        """One pass: catch up with the changes, then send what is due.
+
+        Returns {"checked", "sent", "due", "scheduled", "full", "quiet",
+        "messages"}: members looked at, messages sent, members due now and
+        left over, members with a reminder scheduled, whether the roster
+        was scanned and whether it is quiet hours. dry_run sends and
+        records nothing.
+        """
+        now = now or datetime.datetime.now()
+        ts = now.timestamp()
+        with self.lock.exclusive():
+            self._load()
+            state = self.state
+            events, offset = self.payments.read_from(state["offset"]) if state else (None, 0)
+            full = events is None or any(e.get("event") in FULL_SCAN_EVENTS for e in events)
+            if events is None:
+                try:
+                    # changes logged after this are read next time; the roster below already has them
+                    offset = os.path.getsize(self.payments.path)
+                except OSError:
+                    offset = 0
+            self._changed = {"due": {}, "sent": {}}
+            try:
+                with self.store.lock:
+                    data = self.store.load()
+                    index = self.store.index
+                    if full:
+                        checked = len(data["users"])
+                        sent = state["sent"] if state else {}
+                        self.state = {"offset": offset, "due": {}, "sent": {uid: v for uid, v in sent.items()
+                                                                         if index.get(uid) is not None}}
+                        self.state["due"] = {u["id"]: self._next_due(u["id"], ts, every)
+                                             for u in data["users"] if needs_reminder(u)}
+                        self.queue = sorted((t, uid) for uid, t in self.state["due"].items())
+                    else:
+                        state["offset"] = offset
+                        uids = {e["uid"] for e in events if e.get("uid")}
+                        checked = len(uids)
+                        for uid in uids:
+                            u = index.get(uid)
+                            if u is not None and needs_reminder(u):
+                                if uid not in state["due"]:
+                                    self._set_due(uid, self._next_due(uid, ts, every))
+                            else:
+                                self._set_due(uid, None)
+                                if u is None:
+                                    self._set_sent(uid, None)
+                    ready = bisect.bisect_right(self.queue, (ts, _LAST))
+                    quiet_now = in_quiet_hours(now, quiet)
+                    messages, gone = [], []
+                    if not quiet_now:
+                        stamp = now.isoformat(sep=" ", timespec="seconds")
+                        for _, uid in self.queue[:ready]:
+                            if len(messages) >= batch:
+                                break
+                            u = index.get(uid)
+                            if u is None or not needs_reminder(u):
+                                # deleted or paid after the log was read: its
+                                # event is picked up next run, skip it now
+                                gone.append((uid, u is None))
+                                continue
+                            count = self.state["sent"].get(uid, (0, 0))[1] + 1
+                            messages.append({"time": stamp, "ledger": self.ledger_name, "uid": uid, "name": u["name"],
+                                             "debt": u["debt"], "count": count,
+                                             "text": TEXT.format(name=u["name"], debt=u["debt"], ledger=self.ledger_name)})
+                result = {"checked": checked, "sent": len(messages), "due": ready - len(messages) - len(gone),
+                          "scheduled": len(self.state["due"]) - len(gone), "full": full, "quiet": quiet_now, "messages": messages}
+                if dry_run:
+                    self.state = None  # undo the catch-up above: reread from disk next time
+                    return result
+                if messages:
+                    outbox.send(messages)
+                for uid, deleted in gone:
+                    self._set_due(uid, None)
+                    if deleted:
+                        self._set_sent(uid, None)
+                # with those gone they were the head of the queue: drop it in
+                # one go, not one memmove each
+                for _, uid in self.queue[:len(messages)]:
+                    del self.state["due"][uid]
+                del self.queue[:len(messages)]
+                for m in messages:
+                    self._set_sent(m["uid"], [ts, m["count"]])
+                    self._set_due(m["uid"], ts + every * 3600)
+                self._save(full)
+                return result
+            except BaseException:
+                self.state = None  # whatever was applied in memory is not on disk
+                raise
+            finally:
+                self._changed = None
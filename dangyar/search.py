@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Persian-aware name search.
+#
+# Names are normalized (Arabic yeh/kaf -> Persian, ZWNJ and diacritics
+# dropped, digits folded) and indexed by character bigrams so a query only
+# looks at names sharing all of its bigrams.
+#
+# Matches come back as a Matches object, ranked only as far as they are
+# read: a page near the top costs a bounded heap over the candidates, not a
+# sort of all of them, so a one-letter query on a big roster stays cheap.
+import heapq, re, unicodedata
+
+_CHAR_MAP = str.maketrans({
+    "ي": "ی",  # ARABIC YEH -> FARSI YEH
+    "ى": "ی",  # ALEF MAKSURA
+    "ك": "ک",  # ARABIC KAF -> KEHEH
+    "ة": "ه",  # TEH MARBUTA -> HEH
+    "ۀ": "ه",  # HEH WITH YEH ABOVE
+    "أ": "ا",  # ALEF WITH HAMZA ABOVE
+    "إ": "ا",  # ALEF WITH HAMZA BELOW
+    "آ": "ا",  # ALEF WITH MADDA
+    "ٱ": "ا",  # ALEF WASLA
+    "ؤ": "و",  # WAW WITH HAMZA
+    "ئ": "ی",  # YEH WITH HAMZA
+    "\u200c": None,  # ZWNJ
+    "\u200d": None,  # ZWJ
+    "\u200f": None,  # RLM
+    "\u200e": None,  # LRM
+    "\u0640": None,  # TATWEEL
+    **{chr(0x06F0 + i): str(i) for i in range(10)},  # Persian digits
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # Arabic-Indic digits
+})
+_DIACRITICS = re.compile("[\u064b-\u065f\u0670\u06d6-\u06ed]")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_name(s):
+    s = unicodedata.normalize("NFKC", s or "")
+    s = _DIACRITICS.sub("", s.translate(_CHAR_MAP))
+    return _SPACES.sub(" ", s).strip().casefold()
+
+
+def _bigrams(s):
+    return {s[i:i + 2] for i in range(len(s) - 1)}
+
+
+def _rank(q, name):
+    # lower is better: exact, whole-name prefix, word prefix, substring
+    if name == q:
+        return 0
+    if name.startswith(q):
+        return 1
+    if (" " + q) in name:
+        return 2
+    return 3
+
+
+class Matches:
+    """The users matching one query, best first, read a page at a time.
+
+    The first page is picked with a top-k heap; only paging on sorts the
+    rest. Users deleted after the search are skipped; the ranking is the
+    one at search time.
+    """
+
+    def __init__(self, index, q, keys):
+        self.index = index
+        self.query = q
+        self._keys = keys
+        self._ranked = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _rank_to(self, n):
+        total = len(self._keys)
+        if n <= len(self._ranked) or len(self._ranked) == total:
+            return
+        q, names, order = self.query, self.index._names, self.index._order
+        scored = ((_rank(q, names[k]), len(names[k]), order[k], k) for k in self._keys)
+        if not self._ranked and 4 * n < total:
+            self._ranked = heapq.nsmallest(n, scored)
+        else:
+            # reading on past the first page (or most of the matches): sort once
+            self._ranked = sorted(scored)
+
+    def pages(self, size):
+        return max(1, -(-len(self._keys) // size))
+
+    def page(self, i, size):
+        self._rank_to((i + 1) * size)
+        users = self.index._users
+        return [users[k] for _, _, _, k in self._ranked[i * size:(i + 1) * size] if k in users]
+
+    def __iter__(self):
+        i, step = 0, 16
+        while i < len(self._keys):
+            self._rank_to(i + step)
+            users = self.index._users
+            for _, _, _, k in self._ranked[i:i + step]:
+                if k in users:
+                    yield users[k]
+            i += step
+
+
+class NameIndex:
+    """Bigram index over normalized user names.
+
+    Entries are keyed by user id, so the index can be kept in step with the
+    store one change at a time: CachedStore calls rebuild() after a full
+    load and observe() before applying each change. rebuild() only notes the
+    data; the bigrams are built on the first search, so opening a big roster
+    does not wait for them.
+    """
+
+    def __init__(self):
+        self.data = None
+        self._users = {}   # key -> user dict
+        self._names = {}   # key -> normalized name
+        self._order = {}   # key -> insertion counter, keeps roster order on ties
+        self._grams = {}   # bigram -> set of keys
+        self._counter = 0
+        self._stale = False
+
+    def __len__(self):
+        self._build()
+        return len(self._users)
+
+    def rebuild(self, data):
+        self.data = data
+        self._users, self._names, self._order, self._grams = {}, {}, {}, {}
+        self._counter = 0
+        self._stale = True
+
+    def _build(self):
+        if not self._stale:
+            return
+        self._stale = False
+        for u in self.data["users"]:
+            if u.get("id"):
+                self.add(u)
+
+    def add(self, u):
+        self.remove(u)
+        self._index_as(u, u.get("name", ""))
+
+    def remove(self, u):
+        key = u.get("id")
+        if key not in self._users:
+            return
+        for g in _bigrams(self._names[key]):
+            keys = self._grams.get(g)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._grams[g]
+        del self._users[key], self._names[key], self._order[key]
+
+    def observe(self, change, data, user):
+        # called with the change *before* it is applied to data
+        if data is not self.data or self._stale:
+            return  # not built yet: _build() will see the change in data
+        op = change["op"]
+        if op == "add":
+            self.add(change["user"])
+        elif op == "update":
+            if "name" in change["fields"]:
+                order = self._order.get(user["id"])
+                self.remove(user)
+                self._index_as(user, change["fields"]["name"], order)
+        elif op == "delete":
+            self.remove(user)
+        elif op == "clear":
+            self._users, self._names, self._order, self._grams = {}, {}, {}, {}
+            self._counter = 0
+
+    def _index_as(self, u, raw_name, order=None):
+        key = u["id"]
+        name = normalize_name(raw_name)
+        self._users[key] = u
+        self._names[key] = name
+        if order is None:
+            order = self._counter
+            self._counter += 1
+        self._order[key] = order
+        for g in _bigrams(name):
+            self._grams.setdefault(g, set()).add(key)
+
+    def _candidates(self, q):
+        if len(q) < 2:
+            return [k for k, name in self._names.items() if q in name]
+        postings = []
+        for g in _bigrams(q):
+            keys = self._grams.get(g)
+            if not keys:
+                return []
+            postings.append(keys)
+        postings.sort(key=len)
+        keys = set(postings[0])
+        for p in postings[1:]:
+            keys &= p
+            if not keys:
+                return []
+        names = self._names
+        return [k for k in keys if q in names[k]]
+
+    def matches(self, query):
+        q = normalize_name(query)
+        if not q:
+            return Matches(self, q, [])
+        self._build()
+        return Matches(self, q, self._candidates(q))
+
+    def search(self, query, limit=None):
+        m = self.matches(query)
+        return m.page(0, len(m) if limit is None else limit)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Expense splitting ("dong"): shared expenses -> net balances -> transfers.
+#
+# An expense is stored in data["expenses"] as
+#   {"id", "title", "payer": uid, "amount": toman (int), "split": "equal", "with": [uid, ...]}
+#   {"id", "title", "payer": uid, "amount": ..., "split": "weight" | "exact", "shares": {uid: n}}
+# Shares are whole toman: equal and weighted splits hand the remainder out
+# one toman at a time, so an expense's shares always add up to its amount
+# and the balances of a ledger always sum to zero.
+#
+# Balances is a store observer: it sums every expense once, when first
+# asked after a full load, and afterwards only applies the difference each
+# added, edited or deleted expense makes. settle() turns balances into at most n-1
+# transfers by repeatedly matching the largest creditor with the largest
+# debtor (two heaps).
+import datetime, heapq
+
+from dangyar.money import to_toman
+
+SPLITS = ("equal", "weight", "exact")
+SPLIT_TEXT = {"equal": "مساوی", "weight": "وزنی", "exact": "مبلغ دقیق"}
+
+
+def members_of(e):
+    """uids an expense names: its payer and everyone sharing it."""
+    return {e["payer"], *(e["with"] if e.get("split", "equal") == "equal" else e["shares"])}
+
+
+def shares_of(e):
+    """uid -> share in toman for one expense."""
+    amount = int(e["amount"])
+    split = e.get("split", "equal")
+    if split == "equal":
+        ids = e["with"]
+        base, extra = divmod(amount, len(ids))
+        return {uid: base + (i < extra) for i, uid in enumerate(ids)}
+    shares = e["shares"]
+    if split == "exact":
+        return {uid: int(v) for uid, v in shares.items()}
+    total = sum(shares.values())
+    out, fracs, given = {}, [], 0
+    for i, (uid, w) in enumerate(shares.items()):
+        q, r = divmod(amount * w, total)
+        out[uid] = int(q)
+        given += int(q)
+        fracs.append((-r, i, uid))
+    # largest remainders get the leftover toman
+    for _, _, uid in sorted(fracs)[:amount - given]:
+        out[uid] += 1
+    return out
+
+
+def add_expense_to(net, e, sign=1):
+    # net[uid] += sign * (paid - share)
+    get = net.get
+    payer = e["payer"]
+    amount = int(e["amount"])
+    net[payer] = get(payer, 0) + sign * amount
+    if e.get("split", "equal") == "equal":
+        # the common case, without building a shares dict
+        ids = e["with"]
+        base, extra = divmod(amount, len(ids))
+        base *= sign
+        for uid in ids:
+            net[uid] = get(uid, 0) - base
+        for uid in ids[:extra]:
+            net[uid] -= sign
+        return
+    for uid, share in shares_of(e).items():
+        net[uid] = get(uid, 0) - sign * share
+
+
+def compute_balances(expenses):
+    # one pass; kept separate from Balances so tools can use it on any list
+    net = {}
+    for e in expenses:
+        add_expense_to(net, e)
+    return {uid: v for uid, v in net.items() if v}
+
+
+def settle(net):
+    """Minimal-ish transfers [(from uid, to uid, amount)] that zero net."""
+    creditors = [(-v, uid) for uid, v in net.items() if v > 0]
+    debtors = [(v, uid) for uid, v in net.items() if v < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    out = []
+    while creditors and debtors:
+        c, cu = heapq.heappop(creditors)
+        d, du = heapq.heappop(debtors)
+        c, d = -c, -d
+        x = min(c, d)
+        out.append((du, cu, x))
+        if c > x:
+            heapq.heappush(creditors, (-(c - x), cu))
+        if d > x:
+            heapq.heappush(debtors, (-(d - x), du))
+    return out
+
+
+def make_expense(title, payer, amount, split="equal", participants=None, shares=None):
+    """Validated expense dict; ValueError carries the message to show.
+
+    participants is a list of uids for equal splits; shares maps uid ->
+    weight or toman for weighted and exact splits.
+    """
+    if split not in SPLITS:
+        raise ValueError("نوع تقسیم نامعتبر است.")
+    if not payer:
+        raise ValueError("پرداخت‌کننده مشخص نیست.")
+    try:
+        amount = to_toman(amount)
+        if amount <= 0:
+            raise ValueError
+    except ValueError:
+        raise ValueError("مبلغ هزینه نامعتبر است (عدد صحیح تومان).") from None
+    e = {"title": (title or "").strip(), "payer": payer, "amount": amount, "split": split,
+         "time": datetime.datetime.now().isoformat(sep=" ", timespec="seconds")}
+    if split == "equal":
+        ids = list(dict.fromkeys(participants or ()))
+        if not ids:
+            raise ValueError("حداقل یک نفر باید در هزینه شریک باشد.")
+        e["with"] = ids
+    else:
+        # exact shares are toman; weights may be fractional
+        num = to_toman if split == "exact" else float
+        try:
+            clean = {uid: num(v) for uid, v in (shares or {}).items()}
+        except (TypeError, ValueError):
+            raise ValueError("سهم‌ها باید عدد باشند." if split == "weight" else "سهم‌ها باید عدد صحیح (تومان) باشند.") from None
+        clean = {uid: int(v) if v == int(v) else v for uid, v in clean.items() if v}
+        if not clean or any(v < 0 for v in clean.values()):
+            raise ValueError("سهم‌ها نامعتبر است.")
+        if split == "exact" and sum(clean.values()) != e["amount"]:
+            raise ValueError(f"جمع سهم‌ها باید دقیقاً {e['amount']:,} تومان باشد.")
+        e["shares"] = clean
+    return e
+
+
+class Balances:
+    """Store observer keeping uid -> net balance (toman) of one ledger.
+
+    Positive: the member paid more than their share and should receive;
+    negative: they owe.
+    """
+
+    def __init__(self):
+        self.data = None
+        self._net = {}
+
+    def rebuild(self, data):
+        self.data = data
+        self._net = None  # summed on first use
+
+    @property
+    def net(self):
+        if self._net is None:
+            self._net = compute_balances(self.data.get("expenses", ()))
+        return self._net
+
+    def observe(self, change, data, old):
+        # old is the expense being edited/deleted (see CachedStore._apply)
+        if data is not self.data or self._net is None:
+            return
+        op = change["op"]
+        if op == "expense_add":
+            add_expense_to(self.net, change["expense"])
+        elif op == "expense_update":
+            add_expense_to(self.net, old, -1)
+            add_expense_to(self.net, dict(old, **change["fields"]))
+        elif op == "expense_delete":
+            add_expense_to(self.net, old, -1)
+        elif op == "clear":
+            self._net = {}
+
+    def balance(self, uid):
+        return self.net.get(uid, 0)
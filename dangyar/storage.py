@@ -0,0 +1,907 @@
+# -*- coding: utf-8 -*-
+# Storage backends behind load_data()/save_data().
+#
+#   json     - the original single data.json, rewritten on every change
+#   journal  - columnar snapshot (dangyar/snapshot.py) + append-only change
+#              journal, compacted periodically
+#   sqlite   - one row per user in a SQLite database
+#
+# CachedStore wraps any of them and keeps the parsed data in memory until
+# the backing files are changed by somebody else.
+#
+# Every backend exposes the same small mutation API (add_user, update_user,
+# delete_user, set_password, clear_users) so callers describe *what* changed
+# instead of handing over the whole data dict to be re-serialized. Bulk work
+# (add_users, modify_users) goes in as one "batch" change: one journal line,
+# one fsync, one SQLite transaction.
+#
+# Ledgers may also hold shared expenses (data["expenses"], see
+# dangyar/splitting.py), changed with the expense_add/_update/_delete ops.
+#
+# Several processes (a manager station and kiosks) may share one data
+# directory: writes hold an exclusive advisory lock, reads a shared one,
+# files are replaced atomically, and every update bumps the record's "rev"
+# so modify_user() can do compare-and-swap with retry.
+import json, os, random, sqlite3, threading, time, uuid
+
+from dangyar.locking import FileLock
+from dangyar.metrics import io, timed
+from dangyar.snapshot import read_snapshot, read_top, encode as encode_snapshot
+from dangyar.splitting import members_of
+
+BACKENDS = ("json", "journal", "sqlite")
+DEFAULT_BACKEND = "journal"
+
+# journal entries replayed before the snapshot is rewritten
+JOURNAL_COMPACT_EVERY = 500
+# how often modify_user() re-reads and retries after a conflicting write
+CAS_RETRIES = 20
+
+
+class ConflictError(Exception):
+    """The record changed since it was read (compare-and-swap failed)."""
+
+
+class InUseError(Exception):
+    """The member pays for or shares in expenses (.expenses), so deleting
+    them would leave those expenses pointing at nobody."""
+
+    def __init__(self, uid, expenses):
+        super().__init__(f"user {uid} is in {len(expenses)} expenses")
+        self.expenses = expenses
+
+
+def read_json_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        io(read=os.fstat(f.fileno()).st_size)
+        return json.load(f)
+
+
+def _fsync_dir(path):
+    if os.name == "nt":
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file_atomic(path, payload):
+    # write to a private temp file, fsync, then rename over the target:
+    # readers see either the old or the new file, never a truncated one
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    io(written=len(payload))
+    try:
+        with open(tmp, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    _fsync_dir(path)
+
+
+def write_json_file(path, data, indent=2):
+    write_file_atomic(path, json.dumps(data, ensure_ascii=False, indent=indent).encode("utf-8"))
+
+
+def _stat_sig(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def new_user_id():
+    return uuid.uuid4().hex
+
+
+def assign_ids(data):
+    # give every user a persistent id; returns how many were missing one
+    n = 0
+    for u in data["users"]:
+        if not u.get("id"):
+            u["id"] = new_user_id()
+            n += 1
+    return n
+
+
+class UserIndex:
+    """id -> user dict (and lazily id -> list position) for one data dict,
+    plus id -> expense dict for its expenses."""
+
+    def __init__(self, data=None):
+        self.data = None
+        self._by_id = {}
+        self._pos = None
+        self._expenses = {}
+        if data is not None:
+            self.rebuild(data)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def rebuild(self, data):
+        self.data = data
+        # records without an id (not migrated yet) are not indexed
+        self._by_id = {u["id"]: u for u in data["users"] if u.get("id")}
+        self._pos = None
+        self._expenses = {e["id"]: e for e in data.get("expenses", ())}
+
+    def get(self, uid):
+        return self._by_id.get(uid)
+
+    def position(self, uid):
+        if self._pos is None:
+            self._pos = {u.get("id"): i for i, u in enumerate(self.data["users"])}
+        return self._pos[uid]
+
+    def added(self, u):
+        self._by_id[u["id"]] = u
+        if self._pos is not None:
+            self._pos[u["id"]] = len(self.data["users"]) - 1
+
+    def removed(self, uid):
+        self._by_id.pop(uid, None)
+        # positions after the removed row shifted; recompute on demand
+        self._pos = None
+
+    def expense(self, eid):
+        return self._expenses.get(eid)
+
+    def expense_added(self, e):
+        self._expenses[e["id"]] = e
+
+    def expense_removed(self, eid):
+        self._expenses.pop(eid, None)
+
+    def expenses_of(self, uid):
+        return [e for e in self._expenses.values() if uid in members_of(e)]
+
+
+def _find(users, uid, index):
+    if index is not None:
+        pos = index.position(uid)
+    else:
+        pos = next((i for i, u in enumerate(users) if u.get("id") == uid), None)
+        if pos is None:
+            raise KeyError(uid)
+    return pos
+
+
+def check_rev(change, current):
+    # compare-and-swap: refuse an update made against an older record version
+    expect = change.get("expect_rev")
+    if expect is None:
+        return change
+    if current is None:
+        raise KeyError(change["id"])
+    if current.get("rev", 0) != expect:
+        raise ConflictError(f"user {change['id']} is at rev {current.get('rev', 0)}, expected {expect}")
+    change = dict(change)
+    del change["expect_rev"]
+    return change
+
+
+def apply_change(data, change, index=None):
+    # change is one journal entry; also used by the json backend and the cache.
+    # index (a UserIndex over data) turns id lookups into dict hits.
+    op = change["op"]
+    users = data["users"]
+    if op == "add":
+        users.append(change["user"])
+        if index is not None:
+            index.added(change["user"])
+    elif op == "update":
+        if "idx" in change:  # journals written before user ids existed
+            u = users[change["idx"]]
+        elif index is not None:
+            u = index.get(change["id"])
+            if u is None:
+                raise KeyError(change["id"])
+        else:
+            u = users[_find(users, change["id"], None)]
+        u.update(change["fields"])
+        # every update bumps the record version used for compare-and-swap
+        u["rev"] = u.get("rev", 0) + 1
+    elif op == "delete":
+        pos = change["idx"] if "idx" in change else _find(users, change["id"], index)
+        u = users.pop(pos)
+        if index is not None:
+            index.removed(u.get("id"))
+    elif op == "password":
+        data["password"] = change["value"]
+    elif op == "clear":
+        users[:] = []
+        data["expenses"] = []
+        if index is not None:
+            index.rebuild(data)
+    elif op == "expense_add":
+        data.setdefault("expenses", []).append(change["expense"])
+        if index is not None:
+            index.expense_added(change["expense"])
+    elif op == "expense_update":
+        e = index.expense(change["eid"]) if index is not None else _find_expense(data, change["eid"])
+        if e is None:
+            raise KeyError(change["eid"])
+        e.update(change["fields"])
+    elif op == "expense_delete":
+        expenses = data.get("expenses", [])
+        pos = next((i for i, e in enumerate(expenses) if e["id"] == change["eid"]), None)
+        if pos is None:
+            raise KeyError(change["eid"])
+        expenses.pop(pos)
+        if index is not None:
+            index.expense_removed(change["eid"])
+    elif op == "batch":
+        for c in change["changes"]:
+            apply_change(data, c, index)
+    else:
+        raise ValueError(f"unknown journal op: {op!r}")
+    return data
+
+
+def _find_expense(data, eid):
+    return next((e for e in data.get("expenses", ()) if e["id"] == eid), None)
+
+
+def change_weight(change):
+    # how many records a journal entry touches, for the write timings
+    return len(change["changes"]) if change["op"] == "batch" else 1
+
+
+class BaseStore:
+    name = "base"
+    lock = None  # FileLock, set by each backend
+
+    def exists(self):
+        raise NotImplementedError
+
+    def load(self):
+        raise NotImplementedError
+
+    def save(self, data):
+        raise NotImplementedError
+
+    def signature(self):
+        # changes whenever the stored data may have changed on disk
+        raise NotImplementedError
+
+    def read_new(self):
+        # changes written since our last load/read/write, or None when only
+        # a full load() can tell
+        return None
+
+    def _change(self, change):
+        raise NotImplementedError
+
+    def write_lock(self):
+        return self.lock.exclusive()
+
+    def read_lock(self):
+        return self.lock.shared()
+
+    def get_user(self, uid):
+        return next((u for u in self.load()["users"] if u.get("id") == uid), None)
+
+    def _users_by_id(self):
+        # something with .get(uid) over the current data, for bulk lookups
+        return {u.get("id"): u for u in self.load()["users"]}
+
+    # ---- mutations ----
+    def add_user(self, user):
+        if not user.get("id"):
+            user["id"] = new_user_id()
+        self._change({"op": "add", "user": user})
+        return user["id"]
+
+    def update_user(self, uid, fields, expect_rev=None):
+        change = {"op": "update", "id": uid, "fields": fields}
+        if expect_rev is not None:
+            change["expect_rev"] = expect_rev
+        self._change(change)
+
+    def modify_user(self, uid, fn, retries=CAS_RETRIES):
+        """Read-modify-write one user with compare-and-swap.
+
+        fn gets a copy of the current record and returns the fields to
+        change, or None to leave it alone. If another writer changed the
+        record in between, fn is run again on the new version. Returns the
+        fields written (None if fn declined).
+        """
+        for attempt in range(retries):
+            u = self.get_user(uid)
+            if u is None:
+                raise KeyError(uid)
+            rev = u.get("rev", 0)
+            fields = fn(dict(u))
+            if not fields:
+                return None
+            try:
+                self.update_user(uid, fields, expect_rev=rev)
+                return fields
+            except ConflictError:
+                time.sleep(random.uniform(0, 0.005) * (attempt + 1))
+        raise ConflictError(f"user {uid} kept changing; gave up after {retries} tries")
+
+    def add_users(self, users):
+        """Add many users as one write; returns their ids."""
+        for u in users:
+            if not u.get("id"):
+                u["id"] = new_user_id()
+        if users:
+            self._change({"op": "batch", "changes": [{"op": "add", "user": u} for u in users]})
+        return [u["id"] for u in users]
+
+    def modify_users(self, uids, fn):
+        """modify_user() for many users, written as one batch.
+
+        The whole read-modify-write runs under the write lock, so there is
+        nothing to compare-and-swap against. Unknown ids are skipped.
+        Returns {uid: fields} for the users fn changed.
+        """
+        with self.write_lock():
+            users = self._users_by_id()
+            changed, batch = {}, []
+            for uid in uids:
+                u = users.get(uid)
+                if u is None or uid in changed:
+                    continue
+                fields = fn(dict(u))
+                if fields:
+                    changed[uid] = fields
+                    batch.append({"op": "update", "id": uid, "fields": fields})
+            if batch:
+                self._change({"op": "batch", "changes": batch})
+            return changed
+
+    def delete_user(self, uid):
+        self._change({"op": "delete", "id": uid})
+
+    # ---- expenses ----
+    def add_expenses(self, expenses):
+        for e in expenses:
+            if not e.get("id"):
+                e["id"] = new_user_id()
+        if len(expenses) == 1:
+            self._change({"op": "expense_add", "expense": expenses[0]})
+        elif expenses:
+            self._change({"op": "batch", "changes": [{"op": "expense_add", "expense": e} for e in expenses]})
+        return [e["id"] for e in expenses]
+
+    def update_expense(self, eid, fields):
+        self._change({"op": "expense_update", "eid": eid, "fields": fields})
+
+    def delete_expense(self, eid):
+        self._change({"op": "expense_delete", "eid": eid})
+
+    def set_password(self, value):
+        self._change({"op": "password", "value": value})
+
+    def clear_users(self):
+        self._change({"op": "clear"})
+
+
+class JsonStore(BaseStore):
+    name = "json"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = FileLock(path + ".lock")
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        with self.read_lock():
+            return read_json_file(self.path)
+
+    def save(self, data):
+        with self.write_lock():
+            write_json_file(self.path, data)
+
+    def signature(self):
+        return _stat_sig(self.path)
+
+    def _change(self, change):
+        with self.write_lock():
+            data = self.load()
+            if change["op"] == "update":
+                change = check_rev(change, next((u for u in data["users"] if u.get("id") == change["id"]), None))
+            self.save(apply_change(data, change))
+
+
+class JournalStore(BaseStore):
+    """Snapshot file plus an append-only journal of changes.
+
+    A change costs one appended (and fsynced) line; the snapshot is
+    rewritten only when the journal grows past ``compact_every`` entries.
+    The snapshot is binary and columnar; a JSON snapshot left by older
+    versions (legacy_path) is read until the first compaction replaces it.
+
+    The snapshot records a generation number and the journal starts with a
+    {"gen": n} header. Compaction writes the new snapshot first and then a
+    fresh journal, so a journal whose generation does not match the
+    snapshot was already folded in and is ignored - a crash between the two
+    renames cannot replay entries twice. Such a journal is reset to the
+    snapshot's generation under the write lock before anything is appended,
+    so writes made after the crash are not ignored along with it.
+    """
+    name = "journal"
+
+    def __init__(self, snapshot_path, journal_path, compact_every=JOURNAL_COMPACT_EVERY, durable=True, legacy_path=None):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.legacy_path = legacy_path
+        self.compact_every = compact_every
+        self.durable = durable
+        # the lock keeps the name older versions used, so they still exclude each other
+        self.lock = FileLock((legacy_path or snapshot_path) + ".lock")
+        self._journal_len = None
+        self._pos = None  # (generation, journal byte offset) we have read up to
+        self._snap_gen = None  # (snapshot file signature, its journal_gen)
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path) or bool(self.legacy_path and os.path.exists(self.legacy_path))
+
+    def _read_snapshot(self):
+        try:
+            return read_snapshot(self.snapshot_path)
+        except FileNotFoundError:
+            if not self.legacy_path:
+                raise
+            return read_json_file(self.legacy_path)
+
+    @staticmethod
+    def _parse(chunk):
+        # complete lines of chunk -> (entries, header generation or None, bytes used)
+        end = chunk.rfind(b"\n") + 1
+        entries, gen = [], None
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if "op" not in entry and "gen" in entry:
+                gen = entry["gen"]
+            else:
+                entries.append(entry)
+        return entries, gen, end
+
+    def _snapshot_gen(self):
+        # the generation the snapshot expects its journal to have; the
+        # binary snapshot's header is enough, a legacy JSON one is read once
+        path = self.snapshot_path
+        if self.legacy_path and not os.path.exists(path):
+            path = self.legacy_path
+        sig = (path, _stat_sig(path))
+        if self._snap_gen is None or self._snap_gen[0] != sig:
+            if sig[1] is None:
+                gen = 0
+            elif path == self.snapshot_path:
+                gen = read_top(path).get("journal_gen", 0)
+            else:
+                gen = read_json_file(path).get("journal_gen", 0)
+            self._snap_gen = (sig, gen)
+        return self._snap_gen[1]
+
+    def _journal_gen(self):
+        try:
+            with open(self.journal_path, "rb") as f:
+                first = f.readline()
+        except FileNotFoundError:
+            return None
+        if not first.endswith(b"\n"):
+            return None
+        try:
+            entry = json.loads(first)
+        except ValueError:
+            return None
+        return entry.get("gen", 0) if "op" not in entry else 0
+
+    def load(self):
+        with self.read_lock():
+            data = self._read_snapshot()
+            gen = data.pop("journal_gen", 0)
+            try:
+                with open(self.journal_path, "rb") as f:
+                    chunk = f.read()
+            except FileNotFoundError:
+                chunk = b""
+            io(read=len(chunk))
+            entries, jgen, used = self._parse(chunk)
+            if (jgen or 0) != gen:
+                entries = []  # stale journal, already in the snapshot
+            index = UserIndex(data) if all(u.get("id") for u in data["users"]) else None
+            for change in entries:
+                apply_change(data, change, index)
+            self._journal_len = len(entries)
+            self._pos = (gen, used)
+            return data
+
+    def read_new(self):
+        if self._pos is None:
+            return None
+        gen, offset = self._pos
+        with self.read_lock():
+            if (self._journal_gen() or 0) != gen:
+                return None  # compacted or replaced since
+            with open(self.journal_path, "rb") as f:
+                f.seek(offset)
+                chunk = f.read()
+            io(read=len(chunk))
+            entries, _, used = self._parse(chunk)
+            self._pos = (gen, offset + used)
+            self._journal_len = (self._journal_len or 0) + len(entries)
+            return entries
+
+    def _write_journal_header(self, gen):
+        write_file_atomic(self.journal_path, (json.dumps({"gen": gen}) + "\n").encode("utf-8"))
+
+    def save(self, data):
+        with self.write_lock():
+            gen = (self._journal_gen() or 0) + 1
+            write_file_atomic(self.snapshot_path, encode_snapshot(dict(data, journal_gen=gen)))
+            self._write_journal_header(gen)
+            if self.legacy_path and os.path.exists(self.legacy_path):
+                os.remove(self.legacy_path)  # replaced by the snapshot above
+            self._journal_len = 0
+            self._pos = (gen, os.path.getsize(self.journal_path))
+
+    def signature(self):
+        return (_stat_sig(self.snapshot_path), _stat_sig(self.journal_path))
+
+    def compact(self):
+        with self.write_lock():
+            self.save(self.load())
+
+    def _repair_tail(self, f):
+        # drop a half-written last line left by a crash so the next entry
+        # starts on a line of its own
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return 0
+        f.seek(max(0, size - 65536))
+        chunk = f.read()
+        if chunk.endswith(b"\n"):
+            return size
+        keep = size - len(chunk) + chunk.rfind(b"\n") + 1
+        f.truncate(keep)
+        return keep
+
+    def _change(self, change):
+        with self.write_lock():
+            gen = self._snapshot_gen()
+            if self._journal_gen() != gen:
+                # missing, or left behind by a compaction that crashed before
+                # writing its journal header: its entries are in the snapshot
+                # already, and load() would ignore whatever we append to it
+                self._write_journal_header(gen)
+                self._journal_len = 0
+                self._pos = None
+            if change.get("expect_rev") is not None:
+                # without a cache in front this costs a full read
+                change = check_rev(change, self.get_user(change["id"]))
+            if self._journal_len is None:
+                self.load()
+            line = (json.dumps(change, ensure_ascii=False) + "\n").encode("utf-8")
+            with open(self.journal_path, "r+b") as f:
+                size = self._repair_tail(f)
+                if size == 0:
+                    header = (json.dumps({"gen": 0}) + "\n").encode("utf-8")
+                    f.write(header)
+                    size = len(header)
+                f.seek(size)
+                f.write(line)
+                io(written=len(line))
+                f.flush()
+                if self.durable:
+                    os.fsync(f.fileno())
+            if self._pos is not None and self._pos[1] == size:
+                self._pos = (self._pos[0], size + len(line))
+            else:
+                self._pos = None  # others wrote since we last read
+            # a batch is one entry: an import of many batches must not
+            # rewrite the whole snapshot after each one
+            self._journal_len += 1
+            if self._journal_len >= self.compact_every:
+                self.compact()
+
+
+class SqliteStore(BaseStore):
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = FileLock(path + ".lock")
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            # CachedStore serializes access, so the connection may move between threads
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, uid TEXT, doc TEXT NOT NULL)")
+            cols = [r[1] for r in self._conn.execute("PRAGMA table_info(users)")]
+            if "uid" not in cols:
+                self._conn.execute("ALTER TABLE users ADD COLUMN uid TEXT")
+            self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_uid ON users (uid)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS expenses (id INTEGER PRIMARY KEY AUTOINCREMENT, eid TEXT UNIQUE, doc TEXT NOT NULL)")
+            self._conn.commit()
+        return self._conn
+
+    def exists(self):
+        if not os.path.exists(self.path):
+            return False
+        row = self._db().execute("SELECT value FROM meta WHERE key='password'").fetchone()
+        return row is not None
+
+    def load(self):
+        db = self._db()
+        with db:  # one read transaction, so password and users match
+            row = db.execute("SELECT value FROM meta WHERE key='password'").fetchone()
+            users = [json.loads(doc) for (doc,) in db.execute("SELECT doc FROM users ORDER BY id")]
+            expenses = [json.loads(doc) for (doc,) in db.execute("SELECT doc FROM expenses ORDER BY id")]
+        return {"password": row[0] if row else None, "users": users, "expenses": expenses}
+
+    def save(self, data):
+        db = self._db()
+        with self.write_lock(), db:
+            db.execute("DELETE FROM users")
+            db.executemany("INSERT INTO users (uid, doc) VALUES (?, ?)",
+                           [(u.get("id"), json.dumps(u, ensure_ascii=False)) for u in data["users"]])
+            db.execute("DELETE FROM expenses")
+            db.executemany("INSERT INTO expenses (eid, doc) VALUES (?, ?)",
+                           [(e["id"], json.dumps(e, ensure_ascii=False)) for e in data.get("expenses", ())])
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('password', ?)", (data["password"],))
+
+    def signature(self):
+        # data_version only moves when another connection commits
+        if not os.path.exists(self.path):
+            return None
+        return self._db().execute("PRAGMA data_version").fetchone()[0]
+
+    def _row(self, db, uid):
+        row = db.execute("SELECT id, doc FROM users WHERE uid=?", (uid,)).fetchone()
+        if row is None:
+            raise KeyError(uid)
+        return row
+
+    def get_user(self, uid):
+        row = self._db().execute("SELECT doc FROM users WHERE uid=?", (uid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _change(self, change):
+        db = self._db()
+        with self.write_lock(), db:
+            self._apply_sql(db, change)
+
+    def _apply_sql(self, db, change):
+        op = change["op"]
+        if op == "add":
+            db.execute("INSERT INTO users (uid, doc) VALUES (?, ?)",
+                       (change["user"]["id"], json.dumps(change["user"], ensure_ascii=False)))
+        elif op == "update":
+            rid, doc = self._row(db, change["id"])
+            u = json.loads(doc)
+            check_rev(change, u)
+            u.update(change["fields"])
+            u["rev"] = u.get("rev", 0) + 1
+            db.execute("UPDATE users SET doc=? WHERE id=?", (json.dumps(u, ensure_ascii=False), rid))
+        elif op == "delete":
+            rid, _ = self._row(db, change["id"])
+            db.execute("DELETE FROM users WHERE id=?", (rid,))
+        elif op == "password":
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('password', ?)", (change["value"],))
+        elif op == "clear":
+            db.execute("DELETE FROM users")
+            db.execute("DELETE FROM expenses")
+        elif op == "expense_add":
+            db.execute("INSERT INTO expenses (eid, doc) VALUES (?, ?)",
+                       (change["expense"]["id"], json.dumps(change["expense"], ensure_ascii=False)))
+        elif op == "expense_update":
+            row = db.execute("SELECT id, doc FROM expenses WHERE eid=?", (change["eid"],)).fetchone()
+            if row is None:
+                raise KeyError(change["eid"])
+            e = json.loads(row[1])
+            e.update(change["fields"])
+            db.execute("UPDATE expenses SET doc=? WHERE id=?", (json.dumps(e, ensure_ascii=False), row[0]))
+        elif op == "expense_delete":
+            if db.execute("DELETE FROM expenses WHERE eid=?", (change["eid"],)).rowcount == 0:
+                raise KeyError(change["eid"])
+        elif op == "batch":
+            for c in change["changes"]:
+                self._apply_sql(db, c)
+        else:
+            raise ValueError(f"unknown op: {op!r}")
+
+
+class CachedStore(BaseStore):
+    """Keeps the last loaded data in memory.
+
+    load() re-reads the backend only when its signature changed, i.e. when
+    another process wrote to it, and then only the new journal entries if
+    the backend can tell (read_new). Our own changes are applied to the
+    cached copy as well, so they never force a re-read. The returned dict
+    is shared: change it through the store methods, not in place.
+
+    Users are looked up by id through a UserIndex, so get_user() and
+    single-user changes do not scan the roster. Observers (e.g. the search
+    index) get rebuild(data) after every full load and
+    observe(change, data, user) right before a change is applied, where
+    user is the record being updated/deleted. Observers that define
+    observe_local() get it as well for changes written through this store
+    (not ones read back from other processes), then committed() once the
+    whole write is in.
+
+    Writes catch up with other processes while holding the backend's write
+    lock, so compare-and-swap checks run against the current record, and
+    a member still named in an expense is not deleted (InUseError).
+    All access is serialized by ``lock``; hold it while iterating the
+    loaded data if writes may happen on another thread.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.name = store.name
+        self._data = None
+        self._sig = None
+        self.hits = 0
+        self.misses = 0
+        self.tail_reads = 0
+        self.index = UserIndex()
+        self.observers = []
+        self.lock = threading.RLock()
+
+    def exists(self):
+        return self.store.exists()
+
+    def signature(self):
+        return self.store.signature()
+
+    def write_lock(self):
+        return self.store.write_lock()
+
+    def read_lock(self):
+        return self.store.read_lock()
+
+    def invalidate(self):
+        self._data = None
+        self._sig = None
+
+    @timed("store.full_load", records=lambda r, self: len(self._data["users"]))
+    def _full_load(self):
+        self._data = self.store.load()
+        self.index.rebuild(self._data)
+        for o in self.observers:
+            o.rebuild(self._data)
+
+    def _apply(self, change, local=False):
+        if change["op"] == "batch":
+            for c in change["changes"]:
+                self._apply(c, local)
+            return
+        # observers get the record the change replaces: the user, or the
+        # expense for expense ops
+        if "id" in change:
+            user = self.index.get(change["id"])
+        elif "eid" in change:
+            user = self.index.expense(change["eid"])
+        else:
+            user = None
+        for o in self.observers:
+            o.observe(change, self._data, user)
+            if local and hasattr(o, "observe_local"):
+                o.observe_local(change, self._data, user)
+        apply_change(self._data, change, self.index)
+
+    def _refresh(self):
+        sig = self.store.signature()
+        if self._data is not None and sig == self._sig:
+            self.hits += 1
+            return
+        self.misses += 1
+        changes = self.store.read_new() if self._data is not None else None
+        if changes is None:
+            self._full_load()
+        else:
+            self.tail_reads += 1
+            try:
+                for change in changes:
+                    self._apply(change)
+            except (KeyError, IndexError):
+                self._full_load()
+        self._sig = sig
+
+    def load(self):
+        with self.lock:
+            self._refresh()
+            return self._data
+
+    @timed("store.save", records=lambda r, self, data: len(data["users"]))
+    def save(self, data):
+        with self.lock, self.store.write_lock():
+            self.store.save(data)
+            self._data = data
+            self._sig = self.store.signature()
+            self.index.rebuild(data)
+            for o in self.observers:
+                o.rebuild(data)
+
+    def get_user(self, uid):
+        with self.lock:
+            self._refresh()
+            return self.index.get(uid)
+
+    @timed("store.write", records=lambda r, self, change: change_weight(change))
+    def _change(self, change):
+        with self.lock, self.store.write_lock():
+            # nobody else can write now; catch up, check, then append
+            self._refresh()
+            change = self._check(change)
+            try:
+                self.store._change(change)
+            except BaseException:
+                self.invalidate()
+                raise
+            self._apply(change, local=True)
+            self._sig = self.store.signature()
+            for o in self.observers:
+                if hasattr(o, "committed"):
+                    o.committed()
+
+    def _check(self, change):
+        op = change["op"]
+        if op == "batch":
+            return dict(change, changes=[self._check(c) for c in change["changes"]])
+        if op in ("update", "delete") and self.index.get(change["id"]) is None:
+            raise KeyError(change["id"])
+        if op == "delete" and self.index.expenses_of(change["id"]):
+            raise InUseError(change["id"], self.index.expenses_of(change["id"]))
+        if op == "update":
+            change = check_rev(change, self.index.get(change["id"]))
+        if op in ("expense_update", "expense_delete") and self.index.expense(change["eid"]) is None:
+            raise KeyError(change["eid"])
+        return change
+
+    def _users_by_id(self):
+        self._refresh()
+        return self.index
+
+    def modify_users(self, uids, fn):
+        # take our lock before the file lock, the same order _change() uses
+        with self.lock:
+            return BaseStore.modify_users(self, uids, fn)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "tail_reads": self.tail_reads}
+
+
+def open_store(app_dir, backend=None):
+    backend = backend or os.environ.get("DANGYAR_STORAGE") or DEFAULT_BACKEND
+    if backend == "json":
+        return JsonStore(os.path.join(app_dir, "data.json"))
+    if backend == "journal":
+        return JournalStore(os.path.join(app_dir, "data.snapshot"), os.path.join(app_dir, "data.journal"),
+                            legacy_path=os.path.join(app_dir, "data.snapshot.json"))
+    if backend == "sqlite":
+        return SqliteStore(os.path.join(app_dir, "data.db"))
+    raise ValueError(f"unknown storage backend {backend!r}, expected one of {BACKENDS}")
+
+
+def import_json(store, path):
+    # bring an existing data.json into any backend
+    store.save(read_json_file(path))
+
+
+def export_json(store, path):
+    # the whole ledger as one data.json-style file, whatever the backend
+    with store.read_lock():
+        write_json_file(path, store.load())
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Background work for the GUI.
+#
+# Tk may only be touched from its own thread, so workers never call back
+# into it directly: finished futures are queued and picked up by a short
+# root.after() poll on the Tk thread, which then runs the callbacks.
+import queue, sys, traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TaskRunner:
+    """Runs slow work off the Tk main loop.
+
+    submit() runs on a small thread pool (file copies, deletes, ...);
+    submit(..., serial=True) runs on a single thread so store writes stay in
+    the order they were made. on_done(result) / on_error(exc) run on the Tk
+    thread. on_change(pending) is called whenever the number of unfinished
+    tasks changes, e.g. to show a "saving..." label.
+    """
+    POLL_MS = 50
+
+    def __init__(self, root, workers=4):
+        self.root = root
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="dangyar-io")
+        self._serial = ThreadPoolExecutor(1, thread_name_prefix="dangyar-store")
+        self._done = queue.SimpleQueue()
+        self._polling = False
+        self.pending = 0
+        self.on_change = None
+
+    def submit(self, fn, *args, on_done=None, on_error=None, serial=False):
+        ex = self._serial if serial else self._pool
+        fut = ex.submit(fn, *args)
+        self.pending += 1
+        self._notify()
+        fut.add_done_callback(lambda f: self._done.put((f, on_done, on_error)))
+        self._schedule()
+        return fut
+
+    def _schedule(self):
+        if not self._polling:
+            self._polling = True
+            self.root.after(self.POLL_MS, self._poll)
+
+    def _poll(self):
+        self._polling = False
+        while True:
+            try:
+                fut, on_done, on_error = self._done.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+            exc = fut.exception()
+            if exc is not None:
+                if on_error is not None:
+                    on_error(exc)
+                else:
+                    traceback.print_exception(type(exc), exc, exc.__traceback__, file=sys.stderr)
+            elif on_done is not None:
+                on_done(fut.result())
+        self._notify()
+        if self.pending:
+            self._schedule()
+
+    def _notify(self):
+        if self.on_change is not None:
+            self.on_change(self.pending)
+
+    def shutdown(self, wait=True):
+        # let queued store writes finish before the window goes away
+        self._serial.shutdown(wait=wait)
+        self._pool.shutdown(wait=wait)
@@ -1,64 +1,98 @@
 # -*- coding: utf-8 -*-
+import os, sys, subprocess
+
+if __name__ == "__main__" and len(sys.argv) > 1:
+    # batch commands (see dangyar/cli.py) don't need Tk at all
+    from dangyar.cli import main
+    sys.exit(main())
+
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, filedialog
-import json, os, datetime, shutil, sys, subprocess
-
-APP_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_FILE = os.path.join(APP_DIR, "data.json")
-RECEIPT_DIR = os.path.join(APP_DIR, "receipts")
-
-DEFAULT_PASSWORD = "1357"
-
-# ---------- Utilities ----------
-def ensure_storage():
-    if not os.path.exists(RECEIPT_DIR):
-        os.makedirs(RECEIPT_DIR)
-    if not os.path.exists(DATA_FILE):
-        data = {
-            "password": DEFAULT_PASSWORD,
-            "users": []  # each: {name, debt, paid, pending_cash, pending_card, receipt, payment_time, approved_by}
-        }
-        save_data(data)
-
-def load_data():
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def save_data(data):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def find_users_by_name(query, data):
-    q = query.strip().lower()
-    if not q:
-        return []
-    # flexible matching: substring case-insensitive
-    return [u for u in data["users"] if q in u["name"].lower()]
+
+from dangyar.core import (DangYarCore, STATUS_TEXT, STATUS_RANK, user_status,
+                          request_cash, attach_receipt, new_user, parse_user_fields)
+from dangyar.money import to_toman
+from dangyar.payments import EVENT_TEXT
+from dangyar.bulk import import_users, export_users
+from dangyar.metrics import METRICS, timed
+from dangyar.tasks import TaskRunner
+from dangyar.receipts import THUMB_SIZE, TK_FORMATS
+from dangyar.splitting import SPLITS, SPLIT_TEXT, make_expense
+
+# DANGYAR_HOME runs the app on another data directory (e.g. tools/bench.py)
+APP_DIR = os.environ.get("DANGYAR_HOME") or os.path.dirname(os.path.abspath(__file__))
+
+SEARCH_PAGE = 10           # matches per page in the user panel
+SEARCH_DEBOUNCE_MS = 200   # wait this long after the last key before searching
+BACKUP_EVERY_MS = 30 * 60 * 1000  # automatic backup of the open ledger (only if it changed)
+APPLY_PREVIEW = 15         # debts listed in a message box (apply to debts, rounded legacy debts)
+
+# storage, search and payment logic live in dangyar/core.py
+CORE = DangYarCore(APP_DIR)
+STORE = CORE.store
+RECEIPTS = CORE.receipts
+RECEIPT_DIR = CORE.receipt_dir
+ensure_storage = CORE.ensure_storage
+load_data = CORE.load_data
+save_data = CORE.save_data
+release_receipts = CORE.release_receipts
+# operations slower than DANGYAR_SLOW_MS go here while timing is on
+METRICS.slow_log = METRICS.slow_log or os.path.join(APP_DIR, "slow.log")
+
+# roster filter choices: label -> status (None = all)
+STATUS_FILTERS = [("همه", None), ("در انتظار تأیید", "pending"), ("پرداخت نشده", "unpaid"), ("پرداخت شده", "paid")]
 
 def open_file(path):
     if not path or not os.path.exists(path):
         messagebox.showwarning("فایل یافت نشد", "فایل رسید موجود نیست.")
         return
+    # launch the viewer and return right away; don't wait for it to exit
     try:
         if sys.platform.startswith("darwin"):
-            subprocess.call(("open", path))
+            subprocess.Popen(("open", path))
         elif os.name == "nt":
             os.startfile(path)
         else:
-            subprocess.call(("xdg-open", path))
+            subprocess.Popen(("xdg-open", path))
     except Exception as e:
         messagebox.showerror("خطا", str(e))
 
+def search_first_page(name):
+    # on a worker: the matches for name and the users on their first page
+    if not name:
+        return None, []
+    m = CORE.search_users(name)
+    return m, CORE.match_page(m, 0, SEARCH_PAGE)
+
 # ---------- GUI App ----------
 class DangYarApp(tk.Tk):
     def __init__(self):
         super().__init__()
-        self.title("سامانه دَنگ‌یار")
+        self.update_title()
         self.geometry("900x600")
         self.resizable(True, True)
 
-        ensure_storage()
-        self.data = load_data()
+        # slow work (store writes, file copies/deletes) runs in the background;
+        # busy holds ids of users with a write in flight
+        self.tasks = TaskRunner(self)
+        self.busy = set()
+        self.status_var = tk.StringVar(value="")
+        ttk.Label(self, textvariable=self.status_var, foreground="gray").pack(side="bottom", fill="x", padx=8)
+        self.tasks.on_change = self.on_tasks_change
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        # opening the data (migrations, first load of a big roster) runs on the
+        # store thread, so the window is up at once whatever the roster size;
+        # the panels wait for it through when_ready()
+        # self.data is a copy of the roster (CORE.roster()) fetched on a
+        # worker; the Tk thread never takes the store lock, which the store
+        # thread may hold for as long as another station keeps the files locked
+        self.data = {"users": []}
+        self.users = {}
+        self._reads = {}  # kind -> number of the latest read; older answers are dropped
+        self.ready = False
+        self._on_ready = []
+        self.write(ensure_storage, done=self.storage_ready)
 
         # Frames
         self.frame_welcome = ttk.Frame(self)
@@ -68,6 +102,85 @@ class DangYarApp(tk.Tk):
         self.frame_welcome.pack(fill="both", expand=True)
         self.create_welcome()
 
+    def update_title(self):
+        self.title(f"سامانه دَنگ‌یار — {CORE.ledgers.name(CORE.ledger)}")
+
+    def storage_ready(self, rounded=None):
+        self.ready = True
+        if rounded:
+            # legacy debts that were not whole toman; the store now has them rounded
+            lines = [f"{u.get('name', '')}: {old} ← {u['debt']:,}" for u, old in rounded[:APPLY_PREVIEW]]
+            if len(rounded) > APPLY_PREVIEW:
+                lines.append(f"... و {len(rounded) - APPLY_PREVIEW} نفر دیگر")
+            messagebox.showwarning("بدهی‌های گردشده", f"بدهی {len(rounded)} نفر در داده‌های قبلی عدد صحیح تومان "
+                                   "نبود و گرد شد:\n\n" + "\n".join(lines))
+        self.run_task(CORE.warm_up)  # search index, so the first search is quick too
+        self.after(BACKUP_EVERY_MS, self.scheduled_backup)
+        self.on_tasks_change(self.tasks.pending)
+        callbacks, self._on_ready = self._on_ready, []
+        for fn in callbacks:
+            fn()
+
+    def when_ready(self, fn):
+        if self.ready:
+            fn()
+        else:
+            self._on_ready[:] = [fn]  # only the last click counts
+
+    def on_tasks_change(self, n):
+        if not self.ready:
+            self.status_var.set("در حال بارگذاری داده‌ها...")
+        else:
+            self.status_var.set(f"در حال ذخیره‌سازی... ({n})" if n else "")
+
+    def scheduled_backup(self):
+        # off the write queue: the store is only locked while the changed records are copied
+        self.run_task(CORE.backup, "خودکار", done=lambda _: self.run_task(CORE.prune_backups))
+        self.after(BACKUP_EVERY_MS, self.scheduled_backup)
+
+    def on_close(self):
+        # queued writes must reach the disk before we exit
+        self.tasks.shutdown(wait=True)
+        try:
+            CORE.flush()  # ledger totals and the cross-ledger member index
+        except Exception as e:
+            print(f"ledger index not updated: {e}", file=sys.stderr)
+        self.destroy()
+
+    # ---------- Background tasks ----------
+    def run_task(self, fn, *args, done=None, serial=False, uid=None, error=None, on_error=None):
+        # uid: a user id, or a list of them for bulk work; on_error(exc) undoes
+        # what the caller set up for the task, before the error is shown
+        uids = [] if uid is None else list(uid) if isinstance(uid, (list, tuple, set)) else [uid]
+        self.busy.update(uids)
+        def finish(result):
+            self.busy.difference_update(uids)
+            if done:
+                done(result)
+        def failed(e):
+            self.busy.difference_update(uids)
+            if on_error:
+                on_error(e)
+            messagebox.showerror("خطا", f"{error}: {e}" if error else str(e))
+        self.tasks.submit(fn, *args, on_done=finish, on_error=failed, serial=serial)
+
+    def write(self, fn, *args, done=None, uid=None, on_error=None):
+        # store changes go through one thread so they keep their order
+        self.run_task(fn, *args, done=done, serial=True, uid=uid, on_error=on_error)
+
+    def read(self, kind, fn, *args, done=None, uid=None):
+        # a store read on a worker; done gets only the answer to the latest
+        # read of this kind, so a slow one can't overwrite a newer one
+        n = self._reads[kind] = self._reads.get(kind, 0) + 1
+        def finish(result):
+            if self._reads[kind] == n:
+                done(result)
+        self.run_task(fn, *args, done=finish, uid=uid)
+
+    def set_roster(self, data):
+        self.data = data
+        self.users = {u["id"]: u for u in data["users"]}
+
     # ---------- Welcome ----------
     def create_welcome(self):
         for w in self.frame_welcome.winfo_children():
@@ -78,8 +191,8 @@ class DangYarApp(tk.Tk):
         q_label.pack(pady=10)
         btn_frame = ttk.Frame(self.frame_welcome)
         btn_frame.pack(pady=10)
-        btn_yes = ttk.Button(btn_frame, text="بله (مدیر)", command=self.manager_login)
-        btn_no = ttk.Button(btn_frame, text="خیر (کاربر)", command=self.user_panel_entry)
+        btn_yes = ttk.Button(btn_frame, text="بله (مدیر)", command=lambda: self.when_ready(self.manager_login))
+        btn_no = ttk.Button(btn_frame, text="خیر (کاربر)", command=lambda: self.when_ready(self.user_panel_entry))
         btn_yes.grid(row=0, column=0, padx=10)
         btn_no.grid(row=0, column=1, padx=10)
 
@@ -89,11 +202,13 @@ class DangYarApp(tk.Tk):
         pwd = simpledialog.askstring("ورود مدیر", "پسوورد را وارد کنید:", show="*")
         if pwd is None:
             return
-        self.data = load_data()
-        if pwd == self.data.get("password", DEFAULT_PASSWORD):
-            self.open_manager_panel()
-        else:
-            messagebox.showerror("خطا", "پسوورد اشتباه است.")
+        def check(data):
+            self.set_roster(data)
+            if pwd == data["password"]:
+                self.open_manager_panel()
+            else:
+                messagebox.showerror("خطا", "پسوورد اشتباه است.")
+        self.read("roster", CORE.roster, done=check)
 
     def open_manager_panel(self):
         self.frame_welcome.pack_forget()
@@ -116,17 +231,44 @@ class DangYarApp(tk.Tk):
         btn_change_pwd = ttk.Button(top_frame, text="تغییر پسوورد", command=self.change_password)
         btn_change_pwd.pack(side="right", padx=4)
 
-        # Left: listbox of users
+        ttk.Button(top_frame, text="عیب‌یابی", command=lambda: DiagnosticsDialog(self)).pack(side="right", padx=4)
+        ttk.Button(top_frame, text="داشبورد", command=lambda: DashboardDialog(self)).pack(side="right", padx=4)
+        ttk.Button(top_frame, text="پشتیبان‌ها", command=lambda: BackupsDialog(self)).pack(side="right", padx=4)
+
+        # Ledgers: each trip/event has its own roster; switching loads only that one
+        ledger_frame = ttk.Frame(self.frame_manager)
+        ledger_frame.pack(fill="x", padx=10)
+        ttk.Label(ledger_frame, text="دفتر:").pack(side="left")
+        self.ledger_ids = []
+        self.ledger_cb = ttk.Combobox(ledger_frame, state="readonly", width=36)
+        self.ledger_cb.pack(side="left", padx=4)
+        self.ledger_cb.bind("<<ComboboxSelected>>", lambda e: self.switch_ledger(self.ledger_ids[self.ledger_cb.current()]))
+        ttk.Button(ledger_frame, text="دفتر جدید", command=self.new_ledger_dialog).pack(side="left", padx=4)
+        ttk.Button(ledger_frame, text="جستجو در همهٔ دفترها", command=self.find_member_dialog).pack(side="left", padx=4)
+        self.fill_ledgers()
+
+        # Left: roster with status/debt filters; click a heading to sort
         left = ttk.Frame(self.frame_manager)
         left.pack(side="left", fill="both", expand=True, padx=8, pady=8)
 
-        self.user_listbox = tk.Listbox(left, font=("Tahoma", 12))
-        self.user_listbox.pack(side="left", fill="both", expand=True)
-        self.user_listbox.bind("<<ListboxSelect>>", lambda e: self.show_selected_user())
+        filters = ttk.Frame(left)
+        filters.pack(fill="x", pady=(0, 4))
+        ttk.Label(filters, text="وضعیت:").pack(side="left")
+        self.status_filter = tk.StringVar(value=STATUS_FILTERS[0][0])
+        cb = ttk.Combobox(filters, textvariable=self.status_filter, values=[t for t, _ in STATUS_FILTERS], state="readonly", width=14)
+        cb.pack(side="left", padx=4)
+        cb.bind("<<ComboboxSelected>>", lambda e: self.render_manager_lists())
+        ttk.Label(filters, text="حداقل بدهی:").pack(side="left", padx=(8, 0))
+        self.min_debt = tk.StringVar(value="")
+        e_min = ttk.Entry(filters, textvariable=self.min_debt, width=12)
+        e_min.pack(side="left", padx=4)
+        e_min.bind("<KeyRelease>", lambda e: self.render_manager_lists())
 
-        sb = ttk.Scrollbar(left, orient="vertical", command=self.user_listbox.yview)
-        sb.pack(side="right", fill="y")
-        self.user_listbox.config(yscrollcommand=sb.set)
+        self.roster_sort = None
+        self.roster = VirtualTree(left, ("name", "debt", "status"), ("نام", "بدهی (تومان)", "وضعیت"),
+                                  on_sort=lambda col: self.sort_by(col, "roster_sort"))
+        self.roster.frame.pack(fill="both", expand=True)
+        self.roster.tree.bind("<<TreeviewSelect>>", lambda e: self.show_selected_user(), add="+")
 
         # Right: detail & actions
         right = ttk.Frame(self.frame_manager)
@@ -144,85 +286,204 @@ class DangYarApp(tk.Tk):
         ttk.Button(btns, text="ویرایش انتخاب شده", command=self.edit_selected_user).grid(row=0, column=1, padx=3, pady=3)
         ttk.Button(btns, text="حذف انتخاب شده", command=self.delete_selected_user).grid(row=0, column=2, padx=3, pady=3)
         ttk.Button(btns, text="ریست کامل (حذف همه)", command=self.reset_all).grid(row=0, column=3, padx=3, pady=3)
+        ttk.Button(btns, text="ورود از فایل (CSV/JSON)", command=self.import_users_dialog).grid(row=1, column=0, columnspan=2, padx=3, pady=3)
+        ttk.Button(btns, text="خروجی فهرست", command=self.export_users_dialog).grid(row=1, column=2, columnspan=2, padx=3, pady=3)
+        ttk.Button(btns, text="هزینه‌ها و تسویه", command=lambda: ExpensesDialog(self)).grid(row=2, column=0, columnspan=2, padx=3, pady=3)
+        ttk.Button(btns, text="تاریخچهٔ پرداخت", command=self.show_selected_history).grid(row=2, column=2, columnspan=2, padx=3, pady=3)
 
-        # Pending approvals
+        # Pending approvals: select rows (Ctrl/Shift for several), then confirm;
+        # double-click does the right one for a single row
         ttk.Separator(right, orient="horizontal").pack(fill="x", pady=6)
         ttk.Label(right, text="درخواست‌های پرداخت (نقدی/رسید کارت):", font=("Tahoma", 12)).pack(anchor="w")
-        self.pending_frame = ttk.Frame(right)
-        self.pending_frame.pack(fill="both", expand=True)
+        self.pending_sort = None
+        self.pending = VirtualTree(right, ("name", "debt", "request"), ("نام", "بدهی (تومان)", "درخواست"), height=8,
+                                   on_sort=lambda col: self.sort_by(col, "pending_sort"), selectmode="extended")
+        self.pending.frame.pack(fill="both", expand=True)
+        self.pending.tree.bind("<Double-1>", self.on_pending_double_click)
+        pbtns = ttk.Frame(right)
+        pbtns.pack(pady=4)
+        ttk.Button(pbtns, text="تأیید نقدی", command=lambda: self.confirm_selected_pending("cash")).grid(row=0, column=0, padx=3)
+        ttk.Button(pbtns, text="مشاهده/تأیید رسید", command=lambda: self.confirm_selected_pending("card")).grid(row=0, column=1, padx=3)
+        ttk.Button(pbtns, text="رد درخواست", command=self.reject_selected_pending).grid(row=0, column=2, padx=3)
+        ttk.Button(pbtns, text="انتخاب همه", command=self.pending.select_all).grid(row=0, column=3, padx=3)
 
         self.refresh_manager_lists()
 
     def refresh_manager_lists(self):
-        self.data = load_data()
-        # populate listbox
-        self.user_listbox.delete(0, tk.END)
+        # a fresh copy from a worker, then redraw
+        self.read("roster", CORE.roster, done=self.roster_loaded)
+
+    @timed("ui.refresh_manager_lists", records=lambda r, self, data: len(data["users"]))
+    def roster_loaded(self, data):
+        self.set_roster(data)
+        self.render_manager_lists()
+
+    @timed("ui.render_manager_lists", records=lambda r, self: len(self.data["users"]))
+    def render_manager_lists(self):
+        # rebuild the row model from self.data; the views only touch rows that changed
+        status_only = dict(STATUS_FILTERS).get(self.status_filter.get())
+        try:
+            min_debt = to_toman(self.min_debt.get() or 0)
+        except ValueError:
+            min_debt = 0
+        rows, shown, pending_rows, pending = {}, [], {}, []
         for u in self.data["users"]:
-            status = "✓" if u.get("paid") else ("(درخواست) " if u.get("pending_cash") or u.get("pending_card") else "–")
-            self.user_listbox.insert(tk.END, f"{u['name']} — {u.get('debt',0):,} تومان {status}")
+            st = user_status(u)
+            debt = f"{u.get('debt',0):,}"
+            status = STATUS_TEXT[st] + (" …" if u["id"] in self.busy else "")
+            rows[u["id"]] = (u["name"], debt, status)
+            if (status_only is None or st == status_only) and u.get("debt", 0) >= min_debt:
+                shown.append(u)
+            if st == "pending":
+                request = "نقدی" if u.get("pending_cash") else "رسید کارت"
+                if u["id"] in self.busy:
+                    request += " (در حال ذخیره)"
+                pending_rows[u["id"]] = (u["name"], debt, request)
+                pending.append(u)
+        self.roster.set_rows(rows, [u["id"] for u in self.sorted_users(shown, self.roster_sort)])
+        self.pending.set_rows(pending_rows, [u["id"] for u in self.sorted_users(pending, self.pending_sort)])
 
-        # pending
-        for w in self.pending_frame.winfo_children():
-            w.destroy()
-        idx=0
-        for i,u in enumerate(self.data["users"]):
-            if u.get("pending_cash") or u.get("pending_card"):
-                f = ttk.Frame(self.pending_frame, relief="groove", padding=6)
-                f.pack(fill="x", pady=3)
-                ttk.Label(f, text=f"{u['name']} — {u.get('debt',0):,} تومان", font=("Tahoma", 11)).grid(row=0, column=0, sticky="w")
-                status = []
-                if u.get("pending_cash"): status.append("پرداخت نقدی (تأیید نشده)")
-                if u.get("pending_card"): status.append("رسید کارت آپلود شده (تأیید نشده)")
-                ttk.Label(f, text="، ".join(status)).grid(row=1, column=0, sticky="w")
-                btn_confirm_cash = ttk.Button(f, text="تأیید نقدی", command=lambda i=i: self.confirm_cash(i))
-                btn_confirm_card = ttk.Button(f, text="مشاهده/تأیید رسید", command=lambda i=i: self.view_and_confirm_receipt(i))
-                btn_confirm_cash.grid(row=0, column=1, padx=4)
-                btn_confirm_card.grid(row=1, column=1, padx=4)
-
-                idx+=1
+    def sorted_users(self, users, sort):
+        if sort is None:
+            return users
+        col, reverse = sort
+        if col == "debt":
+            key = lambda u: u.get("debt", 0)
+        elif col in ("status", "request"):
+            key = lambda u: (STATUS_RANK[user_status(u)], not u.get("pending_cash"))
+        else:
+            key = lambda u: u["name"]
+        return sorted(users, key=key, reverse=reverse)
+
+    def sort_by(self, col, attr):
+        # clicking the same heading again flips the direction
+        cur = getattr(self, attr)
+        setattr(self, attr, (col, not cur[1]) if cur and cur[0] == col else (col, False))
+        self.render_manager_lists()
+
+    def confirm_selected_pending(self, method):
+        sel = self.pending.selection()
+        if not sel:
+            messagebox.showwarning("هشدار", "یک درخواست انتخاب کنید.")
+            return
+        if len(sel) > 1:
+            self.confirm_many(sel, method)
+        elif method == "cash":
+            self.confirm_cash(sel[0])
+        else:
+            self.view_and_confirm_receipt(sel[0])
+
+    def reject_selected_pending(self):
+        uids = [uid for uid in self.pending.selection() if uid not in self.busy]
+        if not uids:
+            messagebox.showwarning("هشدار", "یک درخواست انتخاب کنید.")
+            return
+        if not messagebox.askyesno("رد درخواست", f"{len(uids)} درخواست رد شود؟ رسیدهای آپلود شده حذف می‌شوند."):
+            return
+        def rejected(result):
+            self.pending.clear_selection()
+            messagebox.showinfo("رد درخواست", f"{len(result[0])} درخواست رد شد.")
+            self.refresh_manager_lists()
+        self.write(CORE.reject, uids, done=rejected, uid=uids)
+        self.render_manager_lists()
+
+    def show_selected_history(self):
+        sel = self.roster.selection()
+        if not sel:
+            messagebox.showwarning("هشدار", "یک فرد انتخاب کنید.")
+            return
+        def show(events):
+            if not events:
+                messagebox.showinfo("تاریخچهٔ پرداخت", "رویدادی ثبت نشده است.")
+                return
+            messagebox.showinfo("تاریخچهٔ پرداخت", "\n".join(event_line(e) for e in events))
+        self.run_task(CORE.history, sel[0], 30, done=show)
+
+    def on_pending_double_click(self, event):
+        uid = self.pending.tree.identify_row(event.y)
+        u = self.users.get(uid) if uid else None
+        if u is None:
+            return
+        if u.get("pending_cash"):
+            self.confirm_cash(uid)
+        else:
+            self.view_and_confirm_receipt(uid)
 
     def manager_logout(self):
         self.frame_manager.pack_forget()
         self.frame_welcome.pack(fill="both", expand=True)
 
+    # ---------- Ledgers ----------
+    def fill_ledgers(self):
+        ledgers = CORE.ledgers.list()
+        self.ledger_ids = [lid for lid, _ in ledgers]
+        # totals are as of each ledger's last flush
+        self.ledger_cb["values"] = [f"{info.get('name', lid)} ({(info.get('totals') or {}).get('users', 0):,} نفر)"
+                                    for lid, info in ledgers]
+        if CORE.ledger in self.ledger_ids:
+            self.ledger_cb.current(self.ledger_ids.index(CORE.ledger))
+
+    def switch_ledger(self, lid):
+        if lid == CORE.ledger:
+            return
+        def switched(_):
+            global STORE
+            STORE = CORE.store
+            self.set_roster({"users": []})
+            self.update_title()
+            self.fill_ledgers()
+            self.detail_lbl.config(text="انتخاب کنید")
+            self.render_manager_lists()
+            self.refresh_manager_lists()
+        # after the writes already queued for the old ledger
+        self.write(CORE.switch_ledger, lid, done=switched)
+        self.status_var.set("در حال باز کردن دفتر...")
+
+    def new_ledger_dialog(self):
+        name = simpledialog.askstring("دفتر جدید", "نام دفتر (مثلاً سفر شمال، مهر ۱۴۰۳):")
+        if not name or not name.strip():
+            return
+        self.write(CORE.create_ledger, name.strip(), done=self.switch_ledger)
+
+    def find_member_dialog(self):
+        q = simpledialog.askstring("جستجو در همهٔ دفترها", "نام:")
+        if not q or not q.strip():
+            return
+        def found(members):
+            if not members:
+                messagebox.showinfo("جستجو", "در هیچ دفتری یافت نشد.")
+                return
+            lines = [f"{m['name']} — {m['ledger_name']} — {m['debt']:,} تومان — {STATUS_TEXT[m['status']]}" for m in members]
+            messagebox.showinfo("جستجو در همهٔ دفترها", "\n".join(lines))
+        # flush first so the open ledger's latest changes are searchable too
+        self.write(CORE.flush, done=lambda _: self.run_task(CORE.find_member, q.strip(), 30, done=found))
+
     def change_password(self):
         newp = simpledialog.askstring("تغییر پسوورد", "پسورد جدید را وارد کنید (حداقل 4 رقم):", show="*")
         if not newp or len(newp.strip())<4:
             messagebox.showwarning("ناقص", "پسورد باید حداقل 4 کاراکتر باشد.")
             return
-        self.data = load_data()
-        self.data["password"] = newp.strip()
-        save_data(self.data)
-        messagebox.showinfo("موفق", "پسورد با موفقیت تغییر کرد.")
+        self.write(CORE.set_password, newp.strip(),
+                   done=lambda _: messagebox.showinfo("موفق", "پسورد با موفقیت تغییر کرد."))
 
     def add_user_dialog(self):
         dlg = UserEditDialog(self, title="افزودن فرد")
         self.wait_window(dlg.top)
         if dlg.result:
             name, debt = dlg.result
-            self.data = load_data()
             # prevent exact duplicate names? allow but warn
             # append
-            self.data["users"].append({
-                "name": name,
-                "debt": float(debt),
-                "paid": False,
-                "pending_cash": False,
-                "pending_card": False,
-                "receipt": "",
-                "payment_time": "",
-                "approved_by": ""
-            })
-            save_data(self.data)
-            self.refresh_manager_lists()
+            self.write(STORE.add_user, new_user(name, debt), done=lambda _: self.refresh_manager_lists())
 
     def show_selected_user(self):
-        sel = self.user_listbox.curselection()
+        sel = self.roster.selection()
         if not sel: 
             self.detail_lbl.config(text="انتخاب کنید")
             return
-        idx = sel[0]
-        u = self.data["users"][idx]
+        u = self.users.get(sel[0])
+        if u is None:
+            self.detail_lbl.config(text="انتخاب کنید")
+            return
         txt = f"نام: {u['name']}\nمیزان بدهی: {u.get('debt',0):,} تومان\nوضعیت پرداخت: {'پرداخت شده' if u.get('paid') else 'پرداخت نشده'}"
         if u.get("pending_cash"): txt += "\nدرخواست نقدی (تأیید نشده)"
         if u.get("pending_card"): txt += "\nرسید کارت آپلود شده (تأیید نشده)"
@@ -233,84 +494,133 @@ class DangYarApp(tk.Tk):
         self.detail_lbl.config(text=txt)
 
     def edit_selected_user(self):
-        sel = self.user_listbox.curselection()
+        sel = self.roster.selection()
         if not sel:
             messagebox.showwarning("هشدار", "یک فرد انتخاب کنید.")
             return
-        idx = sel[0]
-        u = self.data["users"][idx]
-        dlg = UserEditDialog(self, title="ویرایش فرد", name=u["name"], debt=str(int(u.get("debt",0))))
+        uid = sel[0]
+        u = self.users.get(uid)
+        if u is None:
+            self.refresh_manager_lists()
+            return
+        dlg = UserEditDialog(self, title="ویرایش فرد", name=u["name"], debt=str(u.get("debt",0)))
         self.wait_window(dlg.top)
         if dlg.result:
             name, debt = dlg.result
-            self.data = load_data()
-            self.data["users"][idx]["name"] = name
-            self.data["users"][idx]["debt"] = float(debt)
-            save_data(self.data)
-            self.refresh_manager_lists()
+            self.write(STORE.update_user, uid, {"name": name, "debt": debt},
+                       done=lambda _: self.refresh_manager_lists(), uid=uid)
+            self.render_manager_lists()
 
     def delete_selected_user(self):
-        sel = self.user_listbox.curselection()
+        sel = self.roster.selection()
         if not sel:
             messagebox.showwarning("هشدار", "یک فرد انتخاب کنید.")
             return
-        idx = sel[0]
-        u = self.data["users"][idx]
-        if messagebox.askyesno("حذف", f"آیا از حذف {u['name']} مطمئن هستید؟"):
-            # remove receipt file if exists
-            if u.get("receipt") and os.path.exists(u["receipt"]):
-                try: os.remove(u["receipt"])
-                except: pass
-            self.data = load_data()
-            self.data["users"].pop(idx)
-            save_data(self.data)
+        uid = sel[0]
+        u = self.users.get(uid)
+        if u is None:
             self.refresh_manager_lists()
+            return
+        if messagebox.askyesno("حذف", f"آیا از حذف {u['name']} مطمئن هستید؟\n(از پنجرهٔ پشتیبان‌ها قابل بازگردانی است)"):
+            receipt = u.get("receipt")
+            def deleted(_):
+                # remove receipt file if exists
+                self.run_task(release_receipts, [receipt])
+                self.refresh_manager_lists()
+            # a backup first (it keeps the receipt too); refused while the
+            # member is in an expense
+            self.write(CORE.delete_user, uid, "قبل از حذف " + u["name"], done=deleted, uid=uid,
+                       on_error=lambda e: self.render_manager_lists())
+            self.render_manager_lists()
 
     def reset_all(self):
-        if not messagebox.askyesno("ریست کامل", "آیا می‌خواهید تمام اسامی و داده‌ها حذف شود؟ این عمل برگشت‌پذیر نیست."):
+        if not messagebox.askyesno("ریست کامل", "آیا می‌خواهید تمام اسامی و داده‌ها حذف شود؟ پیش از حذف یک نسخهٔ پشتیبان گرفته می‌شود."):
             return
-        # remove receipts
-        for u in self.data["users"]:
-            if u.get("receipt") and os.path.exists(u["receipt"]):
-                try: os.remove(u["receipt"])
-                except: pass
-        self.data = load_data()
-        self.data["users"] = []
-        save_data(self.data)
-        self.refresh_manager_lists()
+        receipts = [u.get("receipt") for u in self.data["users"] if u.get("receipt")]
+        def cleared(_):
+            # remove receipts
+            self.run_task(release_receipts, receipts)
+            self.refresh_manager_lists()
+        self.write(CORE.backup, "قبل از ریست کامل")
+        self.write(STORE.clear_users, done=cleared)
 
-    def confirm_cash(self, idx):
-        self.data = load_data()
-        u = self.data["users"][idx]
-        if not u.get("pending_cash"):
+    def confirm_cash(self, uid):
+        if uid in self.busy:
+            return
+        u = self.users.get(uid)
+        if u is None or not u.get("pending_cash"):
             messagebox.showinfo("اطلاع", "درخواستی موجود نیست.")
             return
-        u["paid"] = True
-        u["pending_cash"] = False
-        u["payment_time"] = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
-        u["approved_by"] = "مدیر"
-        save_data(self.data)
-        messagebox.showinfo("تأیید", f"پرداخت نقدی {u['name']} تأیید شد.")
-        self.refresh_manager_lists()
+        def confirmed(result):
+            if not result[0]:
+                messagebox.showinfo("اطلاع", "درخواستی موجود نیست.")
+            else:
+                messagebox.showinfo("تأیید", f"پرداخت نقدی {u['name']} تأیید شد.")
+            self.refresh_manager_lists()
+        self.write(CORE.approve, [uid], "cash", done=confirmed, uid=uid)
+        self.render_manager_lists()
 
-    def view_and_confirm_receipt(self, idx):
-        self.data = load_data()
-        u = self.data["users"][idx]
-        if not u.get("pending_card"):
-            messagebox.showinfo("اطلاع", "درخواستی موجود نیست.")
+    def confirm_many(self, uids, method):
+        # one store write for the whole selection; rows of the other kind are skipped
+        uids = [uid for uid in uids if uid not in self.busy]
+        kind = "نقدی" if method == "cash" else "رسید کارت"
+        if not uids or not messagebox.askyesno("تأیید گروهی", f"{len(uids)} درخواست انتخاب شده است. درخواست‌های {kind} تأیید شوند؟"):
+            return
+        def confirmed(result):
+            changed = result[0]
+            self.pending.clear_selection()
+            messagebox.showinfo("تأیید", f"{len(changed)} درخواست {kind} تأیید شد." +
+                                (f"\n{len(uids) - len(changed)} مورد از نوع دیگر یا قبلاً تأیید شده بود." if len(changed) < len(uids) else ""))
+            self.refresh_manager_lists()
+        self.write(CORE.approve, uids, method, done=confirmed, uid=uids)
+        self.render_manager_lists()
+
+    def import_users_dialog(self):
+        path = filedialog.askopenfilename(title="ورود فهرست افراد",
+                                          filetypes=[("CSV / JSON", "*.csv *.jsonl *.json"), ("All files", "*.*")])
+        if not path:
             return
-        # open file if exists
-        if u.get("receipt") and os.path.exists(u["receipt"]):
-            if messagebox.askyesno("دیدن رسید", "آیا می‌خواهید رسید را باز کنید؟ (پس از مشاهده می‌توانید تأیید کنید)"):
-                open_file(u["receipt"])
-        if messagebox.askyesno("تأیید رسید", "آیا این پرداخت را تأیید می‌کنید؟"):
-            u["paid"] = True
-            u["pending_card"] = False
-            u["payment_time"] = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
-            u["approved_by"] = "مدیر"
-            save_data(self.data)
-            messagebox.showinfo("تأیید", f"رسید {u['name']} تأیید شد.")
+        def imported(result):
+            added, errors = result
+            msg = f"{added:,} نفر اضافه شد."
+            if errors:
+                lines = "\n".join(f"سطر {n}: {m}" for n, m in errors[:15])
+                more = f"\n... و {len(errors) - 15} خطای دیگر" if len(errors) > 15 else ""
+                msg += f"\n{len(errors):,} سطر نامعتبر رد شد:\n{lines}{more}"
+            messagebox.showinfo("ورود از فایل", msg)
             self.refresh_manager_lists()
+        # rows are committed in batches; the roster is redrawn once at the end
+        self.write(import_users, STORE, path, done=imported)
+        self.status_var.set("در حال ورود اطلاعات...")
+
+    def export_users_dialog(self):
+        path = filedialog.asksaveasfilename(title="خروجی فهرست", defaultextension=".csv",
+                                            filetypes=[("CSV", "*.csv"), ("JSON lines", "*.jsonl"), ("JSON", "*.json")])
+        if not path:
+            return
+        # self.data holds copies already; the store thread doesn't touch them
+        self.run_task(export_users, self.data["users"], path, error="ذخیره فایل انجام نشد",
+                      done=lambda n: messagebox.showinfo("خروجی فهرست", f"{n:,} نفر در فایل ذخیره شد."))
+
+    def view_and_confirm_receipt(self, uid):
+        if uid in self.busy:
+            return
+        u = self.users.get(uid)
+        if u is None or not u.get("pending_card"):
+            messagebox.showinfo("اطلاع", "درخواستی موجود نیست.")
+            return
+        # preview inline; the external viewer is one button away
+        dlg = ReceiptDialog(self, u)
+        self.wait_window(dlg.top)
+        if dlg.result:
+            def confirmed(result):
+                if not result[0]:
+                    messagebox.showinfo("اطلاع", "درخواستی موجود نیست.")
+                else:
+                    messagebox.showinfo("تأیید", f"رسید {u['name']} تأیید شد.")
+                self.refresh_manager_lists()
+            self.write(CORE.approve, [uid], "card", done=confirmed, uid=uid)
+            self.render_manager_lists()
 
     # ---------- User panel ----------
     def user_panel_entry(self):
@@ -333,11 +643,38 @@ class DangYarApp(tk.Tk):
         ttk.Label(entry_frame, text="نام خود را وارد کنید:").grid(row=0, column=0, padx=4)
         self.name_entry = ttk.Entry(entry_frame, width=30)
         self.name_entry.grid(row=0, column=1, padx=4)
+        self.name_entry.bind("<KeyRelease>", self.schedule_user_search)
+        self.name_entry.bind("<Return>", lambda e: self.user_search())
+        self.name_entry.bind("<Down>", lambda e: self.focus_results(0))
+        self._search_after = None
         ttk.Button(entry_frame, text="جستجو", command=self.user_search).grid(row=0, column=2, padx=4)
 
-        # search results
+        # search results: one page in a fixed list, so a query costs the
+        # same whatever it matches (dangyar/search.py ranks lazily)
         self.search_results = ttk.Frame(self.frame_user)
         self.search_results.pack(fill="x", padx=8, pady=6)
+        self.result_list = tk.Listbox(self.search_results, height=SEARCH_PAGE, activestyle="dotbox", exportselection=False)
+        self.result_list.pack(fill="x")
+        self.result_list.bind("<Return>", lambda e: self.open_selected_result())
+        self.result_list.bind("<Double-Button-1>", lambda e: self.open_selected_result())
+        self.result_list.bind("<Down>", lambda e: self.move_result(1))
+        self.result_list.bind("<Up>", lambda e: self.move_result(-1))
+        self.result_list.bind("<Next>", lambda e: self.show_result_page(self.result_page + 1, select=0))
+        self.result_list.bind("<Prior>", lambda e: self.show_result_page(self.result_page - 1, select=0))
+        self.result_list.bind("<Escape>", lambda e: self.name_entry.focus_set())
+        nav = ttk.Frame(self.search_results)
+        nav.pack(fill="x", pady=(4, 0))
+        self.prev_btn = ttk.Button(nav, text="قبلی", command=lambda: self.show_result_page(self.result_page - 1))
+        self.prev_btn.pack(side="left")
+        self.next_btn = ttk.Button(nav, text="بعدی", command=lambda: self.show_result_page(self.result_page + 1))
+        self.next_btn.pack(side="left", padx=4)
+        ttk.Button(nav, text="انتخاب", command=self.open_selected_result).pack(side="right")
+        self.result_info = ttk.Label(nav, text="")
+        self.result_info.pack(side="left", padx=8)
+        self.matches = None
+        self.result_page = 0
+        self.page_users = []
+        self.show_result_page(0)
 
         # detail/payment area
         self.user_detail = ttk.Frame(self.frame_user, relief="ridge", padding=10)
@@ -349,21 +686,89 @@ class DangYarApp(tk.Tk):
         self.frame_user.pack_forget()
         self.frame_welcome.pack(fill="both", expand=True)
 
+    def schedule_user_search(self, event=None):
+        # search as you type, but only once typing pauses
+        if self._search_after is not None:
+            self.after_cancel(self._search_after)
+        self._search_after = self.after(SEARCH_DEBOUNCE_MS, self.user_search)
+
     def user_search(self):
-        name = self.name_entry.get().strip()
-        self.data = load_data()
-        for w in self.search_results.winfo_children():
-            w.destroy()
-        results = find_users_by_name(name, self.data)
-        if not results:
-            ttk.Label(self.search_results, text="هیچ نامی یافت نشد. اگر جدید هستید، لطفاً از مدیر بخواهید نام شما را اضافه کند.", foreground="red").pack()
+        self._search_after = None
+        self.read("search", search_first_page, self.name_entry.get().strip(), done=self.show_matches)
+
+    @timed("ui.user_search")
+    def show_matches(self, result):
+        self.matches, users = result
+        self.fill_result_page(0, users)
+        if self.matches is not None and not len(self.matches):
             self.clear_user_detail()
-            return
-        for u in results:
-            f = ttk.Frame(self.search_results)
-            f.pack(fill="x", pady=2)
-            ttk.Label(f, text=f"{u['name']} — {int(u.get('debt',0)):,} تومان").pack(side="left")
-            ttk.Button(f, text="انتخاب", command=lambda u=u: self.open_user_detail(u)).pack(side="right")
+
+    def show_result_page(self, page, select=None):
+        # fetch one page of the current matches, then fill the list with it
+        m = self.matches
+        pages = m.pages(SEARCH_PAGE) if m is not None else 1
+        if page < 0 or page >= pages:
+            return "break"
+        if m is None:
+            self.fill_result_page(page, [], select)
+        else:
+            def fetched(users):
+                if m is self.matches:  # not replaced by a newer search meanwhile
+                    self.fill_result_page(page, users, select)
+            self.read("page", CORE.match_page, m, page, SEARCH_PAGE, done=fetched)
+        return "break"
+
+    def fill_result_page(self, page, users, select=None):
+        m = self.matches
+        pages = m.pages(SEARCH_PAGE) if m is not None else 1
+        self.result_page = page
+        self.page_users = users
+        self.result_list.delete(0, "end")
+        for u in self.page_users:
+            self.result_list.insert("end", f"{u['name']} — {u.get('debt', 0):,} تومان")
+        self.prev_btn.state(["!disabled"] if page > 0 else ["disabled"])
+        self.next_btn.state(["!disabled"] if page + 1 < pages else ["disabled"])
+        if m is None:
+            self.result_info.config(text="", foreground="")
+        elif not len(m):
+            self.result_info.config(text="هیچ نامی یافت نشد. اگر جدید هستید، لطفاً از مدیر بخواهید نام شما را اضافه کند.", foreground="red")
+        else:
+            self.result_info.config(text=f"صفحهٔ {page + 1} از {pages} — {len(m):,} نتیجه", foreground="")
+        if select is not None and self.page_users:
+            self.select_result(min(select, len(self.page_users) - 1) if select >= 0 else len(self.page_users) - 1)
+
+    def select_result(self, i):
+        self.result_list.selection_clear(0, "end")
+        self.result_list.selection_set(i)
+        self.result_list.activate(i)
+        self.result_list.see(i)
+
+    def focus_results(self, i):
+        if self.page_users:
+            self.result_list.focus_set()
+            self.select_result(i)
+        return "break"
+
+    def move_result(self, step):
+        # up/down through the list, turning the page at either end
+        sel = self.result_list.curselection()
+        i = (sel[0] if sel else -1) + step
+        if 0 <= i < len(self.page_users):
+            self.select_result(i)
+        elif i < 0 and self.result_page == 0:
+            self.name_entry.focus_set()
+        else:
+            self.show_result_page(self.result_page + step, select=0 if step > 0 else -1)
+        return "break"
+
+    def open_selected_result(self):
+        sel = self.result_list.curselection()
+        if not sel:
+            if len(self.page_users) != 1:
+                messagebox.showwarning("هشدار", "یک نام را انتخاب کنید.")
+                return
+            sel = (0,)
+        self.open_user_detail(self.page_users[sel[0]])
 
     def clear_user_detail(self):
         for w in self.user_detail.winfo_children():
@@ -371,28 +776,25 @@ class DangYarApp(tk.Tk):
         self.cur_user = None
 
     def open_user_detail(self, user_obj):
-        # find actual index in data
-        self.data = load_data()
-        idx = None
-        for i,u in enumerate(self.data["users"]):
-            if u["name"] == user_obj["name"] and int(u.get("debt",0))==int(user_obj.get("debt",0)):
-                idx = i
-                break
-        if idx is None:
+        # look the user up again by id, the record may have changed meanwhile
+        self.read("detail", CORE.get_user, user_obj["id"], done=self.show_user_detail)
+
+    @timed("ui.open_user_detail")
+    def show_user_detail(self, u):
+        if u is None:
             messagebox.showerror("خطا", "کاربر یافت نشد (داده‌ها تغییر کرده‌اند).")
             return
-        u = self.data["users"][idx]
-        self.cur_user = idx
+        self.cur_user = u["id"]
         for w in self.user_detail.winfo_children():
             w.destroy()
         ttk.Label(self.user_detail, text=f"سلام {u['name']}", font=("Tahoma", 14)).pack(anchor="w")
-        ttk.Label(self.user_detail, text=f"میزان بدهی: {int(u.get('debt',0)):,} تومان", font=("Tahoma", 12)).pack(anchor="w", pady=4)
+        ttk.Label(self.user_detail, text=f"میزان بدهی: {u.get('debt',0):,} تومان", font=("Tahoma", 12)).pack(anchor="w", pady=4)
         status_text = "پرداخت شده" if u.get("paid") else "پرداخت نشده"
         ttk.Label(self.user_detail, text=f"وضعیت: {status_text}").pack(anchor="w", pady=2)
 
         # reminder if unpaid
-        if not u.get("paid") and float(u.get("debt",0))>0:
-            ttk.Label(self.user_detail, text=f"یادآوری: امروز {int(u.get('debt',0)):,} تومان بدهی دارید، لطفاً پرداخت کنید.", foreground="blue").pack(anchor="w", pady=4)
+        if not u.get("paid") and u.get("debt",0)>0:
+            ttk.Label(self.user_detail, text=f"یادآوری: امروز {u.get('debt',0):,} تومان بدهی دارید، لطفاً پرداخت کنید.", foreground="blue").pack(anchor="w", pady=4)
 
         # payment options
         pay_frame = ttk.Frame(self.user_detail)
@@ -431,8 +833,19 @@ class DangYarApp(tk.Tk):
         if self.cur_user is None:
             messagebox.showwarning("هشدار", "ابتدا یک نام را انتخاب کنید.")
             return
-        self.data = load_data()
-        u = self.data["users"][self.cur_user]
+        if self.cur_user in self.busy:
+            # the previous click is still being saved
+            return
+        uid, method = self.cur_user, self.pay_method.get()
+        def checked(u):
+            if uid == self.cur_user:  # still the member on screen
+                self.pay(u, method)
+        self.read("pay", CORE.get_user, uid, done=checked, uid=uid)
+
+    def pay(self, u, method):
+        if u is None:
+            messagebox.showerror("خطا", "کاربر یافت نشد (داده‌ها تغییر کرده‌اند).")
+            return
         if u.get("paid"):
             messagebox.showinfo("اطلاع", "بدهی شما قبلاً پرداخت شده است.")
             return
@@ -440,15 +853,16 @@ class DangYarApp(tk.Tk):
         if u.get("pending_cash") or u.get("pending_card"):
             messagebox.showinfo("اطلاع", "درخواست پرداخت شما قبلاً ثبت شده است و در انتظار تأیید مدیر است.")
             return
-        method = self.pay_method.get()
+        uid = u["id"]
         if method == "cash":
             # mark pending cash
-            u["pending_cash"] = True
-            u["pending_card"] = False
-            u["receipt"] = ""
-            save_data(self.data)
-            messagebox.showinfo("ثبت شد", "درخواست پرداخت نقدی ثبت شد. منتظر تأیید مدیر باشید.")
-            self.open_user_detail(u)
+            def saved(fields):
+                if fields is None:
+                    messagebox.showinfo("اطلاع", "درخواست پرداخت شما قبلاً ثبت شده است و در انتظار تأیید مدیر است.")
+                else:
+                    messagebox.showinfo("ثبت شد", "درخواست پرداخت نقدی ثبت شد. منتظر تأیید مدیر باشید.")
+                self.open_user_detail(u)
+            self.write(STORE.modify_user, uid, request_cash, done=saved, uid=uid)
             return
         else:
             # open file dialog to choose receipt image
@@ -456,22 +870,607 @@ class DangYarApp(tk.Tk):
             path = filedialog.askopenfilename(title="انتخاب فایل رسید", filetypes=filetypes)
             if not path:
                 return
-            # copy to receipts dir with unique name
-            base = os.path.basename(path)
-            timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-            dest = os.path.join(RECEIPT_DIR, f"{timestamp}_{base}")
+            # stored by content hash, so re-uploads of the same image share one file
+            def saved(dest, fields):
+                if fields is None:
+                    # someone else registered a payment meanwhile; drop our reference
+                    self.run_task(release_receipts, [dest])
+                    messagebox.showinfo("اطلاع", "درخواست پرداخت شما قبلاً ثبت شده است و در انتظار تأیید مدیر است.")
+                else:
+                    if RECEIPTS.can_thumbnail(dest):
+                        # have the preview ready before the manager opens it
+                        self.run_task(RECEIPTS.make_thumbnail, dest)
+                    messagebox.showinfo("ثبت شد", "رسید آپلود شد. منتظر تأیید مدیر باشید.")
+                self.open_user_detail(u)
+            def not_saved(dest):
+                # the member was deleted or kept changing: nothing refers to the copy
+                self.run_task(release_receipts, [dest])
+                self.open_user_detail(u)
+            def copied(dest):
+                self.write(STORE.modify_user, uid, attach_receipt(dest),
+                           done=lambda fields: saved(dest, fields), uid=uid,
+                           on_error=lambda e: not_saved(dest))
+            # big scans can take a while to copy; keep the window responsive
+            self.run_task(RECEIPTS.put, path, done=copied, uid=uid, error="کپی فایل انجام نشد")
+            self.status_var.set("در حال بارگذاری رسید...")
+            return
+
+# ---------- Virtualized list ----------
+class VirtualTree:
+    """ttk.Treeview that only holds the rows currently scrolled into view.
+
+    set_rows() takes every row (iid -> values) plus the filtered/sorted
+    order; just the visible window is pushed into Tk, and of that only the
+    rows whose values changed are touched.
+    """
+    ROW_HEIGHT = 20
+    HEADING_HEIGHT = 24
+
+    def __init__(self, parent, columns, headings, height=20, on_sort=None, selectmode="browse"):
+        self.frame = ttk.Frame(parent)
+        self.tree = ttk.Treeview(self.frame, columns=columns, show="headings", height=height, selectmode=selectmode)
+        for col, text in zip(columns, headings):
+            self.tree.heading(col, text=text, command=(lambda c=col: on_sort(c)) if on_sort else "")
+            self.tree.column(col, anchor="w", width=120, stretch=True)
+        self.tree.pack(side="left", fill="both", expand=True)
+        self.sb = ttk.Scrollbar(self.frame, orient="vertical", command=self.on_scroll)
+        self.sb.pack(side="right", fill="y")
+
+        self.rows = {}       # iid -> values, all rows
+        self.order = []      # iids in display order (after filter/sort)
+        self.shown = {}      # iid -> values currently inserted in the tree
+        self.top = 0         # index in order of the first visible row
+        self.page = height
+        self.pos = None      # iid -> index in order, built on demand
+        self._selected = []
+
+        self.tree.bind("<<TreeviewSelect>>", self.on_select)
+        self.tree.bind("<Configure>", self.on_resize)
+        self.tree.bind("<MouseWheel>", lambda e: self.scroll_rows(-3 if e.delta > 0 else 3))
+        self.tree.bind("<Button-4>", lambda e: self.scroll_rows(-3))
+        self.tree.bind("<Button-5>", lambda e: self.scroll_rows(3))
+        for key, step in (("<Up>", -1), ("<Down>", 1), ("<Prior>", "-page"), ("<Next>", "page"),
+                          ("<Home>", "home"), ("<End>", "end")):
+            self.tree.bind(key, lambda e, s=step: self.move_focus(s))
+
+    def set_rows(self, rows, order):
+        self.rows = rows
+        self.order = order
+        self.pos = None
+        self._selected = [i for i in self._selected if i in rows]
+        self.render()
+
+    def selection(self):
+        return list(self._selected)
+
+    def select_all(self):
+        self._selected = list(self.order)
+        self.render()
+
+    def clear_selection(self):
+        self._selected = []
+        self.render()
+
+    def index_of(self, iid):
+        if self.pos is None:
+            self.pos = {iid: i for i, iid in enumerate(self.order)}
+        return self.pos.get(iid)
+
+    def render(self):
+        self.top = max(0, min(self.top, len(self.order) - self.page))
+        window = self.order[self.top:self.top + self.page]
+        tree = self.tree
+        want = {iid: self.rows[iid] for iid in window}
+        for iid in [i for i in self.shown if i not in want]:
+            tree.delete(iid)
+        for iid, values in want.items():
+            old = self.shown.get(iid)
+            if old is None:
+                tree.insert("", "end", iid=iid, values=values)
+            elif old != values:
+                tree.item(iid, values=values)
+        if list(tree.get_children("")) != window:
+            tree.set_children("", *window)
+        self.shown = want
+        visible_sel = [i for i in self._selected if i in want]
+        if tuple(visible_sel) != tree.selection():
+            tree.selection_set(visible_sel)
+        n = len(self.order)
+        if n:
+            self.sb.set(self.top / n, min(1.0, (self.top + self.page) / n))
+        else:
+            self.sb.set(0, 1)
+
+    def on_select(self, event=None):
+        # rows scrolled out of view keep their selection
+        hidden = [i for i in self._selected if i not in self.shown]
+        self._selected = hidden + list(self.tree.selection())
+
+    def on_resize(self, event):
+        page = max(1, (event.height - self.HEADING_HEIGHT) // self.ROW_HEIGHT + 1)
+        if page != self.page:
+            self.page = page
+            self.render()
+
+    def on_scroll(self, *args):
+        if args[0] == "moveto":
+            self.top = int(float(args[1]) * len(self.order))
+        elif args[0] == "scroll":
+            step = int(args[1])
+            self.top += step * self.page if args[2] == "pages" else step
+        self.render()
+
+    def scroll_rows(self, n):
+        self.top += n
+        self.render()
+        return "break"
+
+    def move_focus(self, step):
+        if not self.order:
+            return "break"
+        focus = self.tree.focus()
+        cur = self.index_of(focus) if focus else None
+        if cur is None:
+            cur = self.top - 1 if step in (1, "page") else self.top
+        if step == "home":
+            new = 0
+        elif step == "end":
+            new = len(self.order) - 1
+        elif step == "page":
+            new = cur + self.page
+        elif step == "-page":
+            new = cur - self.page
+        else:
+            new = cur + step
+        new = max(0, min(new, len(self.order) - 1))
+        if new < self.top:
+            self.top = new
+        elif new >= self.top + self.page - 1:
+            self.top = new - self.page + 2
+        iid = self.order[new]
+        self._selected = [iid]
+        self.render()
+        self.tree.focus(iid)
+        self.tree.see(iid)
+        return "break"
+
+# ---------- Receipt preview ----------
+class ReceiptDialog:
+    def __init__(self, app, user):
+        self.top = tk.Toplevel(app)
+        self.top.transient(app)
+        self.top.grab_set()
+        self.top.title("مشاهده/تأیید رسید")
+        self.img = None
+        path = user.get("receipt")
+        ttk.Label(self.top, text=f"{user['name']} — {user.get('debt',0):,} تومان", font=("Tahoma", 12)).pack(padx=10, pady=6)
+        self.preview = ttk.Label(self.top, text="رسیدی آپلود نشده است.")
+        self.preview.pack(padx=10, pady=6)
+        if path and os.path.exists(path):
+            thumb = RECEIPTS.thumbnail_path(path)
+            if os.path.exists(thumb):
+                self.show_image(thumb)
+            elif RECEIPTS.can_thumbnail(path):
+                self.preview.config(text="در حال آماده‌سازی پیش‌نمایش...")
+                app.run_task(RECEIPTS.make_thumbnail, path, done=self.show_image)
+            else:
+                self.show_image(path, scale=True)
+        btnf = ttk.Frame(self.top)
+        btnf.pack(pady=8)
+        ttk.Button(btnf, text="تأیید پرداخت", command=self.on_ok).pack(side="left", padx=6)
+        ttk.Button(btnf, text="باز کردن فایل", command=lambda: open_file(path)).pack(side="left", padx=6)
+        ttk.Button(btnf, text="انصراف", command=self.on_cancel).pack(side="left", padx=6)
+        self.result = False
+
+    def show_image(self, path, scale=False):
+        if not self.top.winfo_exists():
+            return
+        unavailable = "پیش‌نمایش در دسترس نیست؛ برای دیدن رسید «باز کردن فایل» را بزنید."
+        if not path or (scale and os.path.splitext(path)[1].lower() not in TK_FORMATS):
+            self.preview.config(text=unavailable)
+            return
+        try:
+            img = tk.PhotoImage(master=self.top, file=path)
+        except tk.TclError:
+            self.preview.config(text=unavailable)
+            return
+        if scale:
+            # no Pillow: let PhotoImage shrink it
+            f = max(1, -(-img.width() // THUMB_SIZE[0]), -(-img.height() // THUMB_SIZE[1]))
+            img = img.subsample(f)
+        self.img = img
+        self.preview.config(image=img, text="")
+
+    def on_ok(self):
+        self.result = True
+        self.top.destroy()
+
+    def on_cancel(self):
+        self.top.destroy()
+
+# ---------- Dashboard ----------
+def event_line(e):
+    line = f"{e.get('time', '')}  {EVENT_TEXT.get(e.get('event'), e.get('event'))}"
+    if e.get("name"):
+        line += f" — {e['name']}"
+    if e.get("event") == "restore":
+        line += f" — {e.get('backup', '')} ({e.get('users', 0):,} نفر)"
+    elif e.get("event") != "clear":
+        line += f" — {e.get('amount', 0):,} تومان"
+    if e.get("method") in ("cash", "card"):
+        line += " (نقدی)" if e["method"] == "cash" else " (کارت)"
+    if e.get("by"):
+        line += f" — {e['by']}"
+    return line
+
+
+class DashboardDialog:
+    """Outstanding and collected totals of the open ledger and the latest
+    payment events. The totals are kept up to date as changes are applied
+    (dangyar/payments.py), so refreshing costs nothing on big rosters."""
+    REFRESH_MS = 1000
+    ROWS = (("users", "تعداد افراد", False), ("unpaid_amount", "مانده (تومان)", True),
+            ("paid_amount", "وصول شده (تومان)", True), ("paid", "پرداخت شده (نفر)", False),
+            ("unpaid", "پرداخت نشده (نفر)", False), ("pending_cash", "در انتظار تأیید نقدی (نفر)", False),
+            ("pending_cash_amount", "مبلغ در انتظار نقدی", True), ("pending_card", "در انتظار تأیید رسید (نفر)", False),
+            ("pending_card_amount", "مبلغ در انتظار رسید", True))
+
+    def __init__(self, app):
+        self.app = app
+        self.top = tk.Toplevel(app)
+        self.top.transient(app)
+        self.top.title("داشبورد")
+        grid = ttk.Frame(self.top)
+        grid.pack(fill="x", padx=10, pady=8)
+        self.labels = {}
+        for i, (key, text, _) in enumerate(self.ROWS):
+            ttk.Label(grid, text=text + ":").grid(row=i, column=0, sticky="e", padx=4, pady=2)
+            self.labels[key] = ttk.Label(grid, text="", font=("Tahoma", 12))
+            self.labels[key].grid(row=i, column=1, sticky="w", padx=4, pady=2)
+        ttk.Label(self.top, text="رویدادهای اخیر:").pack(anchor="w", padx=10)
+        self.events = tk.Listbox(self.top, height=12, width=80)
+        self.events.pack(fill="both", expand=True, padx=10, pady=(0, 8))
+        self.log_size = None
+        self.loading = False
+        self.render()
+
+    def render(self):
+        if not self.top.winfo_exists():
+            return
+        # the totals come from a worker; the store lock may be busy, so
+        # don't queue another read behind one still waiting for it
+        if not self.loading:
+            self.loading = True
+            self.app.read("dashboard", CORE.dashboard, done=self.show_totals)
+        # the event list only when the log grew
+        try:
+            size = os.path.getsize(CORE.payments.path)
+        except OSError:
+            size = 0
+        if size != self.log_size:
+            self.log_size = size
+            self.app.run_task(CORE.history, None, 100, done=self.show_events)
+        self.top.after(self.REFRESH_MS, self.render)
+
+    def show_totals(self, totals):
+        self.loading = False
+        if not self.top.winfo_exists():
+            return
+        for key, _, money in self.ROWS:
+            self.labels[key].config(text=f"{totals[key]:,}" + (" تومان" if money else ""))
+
+    def show_events(self, events):
+        if not self.top.winfo_exists():
+            return
+        self.events.delete(0, "end")
+        for e in events:
+            self.events.insert("end", event_line(e))
+
+# ---------- Backups ----------
+class BackupsDialog:
+    """Backups of the open ledger (dangyar/backups.py): back up now, restore
+    one, or apply the retention policy."""
+    COLUMNS = (("time", "زمان", 140), ("reason", "علت", 160), ("kind", "نوع", 60), ("users", "افراد", 60),
+               ("changed", "تغییرات", 60), ("size", "حجم (KB)", 70))
+
+    def __init__(self, app):
+        self.app = app
+        self.top = tk.Toplevel(app)
+        self.top.transient(app)
+        self.top.title("پشتیبان‌ها — " + CORE.ledgers.name(CORE.ledger))
+        self.tree = ttk.Treeview(self.top, columns=[c for c, _, _ in self.COLUMNS], show="headings", height=14)
+        for col, text, width in self.COLUMNS:
+            self.tree.heading(col, text=text)
+            self.tree.column(col, width=width, anchor="w")
+        self.tree.pack(fill="both", expand=True, padx=8, pady=6)
+        bar = ttk.Frame(self.top)
+        bar.pack(fill="x", padx=8, pady=(0, 8))
+        ttk.Button(bar, text="پشتیبان‌گیری اکنون", command=self.backup_now).pack(side="left", padx=3)
+        ttk.Button(bar, text="بازگردانی به این نسخه", command=self.restore_selected).pack(side="left", padx=3)
+        ttk.Button(bar, text="اعمال سیاست نگهداری", command=self.prune).pack(side="left", padx=3)
+        ttk.Button(bar, text="بستن", command=self.top.destroy).pack(side="right", padx=3)
+        self.refresh()
+
+    def refresh(self, _=None):
+        if not self.top.winfo_exists():
+            return
+        self.tree.delete(*self.tree.get_children())
+        for b in CORE.list_backups():
+            self.tree.insert("", "end", iid=b["id"], values=(
+                b["time"], b.get("reason", ""), "افزایشی" if b.get("parent") else "کامل",
+                f"{b['users']:,}", b["changed"] + b["deleted"], f"{b['size'] / 1024:,.1f}"))
+
+    def backup_now(self):
+        def done(entry):
+            if entry is None:
+                messagebox.showinfo("پشتیبان", "از آخرین پشتیبان تغییری نبوده است.", parent=self.top)
+            self.refresh()
+        self.app.run_task(CORE.backup, "دستی", done=done)
+
+    def restore_selected(self):
+        sel = self.tree.selection()
+        if not sel:
+            messagebox.showwarning("هشدار", "یک نسخه انتخاب کنید.", parent=self.top)
+            return
+        if not messagebox.askyesno("بازگردانی", "داده‌های این دفتر به این نسخه برگردانده شود؟\n"
+                                   "از وضعیت فعلی پیش از آن پشتیبان گرفته می‌شود.", parent=self.top):
+            return
+        def restored(_):
+            self.refresh()
+            if self.app.frame_manager.winfo_ismapped():
+                self.app.refresh_manager_lists()
+        self.app.write(CORE.restore, sel[0], done=restored)
+
+    def prune(self):
+        def done(n):
+            messagebox.showinfo("پشتیبان", f"{n} نسخهٔ قدیمی حذف شد.", parent=self.top)
+            self.refresh()
+        self.app.run_task(CORE.prune_backups, done=done)
+
+# ---------- Diagnostics ----------
+class DiagnosticsDialog:
+    """Live view of the operation timings in dangyar/metrics.py."""
+    REFRESH_MS = 1000
+    COLUMNS = (("op", "عملیات", 200), ("calls", "تعداد", 60), ("avg_ms", "میانگین (ms)", 90), ("max_ms", "بیشینه (ms)", 90),
+               ("bytes_read", "خوانده (KB)", 90), ("bytes_written", "نوشته (KB)", 90), ("records", "رکوردها", 80))
+
+    def __init__(self, app):
+        self.app = app
+        self.top = tk.Toplevel(app)
+        self.top.transient(app)
+        self.top.title("عیب‌یابی و زمان‌سنجی")
+        self.enabled = tk.BooleanVar(value=METRICS.enabled)
+        bar = ttk.Frame(self.top)
+        bar.pack(fill="x", padx=8, pady=6)
+        ttk.Checkbutton(bar, text="ثبت زمان عملیات", variable=self.enabled, command=self.toggle).pack(side="left")
+        ttk.Label(bar, text=f"آستانهٔ کندی: {METRICS.slow_ms:g} ms").pack(side="left", padx=12)
+        ttk.Button(bar, text="ذخیرهٔ گزارش", command=self.save).pack(side="right", padx=3)
+        ttk.Button(bar, text="پاک کردن", command=self.clear).pack(side="right", padx=3)
+
+        self.ops = ttk.Treeview(self.top, columns=[c for c, _, _ in self.COLUMNS], show="headings", height=12)
+        for col, text, width in self.COLUMNS:
+            self.ops.heading(col, text=text)
+            self.ops.column(col, width=width, anchor="w")
+        self.ops.pack(fill="both", expand=True, padx=8)
+        ttk.Label(self.top, text="عملیات کند اخیر:").pack(anchor="w", padx=8, pady=(6, 0))
+        self.slow = tk.Listbox(self.top, height=6)
+        self.slow.pack(fill="x", padx=8, pady=(0, 4))
+        self.cache_lbl = ttk.Label(self.top, foreground="gray")
+        self.cache_lbl.pack(anchor="w", padx=8, pady=(0, 6))
+        self.render()
+
+    def toggle(self):
+        METRICS.enabled = self.enabled.get()
+
+    def clear(self):
+        METRICS.reset()
+        self.render()
+
+    def save(self):
+        path = filedialog.asksaveasfilename(title="ذخیرهٔ گزارش", defaultextension=".json",
+                                            filetypes=[("JSON", "*.json"), ("Prometheus", "*.prom")])
+        if path:
             try:
-                shutil.copy2(path, dest)
-            except Exception as e:
-                messagebox.showerror("خطا", f"کپی فایل انجام نشد: {e}")
+                METRICS.dump(path)
+            except OSError as e:
+                messagebox.showerror("خطا", str(e))
+
+    def render(self):
+        if not self.top.winfo_exists():
+            return
+        snap = METRICS.snapshot()
+        self.ops.delete(*self.ops.get_children(""))
+        for name, d in snap["ops"].items():
+            self.ops.insert("", "end", values=(name, d["calls"], d["avg_ms"], d["max_ms"],
+                                               f"{d['bytes_read'] / 1024:,.1f}", f"{d['bytes_written'] / 1024:,.1f}", d["records"]))
+        self.slow.delete(0, "end")
+        for e in reversed(snap["slow"][-50:]):
+            self.slow.insert("end", f"{e['time']}  {e['op']}  {e['ms']} ms  ({e['records'] or 0} رکورد)")
+        st = STORE.stats()
+        self.cache_lbl.config(text=f"حافظهٔ نهان: {st['hits']} برخورد، {st['misses']} خواندن مجدد، {st['tail_reads']} خواندن انتهای ژورنال — "
+                                   f"کارهای در صف: {self.app.tasks.pending}")
+        self.top.after(self.REFRESH_MS, self.render)
+
+# ---------- Expenses ----------
+class ExpensesDialog:
+    """Shared expenses of the open ledger, the balances they make and the
+    transfers that settle them (dangyar/splitting.py)."""
+
+    def __init__(self, app):
+        self.app = app
+        self.top = tk.Toplevel(app)
+        self.top.transient(app)
+        self.top.title("هزینه‌ها و تسویه")
+        self.names = {}
+        self.expenses = []
+        self.tree = VirtualTree(self.top, ("time", "title", "payer", "amount", "split"),
+                                ("زمان", "عنوان", "پرداخت‌کننده", "مبلغ (تومان)", "تقسیم"), height=12)
+        self.tree.frame.pack(fill="both", expand=True, padx=8, pady=6)
+        self.tree.tree.bind("<Double-1>", lambda e: self.edit())
+        btns = ttk.Frame(self.top)
+        btns.pack(pady=4)
+        ttk.Button(btns, text="هزینهٔ جدید", command=self.add).pack(side="left", padx=3)
+        ttk.Button(btns, text="ویرایش", command=self.edit).pack(side="left", padx=3)
+        ttk.Button(btns, text="حذف", command=self.delete).pack(side="left", padx=3)
+        ttk.Button(btns, text="اعمال به بدهی‌ها", command=self.apply).pack(side="left", padx=3)
+        ttk.Label(self.top, text="تسویه (چه کسی به چه کسی بدهد):").pack(anchor="w", padx=8)
+        self.transfers = tk.Listbox(self.top, height=8)
+        self.transfers.pack(fill="both", expand=True, padx=8, pady=(0, 8))
+        self.refresh()
+
+    def refresh(self, _=None):
+        if self.top.winfo_exists():
+            self.app.read("expenses", CORE.expense_view, done=self.show)
+
+    def show(self, view):
+        if not self.top.winfo_exists():
+            return
+        self.names, self.expenses, transfers = view
+        rows, order = {}, []
+        for e in self.expenses:
+            rows[e["id"]] = (e.get("time", ""), e.get("title", ""), self.names.get(e["payer"], "؟"),
+                             f"{e['amount']:,}", SPLIT_TEXT.get(e.get("split"), ""))
+            order.append(e["id"])
+        order.reverse()  # newest first
+        self.tree.set_rows(rows, order)
+        self.transfers.delete(0, "end")
+        for src, dst, amount in transfers:
+            self.transfers.insert("end", f"{self.names.get(src, '؟')} → {self.names.get(dst, '؟')}: {amount:,} تومان")
+        if not self.transfers.size():
+            self.transfers.insert("end", "همه تسویه هستند.")
+
+    def selected(self):
+        sel = self.tree.selection()
+        if not sel:
+            messagebox.showwarning("هشدار", "یک هزینه انتخاب کنید.", parent=self.top)
+            return None
+        return next((e for e in self.expenses if e["id"] == sel[0]), None)
+
+    def add(self):
+        dlg = ExpenseEditDialog(self.top, self.names)
+        self.top.wait_window(dlg.top)
+        if dlg.result:
+            self.app.write(CORE.add_expense, *dlg.result, done=self.refresh)
+
+    def edit(self):
+        e = self.selected()
+        if e is None:
+            return
+        dlg = ExpenseEditDialog(self.top, self.names, e)
+        self.top.wait_window(dlg.top)
+        if dlg.result:
+            self.app.write(CORE.update_expense, e["id"], *dlg.result, done=self.refresh)
+
+    def delete(self):
+        e = self.selected()
+        if e is None:
+            return
+        if messagebox.askyesno("حذف", f"هزینهٔ «{e.get('title') or e['amount']}» حذف شود؟", parent=self.top):
+            self.app.write(STORE.delete_expense, e["id"], done=self.refresh)
+
+    def apply(self):
+        # list what would be overwritten first; only members in an expense are touched
+        def applied(n):
+            messagebox.showinfo("اعمال به بدهی‌ها", f"بدهی {n} نفر به‌روز شد.", parent=self.top)
+            self.app.refresh_manager_lists()
+        def confirm(changes):
+            if not changes:
+                messagebox.showinfo("اعمال به بدهی‌ها", "بدهی هیچ‌کس تغییر نمی‌کند.", parent=self.top)
                 return
-            u["pending_card"] = True
-            u["pending_cash"] = False
-            u["receipt"] = dest
-            save_data(self.data)
-            messagebox.showinfo("ثبت شد", "رسید آپلود شد. منتظر تأیید مدیر باشید.")
-            self.open_user_detail(u)
+            lines = [f"{u['name']}: {u.get('debt', 0):,} ← {debt:,}" for u, debt in changes[:APPLY_PREVIEW]]
+            if len(changes) > APPLY_PREVIEW:
+                lines.append(f"... و {len(changes) - APPLY_PREVIEW} نفر دیگر")
+            if messagebox.askyesno("اعمال به بدهی‌ها", f"بدهی {len(changes)} نفر (بدون پرداخت یا درخواست) برابر سهمشان "
+                                   "از هزینه‌ها می‌شود:\n\n" + "\n".join(lines) + "\n\nادامه می‌دهید؟", parent=self.top):
+                self.app.write(CORE.apply_balances, changes, done=applied)
+        self.app.run_task(CORE.balance_changes, done=confirm)
+
+
+class ExpenseEditDialog:
+    # participants: one name per line; "name: n" gives the weight or toman of weighted/exact splits.
+    # Members who share a name are written "name (id...)", as the payer list shows them.
+    def __init__(self, parent, names, expense=None):
+        e = expense or {}
+        seen = {}
+        for name in names.values():
+            seen[name] = seen.get(name, 0) + 1
+        self.ambiguous = {name for name, n in seen.items() if n > 1}
+        self.labels = {uid: f"{name} ({uid[:8]})" if name in self.ambiguous else name for uid, name in names.items()}
+        self.ids = {label: uid for uid, label in self.labels.items()}
+        self.top = tk.Toplevel(parent)
+        self.top.transient(parent)
+        self.top.grab_set()
+        self.top.title("ویرایش هزینه" if expense else "هزینهٔ جدید")
+        ttk.Label(self.top, text="عنوان:").grid(row=0, column=0, padx=6, pady=4, sticky="e")
+        self.e_title = ttk.Entry(self.top, width=36)
+        self.e_title.grid(row=0, column=1, padx=6, pady=4, sticky="w")
+        self.e_title.insert(0, e.get("title", ""))
+        ttk.Label(self.top, text="مبلغ (تومان):").grid(row=1, column=0, padx=6, pady=4, sticky="e")
+        self.e_amount = ttk.Entry(self.top, width=18)
+        self.e_amount.grid(row=1, column=1, padx=6, pady=4, sticky="w")
+        self.e_amount.insert(0, f"{e['amount']}" if e else "")
+        ttk.Label(self.top, text="پرداخت‌کننده:").grid(row=2, column=0, padx=6, pady=4, sticky="e")
+        self.payer = ttk.Combobox(self.top, values=sorted(self.ids), width=34)
+        self.payer.grid(row=2, column=1, padx=6, pady=4, sticky="w")
+        self.payer.set(self.labels.get(e.get("payer"), ""))
+        self.split = tk.StringVar(value=e.get("split", "equal"))
+        sf = ttk.Frame(self.top)
+        sf.grid(row=3, column=1, padx=6, pady=4, sticky="w")
+        for key in SPLITS:
+            ttk.Radiobutton(sf, text=SPLIT_TEXT[key], value=key, variable=self.split).pack(side="left", padx=3)
+        ttk.Label(self.top, text="شرکا (هر نفر یک خط):").grid(row=4, column=0, padx=6, pady=4, sticky="ne")
+        self.t_with = tk.Text(self.top, width=36, height=8)
+        self.t_with.grid(row=4, column=1, padx=6, pady=4, sticky="w")
+        if e.get("split", "equal") == "equal":
+            lines = [self.labels.get(uid, uid) for uid in e.get("with", ())]
+        else:
+            lines = [f"{self.labels.get(uid, uid)}: {v}" for uid, v in e.get("shares", {}).items()]
+        self.t_with.insert("1.0", "\n".join(lines))
+        self.everyone = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.top, text="همه افراد (تقسیم مساوی)", variable=self.everyone).grid(row=5, column=1, padx=6, sticky="w")
+        btnf = ttk.Frame(self.top)
+        btnf.grid(row=6, column=0, columnspan=2, pady=8)
+        ttk.Button(btnf, text="ذخیره", command=self.on_ok).pack(side="left", padx=6)
+        ttk.Button(btnf, text="انصراف", command=self.on_cancel).pack(side="left", padx=6)
+        self.result = None
+
+    def uid_of(self, name):
+        name = name.strip()
+        if name in self.labels:
+            return name  # a member id
+        if name in self.ambiguous:
+            raise ValueError(f"چند نفر با نام «{name}» هست؛ نام را همراه شناسه بنویسید، مثل فهرست پرداخت‌کننده.")
+        if name not in self.ids:
+            raise ValueError(f"«{name}» در فهرست نیست.")
+        return self.ids[name]
+
+    def on_ok(self):
+        # make_expense (dangyar/splitting.py) does the remaining checks
+        try:
+            split = self.split.get()
+            payer = self.uid_of(self.payer.get())
+            lines = [l for l in self.t_with.get("1.0", "end").splitlines() if l.strip()]
+            participants, shares = None, None
+            if self.everyone.get():
+                split, participants = "equal", list(self.labels)
+            elif split == "equal":
+                participants = [self.uid_of(l) for l in lines]
+            else:
+                shares = {}
+                for l in lines:
+                    name, sep, value = l.rpartition(":")
+                    if not sep:
+                        raise ValueError(f"«{l.strip()}»: سهم را به صورت «نام: مقدار» بنویسید.")
+                    shares[self.uid_of(name)] = value.strip().replace(",", "")
+            make_expense(self.e_title.get(), payer, self.e_amount.get(), split, participants, shares)
+        except ValueError as e:
+            messagebox.showwarning("هشدار", str(e), parent=self.top)
             return
+        self.result = (self.e_title.get(), payer, self.e_amount.get(), split, participants, shares)
+        self.top.destroy()
+
+    def on_cancel(self):
+        self.top.destroy()
 
 # ---------- Simple dialog for add/edit ----------
 class UserEditDialog:
@@ -495,19 +1494,12 @@ class UserEditDialog:
         self.result = None
 
     def on_ok(self):
-        name = self.e_name.get().strip()
-        debt = self.e_debt.get().strip().replace(",", "")
-        if not name:
-            messagebox.showwarning("هشدار", "نام نباید خالی باشد.")
-            return
+        # same checks as file imports (dangyar/core.py)
         try:
-            d = float(debt)
-            if d < 0:
-                raise ValueError
-        except:
-            messagebox.showwarning("هشدار", "مقدار بدهی نامعتبر است.")
+            self.result = parse_user_fields(self.e_name.get(), self.e_debt.get())
+        except ValueError as e:
+            messagebox.showwarning("هشدار", str(e))
             return
-        self.result = (name, d)
         self.top.destroy()
 
     def on_cancel(self):
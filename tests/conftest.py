@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+# Tests run from a checkout, like tools/: put the repo root on the path.
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from dangyar.core import DangYarCore
+
+
+@pytest.fixture
+def core(tmp_path):
+    # a fresh install in tmp_path, on the default backend
+    c = DangYarCore(str(tmp_path))
+    c.ensure_storage()
+    return c
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+
+
+def roster(core):
+    return {u["name"]: u["debt"] for u in core.load_data()["users"]}
+
+
+def backups(core):
+    # oldest first
+    return core.list_backups()[::-1]
+
+
+def receipt(core, tmp_path, content):
+    src = tmp_path / "upload.png"
+    src.write_bytes(content)
+    return core.receipts.put(str(src))
+
+
+def test_incremental_restore_after_deletes(core):
+    a, b, c = core.store.add_users([{"name": n, "debt": d} for n, d in (("علی", 1), ("رضا", 2), ("مینا", 3))])
+    core.add_expense("شام", a, 900, participants=[a, b])
+    b1 = core.backup("اول")["id"]
+    core.store.delete_user(c)
+    core.store.update_user(a, {"debt": 10})
+    core.store.delete_expense(core.expenses()[0]["id"])
+    entry = core.backup("دوم")
+    assert (entry["parent"], entry["changed"], entry["deleted"]) == (b1, 1, 1)
+    core.store.add_users([{"name": "سارا", "debt": 4}])
+    core.backup("سوم")
+
+    core.restore(entry["id"])
+    assert roster(core) == {"علی": 10, "رضا": 2}
+    assert core.expenses() == []
+    core.restore(b1)
+    assert roster(core) == {"علی": 1, "رضا": 2, "مینا": 3}
+    assert [e["title"] for e in core.expenses()] == ["شام"]
+    # each restore ends with a full backup, so it can be gone back to
+    undo = next(s for s in core.list_backups() if s["reason"] == "بازگردانی " + entry["id"])
+    assert undo["parent"] is None
+    core.restore(undo["id"])
+    assert roster(core) == {"علی": 10, "رضا": 2}
+
+
+def test_prune_folds_dropped_backup_into_successor(core):
+    a, b, c = core.store.add_users([{"name": n, "debt": 0} for n in ("علی", "رضا", "مینا")])
+    b1 = core.backup()["id"]
+    core.store.delete_user(c)
+    core.store.update_user(a, {"debt": 5})
+    b2 = core.backup()["id"]
+    core.store.update_user(b, {"debt": 7})
+    b3 = core.backup()["id"]
+    want = core.backups.materialize(core.ledger, b3)
+    # drop the middle one: its delete and its change must survive in b3
+    core.backups.keep_set = lambda index, *policy: {b1, b3}
+    assert core.prune_backups() == 1
+    assert [(s["id"], s["parent"]) for s in backups(core)] == [(b1, None), (b3, b1)]
+    assert not os.path.exists(core.backups._path(core.ledger, b2))
+    assert core.backups.materialize(core.ledger, b3) == want
+    core.restore(b3)
+    assert roster(core) == {"علی": 5, "رضا": 7}
+    # dropping the full one makes its successor full
+    core.backups.keep_set = lambda index, *policy: {s["id"] for s in index if s["id"] != b1}
+    core.prune_backups()
+    assert next(s for s in backups(core) if s["id"] == b3)["parent"] is None
+    assert core.backups.materialize(core.ledger, b3) == want
+
+
+def test_restore_recreates_receipts(core, tmp_path):
+    a, b, c = core.store.add_users([{"name": n, "debt": 0} for n in ("علی", "رضا", "مینا")])
+    shared, own = receipt(core, tmp_path, b"shared"), receipt(core, tmp_path, b"own")
+    core.receipts.retain(shared)  # a and b uploaded the same image
+    for uid, path in ((a, shared), (b, shared), (c, own)):
+        core.store.update_user(uid, {"receipt": path, "pending_card": True})
+    assert (core.receipts.refs(shared), core.receipts.refs(own)) == (2, 1)
+    sid = core.backup()["id"]
+    # rejected and deleted: the files go with their last reference
+    core.reject([a, b])
+    core.store.delete_user(c)
+    core.release_receipts([own])
+    assert not os.path.exists(shared) and not os.path.exists(own)
+
+    core.restore(sid)
+    assert open(shared, "rb").read() == b"shared" and open(own, "rb").read() == b"own"
+    assert (core.receipts.refs(shared), core.receipts.refs(own)) == (2, 1)
+    # restoring onto the same receipts again does not count them twice
+    core.restore(sid)
+    assert (core.receipts.refs(shared), core.receipts.refs(own)) == (2, 1)
+    core.reject([a])
+    assert core.receipts.refs(shared) == 1 and os.path.exists(shared)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from dangyar.bulk import export_users, file_format, import_users
+from dangyar.storage import CachedStore, JournalStore, open_store
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = open_store(str(tmp_path), "journal")
+    s.save({"password": "1357", "users": [], "expenses": []})
+    return CachedStore(s)
+
+
+def write(path, text):
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def imported(store):
+    return [(u["name"], u["debt"]) for u in store.load()["users"]]
+
+
+def test_file_format():
+    assert [file_format(p) for p in ("a.csv", "a.JSONL", "a.ndjson", "a.json", "a")] == \
+        ["csv", "jsonl", "jsonl", "json", "csv"]
+
+
+def test_import_csv_and_jsonl(store, tmp_path):
+    added, errors = import_users(store, write(tmp_path / "a.csv", "نام,بدهی\nعلی,۱٬۰۰۰\n,5\nرضا,abc\nمینا,0\n"))
+    assert added == 2 and [n for n, _ in errors] == [3, 4]
+    added, errors = import_users(store, write(tmp_path / "b.jsonl", '{"name": "سارا", "debt": 300}\n\nnot json\n[1]\n'))
+    assert added == 1 and [n for n, _ in errors] == [3, 4]
+    assert imported(store) == [("علی", 1000), ("مینا", 0), ("سارا", 300)]
+
+
+@pytest.mark.parametrize("doc", [
+    [{"name": "علی", "debt": 1000}, "x", {"name": "رضا", "debt": 2000}],
+    {"password": "1357", "users": [{"name": "علی", "debt": 1000}, "x", {"name": "رضا", "debt": 2000}]},
+])
+def test_import_json_document(store, tmp_path, doc):
+    # pretty-printed over many lines, as an editor or dump-json writes it
+    path = write(tmp_path / "a.json", json.dumps(doc, ensure_ascii=False, indent=2))
+    added, errors = import_users(store, path)
+    assert added == 2 and [n for n, _ in errors] == [2]
+    assert imported(store) == [("علی", 1000), ("رضا", 2000)]
+
+
+@pytest.mark.parametrize("text", ['{"name": "علی"}', '"x"', '[{"name": "علی"', ""])
+def test_import_json_rejected(store, tmp_path, text):
+    with pytest.raises(ValueError):
+        import_users(store, write(tmp_path / "a.json", text))
+    assert imported(store) == []
+
+
+@pytest.mark.parametrize("name", ["out.csv", "out.jsonl", "out.json"])
+def test_export_round_trip(store, tmp_path, name):
+    store.add_users([{"name": "علی", "debt": 1000}, {"name": "رضا", "debt": 0}])
+    path = str(tmp_path / name)
+    assert export_users(store.load()["users"], path) == 2
+    (tmp_path / "other").mkdir()
+    other = CachedStore(open_store(str(tmp_path / "other"), "json"))
+    other.save({"password": "1357", "users": [], "expenses": []})
+    assert import_users(other, path) == (2, [])
+    assert imported(other) == imported(store)
+
+
+def test_import_does_not_compact_per_batch(tmp_path):
+    s = JournalStore(str(tmp_path / "data.snapshot"), str(tmp_path / "data.journal"), compact_every=5)
+    s.save({"password": "1357", "users": [], "expenses": []})
+    saves = []
+    save = s.save
+    s.save = lambda data: (saves.append(len(data["users"])), save(data))
+    rows = "".join(f'{{"name": "n{i}", "debt": {i}}}\n' for i in range(40))
+    assert import_users(s, write(tmp_path / "a.jsonl", rows), batch_size=10) == (40, [])
+    assert saves == []  # four batches, four journal entries
+    assert len(s.load()["users"]) == 40
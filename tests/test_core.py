@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+def add(core, *names):
+    return core.store.add_users([{"name": n, "debt": 0} for n in names])
+
+
+def test_delete_member_in_expense_refused(core):
+    a, b, c, d = add(core, "علی", "رضا", "مینا", "سارا")
+    core.add_expense("شام", a, 900, participants=[a, b])
+    core.add_expense("تاکسی", c, 300, "exact", shares={c: 100, d: 200})
+    backups = len(core.backups.list(core.ledger))
+    for uid in (a, b, c, d):
+        with pytest.raises(ValueError, match="هزینه"):
+            core.delete_user(uid)
+    assert len(core.load_data()["users"]) == 4
+    assert len(core.backups.list(core.ledger)) == backups  # nothing to back up for
+    # once the expense is gone the members can go
+    eid = next(e["id"] for e in core.expenses() if e["title"] == "تاکسی")
+    core.store.delete_expense(eid)
+    core.delete_user(d, "قبل از حذف سارا")
+    assert [u["name"] for u in core.load_data()["users"]] == ["علی", "رضا", "مینا"]
+    assert core.settlement() == [(b, a, 450)]
+    with pytest.raises(KeyError):
+        core.delete_user(d)
+
+
+def test_store_refuses_delete_under_its_lock(core, tmp_path):
+    # another station adds the expense after our check, before our write
+    from dangyar.core import DangYarCore
+    from dangyar.storage import InUseError
+    a, b = add(core, "علی", "رضا")
+    core.load_data()
+    DangYarCore(str(tmp_path)).add_expense("شام", a, 900, participants=[a, b])
+    with pytest.raises(InUseError) as e:
+        core.store.delete_user(b)
+    assert [x["title"] for x in e.value.expenses] == ["شام"]
+    assert len(core.load_data()["users"]) == 2
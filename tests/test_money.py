@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from dangyar.money import MAX_TOMAN, int_amounts, to_toman
+
+
+@pytest.mark.parametrize("value, toman", [
+    (1000, 1000), (-5, -5), (1000.0, 1000), ("1200", 1200), (" 1,200 ", 1200),
+    ("۱٬۲۰۰٬۰۰۰", 1200000), ("١٢٣", 123), ("۱،۰۰۰", 1000), ("1200.0", 1200),
+    (MAX_TOMAN, MAX_TOMAN), (str(-MAX_TOMAN), -MAX_TOMAN),
+])
+def test_to_toman(value, toman):
+    n = to_toman(value)
+    assert n == toman and type(n) is int
+
+
+@pytest.mark.parametrize("value", [
+    True, False, 1.5, "1.5", float("nan"), float("inf"), float("-inf"), "nan", "inf",
+    "", "abc", "۱۲الف", None, MAX_TOMAN + 1, float(MAX_TOMAN * 10), "1e20",
+])
+def test_to_toman_rejects(value):
+    with pytest.raises(ValueError):
+        to_toman(value)
+
+
+def test_int_amounts():
+    users = [{"name": "a", "debt": 1000.0}, {"name": "b", "debt": 7}, {"name": "c"},
+             {"name": "d", "debt": 1000.6}, {"name": "e", "debt": float("nan")}, {"name": "f", "debt": "x"},
+             {"name": "g", "debt": "۲۰۰"}]
+    rounded = []
+    assert int_amounts({"users": users}, rounded) == 5
+    assert [u.get("debt") for u in users] == [1000, 7, None, 1001, 0, 0, 200]
+    assert all(type(u["debt"]) is int for u in users if "debt" in u)
+    assert [(u["name"], old) for u, old in rounded][::2] == [("d", 1000.6), ("f", "x")]
+    assert int_amounts({"users": users}) == 0  # already migrated
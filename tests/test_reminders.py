@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import datetime, json
+
+from dangyar.core import DangYarCore
+from dangyar.reminders import FileOutbox
+
+NOON = datetime.datetime(2024, 5, 1, 12, 0)
+
+
+def sent(outbox):
+    with open(outbox.path, encoding="utf-8") as f:
+        return [json.loads(line)["name"] for line in f]
+
+
+def test_reminds_unpaid_members(core, tmp_path):
+    core.store.add_users([{"name": "علی", "debt": 1000}, {"name": "رضا", "debt": 0},
+                          {"name": "مینا", "debt": 500, "pending_cash": True}])
+    outbox = FileOutbox(str(tmp_path / "outbox.jsonl"))
+    r = core.remind(outbox, now=NOON)
+    assert (r["sent"], r["scheduled"], r["full"]) == (1, 1, True)
+    assert sent(outbox) == ["علی"]
+    assert core.remind(outbox, now=NOON + datetime.timedelta(hours=1))["sent"] == 0
+    assert core.remind(outbox, now=NOON + datetime.timedelta(hours=11), quiet=(22, 8))["quiet"]
+    assert core.remind(outbox, now=NOON + datetime.timedelta(days=3))["sent"] == 1
+
+
+def test_member_gone_after_the_log_was_read(core, tmp_path):
+    # due at the same time, so the queue goes by id: b and c first
+    a, b, c, d = core.store.add_users([{"id": uid, "name": n, "debt": 1000}
+                                       for uid, n in (("3", "علی"), ("1", "رضا"), ("2", "مینا"), ("4", "سارا"))])
+    outbox = FileOutbox(str(tmp_path / "outbox.jsonl"))
+    assert core.remind(outbox, now=NOON, batch=0)["scheduled"] == 4
+    # another station deletes b and takes c's payment between our read of
+    # payments.log and our read of the roster
+    log = core.reminders.payments
+    read_from = log.read_from
+    def racing(offset):
+        events = read_from(offset)
+        other = DangYarCore(str(tmp_path))
+        other.store.delete_user(b)
+        other.store.update_user(c, {"paid": True})
+        return events
+    log.read_from = racing
+    r = core.remind(outbox, now=NOON, batch=2)
+    del log.read_from
+    assert sorted(sent(outbox)) == ["سارا", "علی"]  # the skipped ones don't use up the batch
+    assert (r["sent"], r["due"], r["scheduled"]) == (2, 0, 2)
+    assert b not in core.reminders.state["sent"]
+    # the next run reads their events; nothing left to send, in this
+    # process or a new one
+    later = NOON + datetime.timedelta(days=4)
+    assert core.remind(outbox, now=NOON)["scheduled"] == 2
+    r = DangYarCore(str(tmp_path)).remind(outbox, now=later)
+    assert (r["sent"], r["scheduled"]) == (2, 2)
+    assert sorted(sent(outbox)[2:]) == ["سارا", "علی"]
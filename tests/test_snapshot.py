@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from dangyar.snapshot import decode, encode, read_snapshot, read_top
+from dangyar.storage import JournalStore
+
+
+def user(uid, name, debt=0, **fields):
+    # a record with every column set, as decode() returns it
+    u = {"id": uid, "name": name, "debt": debt, "paid": False, "pending_cash": False, "pending_card": False,
+         "receipt": "", "payment_time": "", "approved_by": "", "rev": 0}
+    u.update(fields)
+    return u
+
+
+def round_trip(data):
+    return decode(encode(data))
+
+
+def test_empty_roster():
+    data = {"password": "1357", "journal_gen": 3, "users": [], "expenses": []}
+    assert round_trip(data) == data
+    assert round_trip({"users": []}) == {"users": [], "expenses": []}
+
+
+def test_text_columns():
+    users = [user("a", "علی‌رضا محمدی", 1000, paid=True, payment_time="۱۴۰۳/۰۱/۰۱ ۱۲:۰۰"),
+             user("b", "", 0, pending_cash=True, pending_card=True),
+             user("c", "x\0y", -5),  # NUL would split the column: kept in extra
+             user("d\0", "d", rev=7)]
+    data = {"password": "۱۳۵۷", "users": users, "expenses": []}
+    assert round_trip(data) == data
+
+
+def test_dictionary_coded_columns():
+    users = [user(str(i), f"n{i}", receipt="r1.png" if i % 2 else "", approved_by="مدیر" if i < 3 else "")
+             for i in range(6)]
+    users.append(user("6", "n6", receipt="r2\0.png"))
+    buf = encode({"users": users})
+    assert buf.count("مدیر".encode("utf-8")) == 1 and buf.count(b"r1.png") == 1
+    assert decode(buf)["users"] == users
+
+
+def test_odd_values_go_to_extra():
+    users = [user("a", "a", debt=1000.5, paid=1, rev=None, note="یادداشت", tags=["x"]),
+             user("b", "b", debt=10 ** 18, receipt=None, approved_by=5),
+             {"id": "c", "name": "c"}]
+    data = round_trip({"users": users})
+    assert data["users"][:2] == users[:2]
+    assert data["users"][2] == user("c", "c")  # missing fields come back as their defaults
+
+
+def test_expenses_and_top_keys():
+    expenses = [{"id": "e1", "title": "شام", "payer": "a", "amount": 900, "split": "equal", "with": ["a", "b"]},
+                {"id": "e2", "title": "", "payer": "b", "amount": 10, "split": "weight", "shares": {"a": 1.5, "b": 1}}]
+    data = {"password": "1357", "journal_gen": 12, "ledger": {"name": "سفر"},
+            "users": [user("a", "a"), user("b", "b")], "expenses": expenses}
+    assert round_trip(data) == data
+
+
+def test_read_top_and_file(tmp_path):
+    path = tmp_path / "data.snapshot"
+    data = {"password": "1357", "journal_gen": 4, "users": [user("a", "علی", 1000)], "expenses": []}
+    path.write_bytes(encode(data))
+    assert read_top(str(path)) == {"password": "1357", "journal_gen": 4}
+    assert read_snapshot(str(path)) == data
+    for bad in (b"", b"DGY", b"{\"users\": []}" + b" " * 16):
+        path.write_bytes(bad)
+        with pytest.raises(ValueError):
+            read_top(str(path))
+    with pytest.raises(ValueError):
+        decode(b"XXXX" + encode(data)[4:])
+
+
+def test_legacy_json_snapshot(tmp_path):
+    # snapshots were JSON before the columnar format; they still load and
+    # compaction replaces them with the new one
+    legacy = {"password": "1357", "journal_gen": 2, "users": [{"id": "a", "name": "علی", "debt": 1000, "rev": 3,
+                                                                "note": "x"}]}
+    (tmp_path / "data.snapshot.json").write_text(json.dumps(legacy, ensure_ascii=False), encoding="utf-8")
+    (tmp_path / "data.journal").write_text('{"gen": 2}\n{"op": "update", "id": "a", "fields": {"debt": 0}}\n')
+    s = JournalStore(str(tmp_path / "data.snapshot"), str(tmp_path / "data.journal"),
+                     legacy_path=str(tmp_path / "data.snapshot.json"))
+    u = s.load()["users"][0]
+    assert (u["name"], u["debt"], u["rev"], u["note"]) == ("علی", 0, 4, "x")
+    s.compact()
+    assert read_top(s.snapshot_path)["password"] == "1357"
+    assert read_snapshot(s.snapshot_path)["users"][0] == user("a", "علی", 0, rev=4, note="x")
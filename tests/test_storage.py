@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import json, multiprocessing, os
+
+import pytest
+
+from dangyar.storage import BACKENDS, CachedStore, ConflictError, JournalStore, open_store
+
+
+def roster():
+    return {"password": "1357", "users": [{"id": "a", "name": "علی", "debt": 1000},
+                                          {"id": "b", "name": "رضا", "debt": 2000}], "expenses": []}
+
+
+@pytest.fixture(params=[(b, c) for b in BACKENDS for c in (False, True)],
+                ids=lambda p: p[0] + ("-cached" if p[1] else ""))
+def store(request, tmp_path):
+    backend, cached = request.param
+    s = open_store(str(tmp_path), backend)
+    s.save(roster())
+    return CachedStore(s) if cached else s
+
+
+def reopen(store):
+    # a fresh process on the same files
+    s = store.store if isinstance(store, CachedStore) else store
+    if s.name == "journal":
+        return JournalStore(s.snapshot_path, s.journal_path, legacy_path=s.legacy_path)
+    return open_store(os.path.dirname(getattr(s, "path", "")), s.name)
+
+
+def names(data):
+    return [u["name"] for u in data["users"]]
+
+
+def test_save_load(store):
+    assert store.exists()
+    for s in (store, reopen(store)):
+        data = s.load()
+        assert data["password"] == "1357"
+        assert [(u["id"], u["name"], u["debt"]) for u in data["users"]] == [("a", "علی", 1000), ("b", "رضا", 2000)]
+
+
+def test_every_change_kind(store):
+    store.add_user({"id": "c", "name": "مینا", "debt": 0})
+    store.update_user("a", {"debt": 0, "paid": True})
+    store.delete_user("b")
+    store.set_password("2468")
+    store.add_expenses([{"id": "e1", "payer": "a", "amount": 300}])
+    store.add_expenses([{"id": "e2", "payer": "c", "amount": 100}, {"id": "e3", "payer": "c", "amount": 50}])
+    store.update_expense("e1", {"amount": 600})
+    store.delete_expense("e3")
+    for s in (store, reopen(store)):
+        data = s.load()
+        assert data["password"] == "2468"
+        assert [u["id"] for u in data["users"]] == ["a", "c"]
+        a = s.get_user("a")
+        assert (a["debt"], a["paid"], a["rev"]) == (0, True, 1)
+        assert s.get_user("b") is None
+        assert [(e["id"], e["amount"]) for e in data["expenses"]] == [("e1", 600), ("e2", 100)]
+    store.clear_users()
+    for s in (store, reopen(store)):
+        data = s.load()
+        assert data["users"] == [] and data["expenses"] == []
+
+
+def test_batch(store):
+    ids = store.add_users([{"name": "x", "debt": 1}, {"name": "y", "debt": 2}])
+    assert len(ids) == 2 and all(ids)
+    changed = store.modify_users(["a", "missing", ids[1]], lambda u: {"debt": u["debt"] * 10} if u["debt"] < 2000 else None)
+    assert changed == {"a": {"debt": 10000}, ids[1]: {"debt": 20}}
+    for s in (store, reopen(store)):
+        assert [u["debt"] for u in s.load()["users"]] == [10000, 2000, 1, 20]
+
+
+def test_unknown_ids(store):
+    if store.name == "journal" and not isinstance(store, CachedStore):
+        pytest.skip("the journal appends without reading; CachedStore checks ids in front of it")
+    with pytest.raises(KeyError):
+        store.update_user("missing", {"debt": 1})
+    with pytest.raises(KeyError):
+        store.delete_user("missing")
+    with pytest.raises(KeyError):
+        store.update_expense("missing", {"amount": 1})
+    assert names(reopen(store).load()) == ["علی", "رضا"]
+
+
+def test_compare_and_swap(store):
+    store.update_user("a", {"debt": 500}, expect_rev=0)
+    with pytest.raises(ConflictError):
+        store.update_user("a", {"debt": 1}, expect_rev=0)
+    assert store.get_user("a")["debt"] == 500
+    # another process writes between our read and our write: fn runs again
+    other, calls = reopen(store), []
+    def fn(u):
+        calls.append(u["debt"])
+        if len(calls) == 1:
+            other.update_user("a", {"debt": u["debt"] + 7})
+        return {"debt": u["debt"] + 1}
+    assert store.modify_user("a", fn) == {"debt": 508}
+    assert calls == [500, 507]
+    assert reopen(store).get_user("a")["debt"] == 508
+    assert store.modify_user("a", lambda u: None) is None
+
+
+def test_modify_user_gives_up(store):
+    other = reopen(store)
+    def fn(u):
+        other.update_user("a", {"debt": u["debt"] + 1})
+        return {"debt": 0}
+    with pytest.raises(ConflictError):
+        store.modify_user("a", fn, retries=3)
+    with pytest.raises(KeyError):
+        store.modify_user("missing", fn)
+
+
+def test_cached_store_reads_other_writes(store):
+    if not isinstance(store, CachedStore):
+        pytest.skip("cache only")
+    store.load()
+    other = reopen(store)
+    other.add_user({"id": "c", "name": "مینا", "debt": 0})
+    other.update_user("a", {"debt": 1})
+    assert store.get_user("c")["name"] == "مینا"
+    assert store.get_user("a")["debt"] == 1
+    if store.name == "journal":
+        assert store.tail_reads == 1  # only the new journal lines were read
+    store.load()
+    assert store.stats()["hits"] >= 1
+
+
+# ---------- journal ----------
+def journal(tmp_path, **kw):
+    return JournalStore(str(tmp_path / "data.snapshot"), str(tmp_path / "data.journal"),
+                        legacy_path=str(tmp_path / "data.snapshot.json"), **kw)
+
+
+def journal_lines(s):
+    with open(s.journal_path, "rb") as f:
+        return [json.loads(line) for line in f.read().splitlines() if line.strip()]
+
+
+def test_journal_replay(tmp_path):
+    s = journal(tmp_path)
+    s.save(roster())
+    s.add_user({"id": "c", "name": "مینا", "debt": 0})
+    s.update_user("c", {"debt": 5})
+    assert [e.get("op") for e in journal_lines(s)] == [None, "add", "update"]
+    assert s.load() == journal(tmp_path).load()
+    assert journal(tmp_path).get_user("c")["debt"] == 5
+
+
+def test_journal_half_written_line(tmp_path):
+    s = journal(tmp_path)
+    s.save(roster())
+    s.add_user({"id": "c", "name": "c", "debt": 0})
+    with open(s.journal_path, "ab") as f:
+        f.write(b'{"op": "add", "user": {"id": "x"')  # crash mid-append
+    assert names(journal(tmp_path).load()) == ["علی", "رضا", "c"]
+    s2 = journal(tmp_path)
+    s2.add_user({"id": "d", "name": "d", "debt": 0})
+    assert names(journal(tmp_path).load()) == ["علی", "رضا", "c", "d"]
+
+
+def test_journal_compaction(tmp_path):
+    s = journal(tmp_path, compact_every=3)
+    s.save(roster())
+    gen = journal_lines(s)[0]["gen"]
+    s.add_user({"id": "c", "name": "c", "debt": 0})
+    s.update_user("c", {"debt": 1})
+    assert len(journal_lines(s)) == 3
+    s.update_user("c", {"debt": 2})  # third entry: folded into the snapshot
+    assert journal_lines(s) == [{"gen": gen + 1}]
+    assert journal(tmp_path).get_user("c")["debt"] == 2
+    # a batch is one entry however many records it holds
+    s.add_users([{"name": str(i), "debt": 0} for i in range(5)])
+    s.add_users([{"name": str(i), "debt": 0} for i in range(5)])
+    assert len(journal_lines(s)) == 3
+    assert len(journal(tmp_path).load()["users"]) == 13
+
+
+def test_journal_stale_generation_ignored(tmp_path):
+    # snapshot and journal after a compaction that crashed before the new
+    # journal header: the old entries are already in the snapshot
+    s = journal(tmp_path)
+    s.save(roster())
+    s.update_user("a", {"debt": 1})
+    with open(s.journal_path, "rb") as f:
+        old = f.read()
+    s.compact()
+    with open(s.journal_path, "wb") as f:
+        f.write(old)
+    data = journal(tmp_path).load()
+    assert data["users"][0]["debt"] == 1 and data["users"][0]["rev"] == 1
+
+
+def compact_and_die(tmp_path):
+    # the process dies after the new snapshot is in, before the journal header
+    s = journal(tmp_path)
+    s._write_journal_header = lambda gen: os._exit(9)
+    s.compact()
+
+
+def test_journal_crash_during_compaction(tmp_path):
+    s = journal(tmp_path)
+    s.save(roster())
+    s.update_user("a", {"debt": 1})
+    gen = journal_lines(s)[0]["gen"]
+    p = multiprocessing.get_context("fork").Process(target=compact_and_die, args=(tmp_path,))
+    p.start()
+    p.join()
+    assert p.exitcode == 9
+    assert journal_lines(s)[0]["gen"] == gen  # the snapshot is at gen + 1 now
+    # writes after the crash, from a store that was open before it and from a new one
+    s.add_user({"id": "c", "name": "c", "debt": 0})
+    journal(tmp_path).update_user("c", {"debt": 5})
+    cached = CachedStore(journal(tmp_path))
+    cached.add_user({"id": "d", "name": "d", "debt": 0})
+    data = journal(tmp_path).load()
+    assert names(data) == ["علی", "رضا", "c", "d"]
+    assert [u["debt"] for u in data["users"]] == [1, 2000, 5, 0]
+    assert data["users"][0]["rev"] == 1  # the pre-crash entry is not replayed twice
+
+
+def test_legacy_journal_migration(tmp_path):
+    # JSON snapshot, no generation header, changes addressed by list position
+    with open(tmp_path / "data.snapshot.json", "w", encoding="utf-8") as f:
+        json.dump({"password": "1357", "users": [{"name": "علی", "debt": 1000.0}, {"name": "رضا", "debt": 2000},
+                                                  {"name": "مینا", "debt": 0}]}, f, ensure_ascii=False)
+    with open(tmp_path / "data.journal", "w", encoding="utf-8") as f:
+        for change in ({"op": "update", "idx": 0, "fields": {"paid": True}}, {"op": "delete", "idx": 1},
+                       {"op": "add", "user": {"name": "سارا", "debt": 300}}):
+            f.write(json.dumps(change, ensure_ascii=False) + "\n")
+    s = journal(tmp_path)
+    assert s.exists()
+    data = s.load()
+    assert names(data) == ["علی", "مینا", "سارا"]
+    assert data["users"][0]["paid"] is True
+    s.compact()
+    assert not os.path.exists(s.legacy_path)
+    assert os.path.exists(s.snapshot_path)
+    assert names(journal(tmp_path).load()) == ["علی", "مینا", "سارا"]
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# Load test for the members' HTTP API (dangyar/api.py).
+#
+# Generates a synthetic roster (tools/bench.py), starts `python -m dangyar
+# serve` on it in a child process and drives it from many concurrent
+# keep-alive clients on one asyncio loop: name searches, balance lookups,
+# cash requests and receipt uploads, mixed like phones at the start of a
+# meeting. Reports throughput, latency percentiles per request kind, the
+# status codes seen and the server's peak memory, then checks the store:
+# every accepted request is pending and none was accepted twice.
+#
+#   python tools/api_load.py --users 10k --clients 300 --requests 20000
+#   python tools/api_load.py --url http://127.0.0.1:8765 --clients 100 --duration 30
+#
+# With --url an already running server is used; its data is changed and
+# the store check is skipped.
+import argparse, asyncio, json, os, random, shutil, statistics, subprocess, sys, tempfile, time
+from collections import Counter, defaultdict
+from urllib.parse import quote, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench import FIRST, LAST, PNG_1PX, make_roster, parse_size
+from dangyar.core import DangYarCore
+
+MIX = {"search": 50, "balance": 30, "cash": 10, "receipt": 10}
+
+
+class Client:
+    """One keep-alive connection; reconnects when the server closes it."""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+        self.connects = 0
+
+    async def request(self, method, path, body=b"", ctype=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            self.connects += 1
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Length: {len(body)}\r\n"
+        if ctype:
+            head += f"Content-Type: {ctype}\r\n"
+        self.writer.write(head.encode("utf-8") + b"\r\n" + body)
+        await self.writer.drain()
+        lines = (await self.reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        headers = dict((k.strip().lower(), v.strip()) for k, _, v in (l.partition(":") for l in lines[1:] if l))
+        payload = await self.reader.readexactly(int(headers.get("content-length", 0)))
+        if headers.get("connection", "").lower() == "close":
+            await self.close()
+        return int(lines[0].split(" ")[1]), json.loads(payload) if payload else {}
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            self.reader = self.writer = None
+
+
+def pick(rnd):
+    r = rnd.randrange(sum(MIX.values()))
+    for kind, weight in MIX.items():
+        if r < weight:
+            return kind
+        r -= weight
+
+
+async def collect_ids(host, port, want=2000):
+    # member ids the way a phone finds them: by searching names
+    c, ids = Client(host, port), []
+    for name in FIRST + LAST:
+        status, res = await c.request("GET", f"/api/search?q={quote(name)}&size=50")
+        ids.extend(u["id"] for u in res.get("results", []) if status == 200)
+        if len(ids) >= want:
+            break
+    await c.close()
+    return sorted(set(ids))
+
+
+async def client_loop(i, host, port, ids, receipt, budget, deadline, stats, seed):
+    rnd = random.Random(seed * 7919 + i)
+    # each phone sends its own picture, so receipts don't all dedup to one file
+    body = receipt + i.to_bytes(4, "big")
+    c = Client(host, port)
+    try:
+        while budget[0] > 0 and time.perf_counter() < deadline:
+            budget[0] -= 1
+            kind = pick(rnd)
+            uid = rnd.choice(ids)
+            t = time.perf_counter()
+            try:
+                if kind == "search":
+                    name = rnd.choice(FIRST)
+                    q = name[:rnd.randint(2, len(name))]  # what people type before the list is short enough
+                    status, res = await c.request("GET", f"/api/search?q={quote(q)}&page={rnd.randrange(3)}")
+                elif kind == "balance":
+                    status, res = await c.request("GET", f"/api/users/{uid}")
+                elif kind == "cash":
+                    status, res = await c.request("POST", f"/api/users/{uid}/cash")
+                else:
+                    status, res = await c.request("PUT", f"/api/users/{uid}/receipt", body, "image/png")
+            except (ConnectionError, asyncio.IncompleteReadError, OSError) as e:
+                stats["errors"][type(e).__name__] += 1
+                await c.close()
+                continue
+            stats["latency"][kind].append(time.perf_counter() - t)
+            stats["status"][f"{kind} {status}"] += 1
+            if status == 200 and kind in ("cash", "receipt"):
+                stats["accepted"][kind].append(uid)
+    finally:
+        stats["connects"] += c.connects
+        await c.close()
+
+
+async def drive(host, port, clients, requests, duration, receipt, seed):
+    ids = await collect_ids(host, port)
+    if not ids:
+        raise SystemExit("no members found through /api/search")
+    stats = {"latency": defaultdict(list), "status": Counter(), "errors": Counter(),
+             "accepted": defaultdict(list), "connects": 0}
+    budget = [requests]
+    deadline = time.perf_counter() + duration if duration else float("inf")
+    t = time.perf_counter()
+    await asyncio.gather(*(client_loop(i, host, port, ids, receipt, budget, deadline, stats, seed)
+                           for i in range(clients)))
+    stats["elapsed"] = time.perf_counter() - t
+    return stats
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def peak_rss_kb(pid):
+    # Linux only; VmHWM is the resident peak since start
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def check_store(app_dir, backend, accepted):
+    """Problems found in the store after the run; [] when consistent."""
+    core = DangYarCore(app_dir, backend)
+    core.load_data()
+    problems = []
+    for kind, uids in accepted.items():
+        twice = [uid for uid, n in Counter(uids).items() if n > 1]
+        if twice:
+            problems.append(f"{len(twice)} {kind} requests accepted twice for the same member")
+    cash, card = set(accepted.get("cash", ())), set(accepted.get("receipt", ()))
+    if cash & card:
+        problems.append(f"{len(cash & card)} members got both a cash request and a receipt accepted")
+    for uid in cash:
+        if not core.store.get_user(uid).get("pending_cash"):
+            problems.append(f"accepted cash request missing: {uid}")
+    for uid in card:
+        u = core.store.get_user(uid)
+        if not (u.get("pending_card") and u.get("receipt") and os.path.exists(u["receipt"])):
+            problems.append(f"accepted receipt missing: {uid}")
+    return problems
+
+
+def start_server(app_dir, backend, max_connections):
+    cmd = [sys.executable, "-m", "dangyar", "--data-dir", app_dir, "--backend", backend,
+           "serve", "--port", "0", "--max-connections", str(max_connections)]
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    if not line.startswith("serving"):
+        proc.kill()
+        raise SystemExit(f"server did not start: {line!r}")
+    url = urlsplit(line.split()[-1])
+    return proc, url.hostname, url.port
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="load test the members' HTTP API")
+    ap.add_argument("--users", default="10k", help="roster size, e.g. 1k, 10k, 100k")
+    ap.add_argument("--backend", default="journal")
+    ap.add_argument("--clients", type=int, default=200, help="concurrent keep-alive connections")
+    ap.add_argument("--requests", type=int, default=10000, help="total requests over all clients")
+    ap.add_argument("--duration", type=float, default=0, help="stop after this many seconds (0: no limit)")
+    ap.add_argument("--receipt-kb", type=int, default=200, help="size of each uploaded receipt")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--url", help="use this running server instead of starting one")
+    ap.add_argument("--out", help="also write the report as JSON here")
+    args = ap.parse_args(argv)
+
+    receipt = PNG_1PX + os.urandom(max(0, args.receipt_kb * 1024 - len(PNG_1PX)))
+    app_dir = proc = None
+    try:
+        if args.url:
+            url = urlsplit(args.url)
+            host, port = url.hostname, url.port or 80
+        else:
+            app_dir = tempfile.mkdtemp(prefix="dangyar-api-load-")
+            n = parse_size(args.users)
+            print(f"roster of {n} members ...", file=sys.stderr)
+            make_roster(app_dir, n, args.seed)
+            DangYarCore(app_dir, args.backend).ensure_storage()
+            proc, host, port = start_server(app_dir, args.backend, max(1000, args.clients + 10))
+        stats = asyncio.run(drive(host, port, args.clients, args.requests, args.duration, receipt, args.seed))
+        peak = peak_rss_kb(proc.pid) if proc else None
+        total = sum(len(v) for v in stats["latency"].values())
+        report = {"clients": args.clients, "requests": total, "elapsed_s": round(stats["elapsed"], 3),
+                  "per_second": round(total / stats["elapsed"], 1) if stats["elapsed"] else 0,
+                  "connections_opened": stats["connects"], "server_peak_rss_mb": peak and round(peak / 1024, 1),
+                  "latency_ms": {}, "status": dict(sorted(stats["status"].items())),
+                  "errors": dict(stats["errors"]),
+                  "accepted": {k: len(v) for k, v in stats["accepted"].items()}}
+        for kind, values in sorted(stats["latency"].items()):
+            report["latency_ms"][kind] = {"n": len(values), "p50": round(statistics.median(values) * 1000, 2),
+                                          "p95": round(percentile(values, 0.95) * 1000, 2),
+                                          "p99": round(percentile(values, 0.99) * 1000, 2),
+                                          "max": round(max(values) * 1000, 2)}
+        if proc:
+            proc.terminate()
+            proc.wait(10)
+            proc = None
+            report["problems"] = check_store(app_dir, args.backend, stats["accepted"])
+        print(f"{total} requests from {args.clients} clients in {report['elapsed_s']} s "
+              f"({report['per_second']}/s), server peak RSS {report['server_peak_rss_mb']} MB")
+        print(f"{'kind':10s} {'n':>7s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'max ms':>9s}")
+        for kind, r in report["latency_ms"].items():
+            print(f"{kind:10s} {r['n']:7d} {r['p50']:9.2f} {r['p95']:9.2f} {r['p99']:9.2f} {r['max']:9.2f}")
+        print("status: " + ", ".join(f"{k}: {v}" for k, v in report["status"].items()))
+        if report["errors"]:
+            print("errors: " + ", ".join(f"{k}: {v}" for k, v in report["errors"].items()))
+        for p in report.get("problems", ())[:20]:
+            print(f"PROBLEM: {p}")
+        if "problems" in report:
+            print("store check: " + ("OK" if not report["problems"] else f"{len(report['problems'])} problems"))
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        return 1 if report["errors"] or report.get("problems") else 0
+    finally:
+        if proc:
+            proc.kill()
+        if app_dir:
+            shutil.rmtree(app_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
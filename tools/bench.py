@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+# Benchmarks for the hot paths on synthetic rosters.
+#
+# Generates data.json rosters (Persian names, mixed paid / pending cash /
+# pending card states, receipt files), imports them into a backend and
+# times loading, saving, name search, the per-user lookup the user panel
+# does, the cross-ledger member search, approvals, the dashboard totals,
+# reminder runs, expense balances and settlement, full and incremental
+# backups and a restore, and - when a display is available - the manager
+# lists and the user detail view in a withdrawn Tk window.
+#
+#   python tools/bench.py --sizes 1k,10k,100k --out bench.json
+#   python tools/bench.py --sizes 1k,10k --save-baseline tools/bench-baseline.json
+#   python tools/bench.py --sizes 1k,10k --baseline tools/bench-baseline.json
+#
+# With --baseline the run is compared against an earlier result file and
+# exits with status 1 when an operation got slower than --tolerance.
+import argparse, importlib.util, json, os, platform, random, shutil, statistics, subprocess
+import sys, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from dangyar.core import DangYarCore, approve_cash, approve_card
+from dangyar.reminders import FileOutbox
+from dangyar.splitting import compute_balances
+from dangyar.storage import BACKENDS
+
+FIRST = ["علی", "محمد", "حسین", "رضا", "مهدی", "امیر", "حسن", "سعید", "مجید", "حمید",
+         "فاطمه", "زهرا", "مریم", "سارا", "نرگس", "الهام", "مهسا", "نازنین", "پریسا", "لیلا",
+         "امیرحسین", "محمدرضا", "علیرضا", "سید علی", "ابوالفضل", "كيان", "ياسمن", "آرش", "آیدا", "کوثر"]
+LAST = ["محمدی", "حسینی", "احمدی", "رضایی", "موسوی", "کریمی", "جعفری", "صادقی", "رحیمی", "هاشمی",
+        "قاسمی", "علی‌پور", "نوروزی", "ابراهیمی", "اکبری", "شریفی", "طاهری", "یزدانی", "کاظمی", "فرهادی",
+        "میرزایی", "حیدری", "زارعی", "بهرامی", "سلطانی", "نجفی", "عباسی", "مرادی", "اسدی", "كاظمي"]
+# a minimal valid PNG (1x1), enough for receipts to be real files
+PNG_1PX = bytes.fromhex("89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+                        "1f15c4890000000d4944415478da63f8ffff3f0005fe02fea7d6a4a70000000049454e44ae426082")
+
+
+def parse_size(s):
+    s = s.strip().lower()
+    mult = {"k": 1000, "m": 1000000}.get(s[-1:], 1)
+    return int(float(s.rstrip("km")) * mult)
+
+
+def size_label(n):
+    return f"{n // 1000000}m" if n % 1000000 == 0 else f"{n // 1000}k" if n % 1000 == 0 else str(n)
+
+
+def make_roster(app_dir, n, seed=1, receipt_files=200):
+    """Write app_dir/data.json with n users; returns the path."""
+    rnd = random.Random(seed)
+    receipts = os.path.join(app_dir, "receipts")
+    os.makedirs(receipts, exist_ok=True)
+    paths = []
+    for i in range(max(1, min(receipt_files, n // 10))):
+        p = os.path.join(receipts, f"receipt_bench_{i}.png")
+        with open(p, "wb") as f:
+            f.write(PNG_1PX)
+        paths.append(p)
+    users = []
+    for i in range(n):
+        u = {"id": f"{i:032x}", "name": f"{rnd.choice(FIRST)} {rnd.choice(LAST)} {i}",
+             "debt": rnd.randrange(10, 5000) * 1000, "paid": False, "pending_cash": False,
+             "pending_card": False, "receipt": "", "payment_time": "", "approved_by": ""}
+        r = rnd.random()
+        if r < 0.2:
+            u.update(paid=True, payment_time="2024-01-01 12:00:00", approved_by="مدیر")
+        elif r < 0.35:
+            u["pending_cash"] = True
+        elif r < 0.5:
+            u.update(pending_card=True, receipt=rnd.choice(paths))
+        users.append(u)
+    path = os.path.join(app_dir, "data.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"password": "1357", "users": users}, f, ensure_ascii=False)
+    return path
+
+
+def timed(fn, repeat, setup=None):
+    # setup, if given, runs untimed before each call
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def summary(times):
+    return {"median_ms": round(statistics.median(times) * 1000, 4),
+            "min_ms": round(min(times) * 1000, 4), "runs": len(times)}
+
+
+# ---------- headless Tk ----------
+def ensure_display():
+    """Make sure Tk can open a window; returns (ok, reason, process to kill)."""
+    try:
+        import tkinter
+    except ImportError:
+        return False, "tkinter not installed", None
+    def can_open():
+        try:
+            r = tkinter.Tk()
+        except tkinter.TclError:
+            return False
+        r.destroy()
+        return True
+    if can_open():
+        return True, "", None
+    xvfb = shutil.which("Xvfb")
+    if not xvfb:
+        return False, "no display and no Xvfb", None
+    display = f":{random.randrange(100, 900)}"
+    proc = subprocess.Popen([xvfb, display, "-nolisten", "tcp"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.environ["DISPLAY"] = display
+    for _ in range(50):
+        time.sleep(0.1)
+        if can_open():
+            return True, "", proc
+    proc.kill()
+    return False, "Xvfb did not start", None
+
+
+def bench_gui(app_dir, backend, repeat, rnd):
+    # the GUI module reads its data directory and backend from the environment
+    os.environ["DANGYAR_HOME"] = app_dir
+    os.environ["DANGYAR_STORAGE"] = backend
+    spec = importlib.util.spec_from_file_location(f"dangyar_gui_{rnd.random():.9f}", os.path.join(ROOT, "python dangyar.py"))
+    gui = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(gui)
+    t = time.perf_counter()
+    app = gui.DangYarApp()
+    out = {"app_init": summary([time.perf_counter() - t])}
+    app.withdraw()
+    try:
+        while not app.ready:  # the data opens on the store thread
+            app.update()
+            time.sleep(0.005)
+        out["app_ready"] = summary([time.perf_counter() - t])
+        def idle():
+            # store reads run on workers; wait for them and their callbacks
+            while app.tasks.pending:
+                app.update()
+                time.sleep(0.001)
+            app.update_idletasks()
+        idle()
+        app.open_manager_panel()
+        idle()
+        def refresh():
+            app.refresh_manager_lists()
+            idle()
+        out["refresh_manager_lists"] = summary(timed(refresh, repeat))
+        users = app.data["users"]
+        app.user_panel_entry()
+        def detail():
+            app.open_user_detail(rnd.choice(users))
+            idle()
+        out["open_user_detail"] = summary(timed(detail, repeat))
+        app.name_entry.insert(0, "ع")
+        def search():
+            app.user_search()
+            idle()
+        out["user_search_1char"] = summary(timed(search, repeat))
+        def next_page():
+            app.show_result_page(app.result_page + 1)
+            idle()
+        out["user_search_next_page"] = summary(timed(next_page, repeat))
+    finally:
+        app.on_close()
+    return out
+
+
+# ---------- core ----------
+def bench_size(n, backend, repeat, gui, seed=1):
+    rnd = random.Random(seed)
+    app_dir = tempfile.mkdtemp(prefix=f"dangyar-bench-{size_label(n)}-")
+    out = {}
+    try:
+        t = time.perf_counter()
+        make_roster(app_dir, n, seed)
+        gen_s = time.perf_counter() - t
+        core = DangYarCore(app_dir, backend)
+        out["import_json"] = summary(timed(core.ensure_storage, 1))
+        out["load_cold"] = summary(timed(lambda: DangYarCore(app_dir, backend).load_data(), repeat))
+        data = core.load_data()
+        out["load_warm"] = summary(timed(core.load_data, repeat))
+        out["search_index_build"] = summary(timed(lambda: (core.names.rebuild(data), len(core.names)), repeat))
+        sample = rnd.choice(data["users"])["name"]
+        queries = {"search_1char": "ع", "search_2char": "حس", "search_word": "محمدی",
+                   "search_full": sample, "search_nomatch": "ژژژ"}
+        for key, q in queries.items():
+            out[key] = summary(timed(lambda: core.find_users_by_name(q, data, limit=50), repeat))
+        # the user panel: one page of a one-letter query, and paging on
+        out["search_page_first"] = summary(timed(lambda: core.match_page(core.search_users("ع"), 0, 10), repeat))
+        matches = core.search_users("ع")
+        pages = iter(range(1, repeat + 1))
+        out["search_page_next"] = summary(timed(lambda: core.match_page(matches, next(pages), 10), repeat))
+        # the cross-ledger member index: built once, then queried
+        out["ledger_flush_full"] = summary(timed(core.flush, 1))
+        for key, q in {"find_member_1char": "ع", "find_member_word": "محمدی", "find_member_full": sample}.items():
+            out[key] = summary(timed(lambda: core.find_member(q, 30), repeat))
+        ids = [u["id"] for u in data["users"]]
+        picks = [rnd.choice(ids) for _ in range(1000)]
+        out["get_user_x1000"] = summary(timed(lambda: [core.store.get_user(uid) for uid in picks], repeat))
+        cash = [u["id"] for u in data["users"] if u.get("pending_cash")]
+        card = [u["id"] for u in data["users"] if u.get("pending_card")]
+        rnd.shuffle(cash)
+        single = iter(cash[:repeat])
+        out["approve_cash_one"] = summary(timed(lambda: core.store.modify_user(next(single), approve_cash), min(repeat, len(cash))))
+        batches = iter([card[i:i + 1000] for i in range(0, len(card), 1000)][:repeat])
+        out["approve_card_batch_1000"] = summary(timed(lambda: core.store.modify_users(next(batches), approve_card),
+                                                       min(repeat, (len(card) + 999) // 1000)))
+        out["dashboard_totals"] = summary(timed(core.dashboard, repeat))
+        outbox = FileOutbox(os.path.join(app_dir, "outbox.jsonl"))
+        out["remind_full"] = summary(timed(lambda: core.remind(outbox, quiet=None), 1))
+        def change_10():
+            core.store.modify_users([rnd.choice(ids) for _ in range(10)], lambda u: {"debt": u["debt"] + 1000})
+        # the run only, after 10 changed members
+        out["remind_incremental_10"] = summary(timed(lambda: core.remind(outbox, quiet=None), repeat, setup=change_10))
+        out["save_data"] = summary(timed(lambda: core.save_data(core.load_data()), repeat))
+        # expenses: two per member, half of them among 2-6 people
+        members = ids[:5000]
+        expenses = []
+        for i in range(2 * len(ids)):
+            e = {"title": f"هزینه {i}", "payer": rnd.choice(members), "amount": rnd.randrange(10, 5000) * 1000}
+            if i % 2:
+                e.update(split="equal", **{"with": rnd.sample(members, min(len(members), rnd.randint(2, 6)))})
+            else:
+                e.update(split="weight", shares={uid: rnd.randint(1, 3) for uid in rnd.sample(members, min(len(members), 3))})
+            expenses.append(e)
+        out["expense_add_all"] = summary(timed(lambda: core.store.add_expenses(expenses), 1))
+        out["balances_full"] = summary(timed(lambda: compute_balances(core.load_data()["expenses"]), repeat))
+        eids = iter([e["id"] for e in rnd.sample(core.load_data()["expenses"], repeat)])
+        out["expense_update_one"] = summary(timed(lambda: core.store.update_expense(next(eids), {"amount": 123000}), repeat))
+        out["settle"] = summary(timed(core.settlement, repeat))
+        out["backup_full"] = summary(timed(lambda: core.backup("bench"), 1))
+        def backup_10():
+            core.store.modify_users([rnd.choice(ids) for _ in range(10)], lambda u: {"debt": u["debt"] + 1000})
+            return core.backup("bench")
+        out["backup_incremental_10"] = summary(timed(backup_10, repeat))
+        first = core.list_backups()[-1]["id"]
+        out["restore"] = summary(timed(lambda: core.restore(first), 1))
+        if gui:
+            out.update(bench_gui(app_dir, backend, repeat, rnd))
+        sizes = {}
+        for name in os.listdir(app_dir):
+            p = os.path.join(app_dir, name)
+            if os.path.isfile(p):
+                sizes[name] = os.path.getsize(p)
+        return out, {"generate_s": round(gen_s, 3), "files": sizes}
+    finally:
+        shutil.rmtree(app_dir, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance, floor_ms):
+    """Print a comparison table; returns the keys that regressed."""
+    base = baseline.get("results", {})
+    regressed = []
+    print(f"{'operation':45s} {'baseline':>12s} {'now':>12s} {'ratio':>7s}")
+    for key, r in sorted(results.items()):
+        b = base.get(key)
+        if b is None:
+            print(f"{key:45s} {'-':>12s} {r['median_ms']:12.3f}")
+            continue
+        ratio = r["median_ms"] / b["median_ms"] if b["median_ms"] else float("inf")
+        slow = ratio > 1 + tolerance and r["median_ms"] - b["median_ms"] > floor_ms
+        if slow:
+            regressed.append(key)
+        print(f"{key:45s} {b['median_ms']:12.3f} {r['median_ms']:12.3f} {ratio:7.2f}{'  SLOWER' if slow else ''}")
+    return regressed
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="time the hot paths on synthetic rosters")
+    ap.add_argument("--sizes", default="1k,10k,100k", help="comma separated, e.g. 1k,10k,100k,1m")
+    ap.add_argument("--backend", default="journal", choices=BACKENDS + ("all",))
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--no-gui", action="store_true", help="skip the Tk timings")
+    ap.add_argument("--out", help="write results as JSON here (default: stdout)")
+    ap.add_argument("--baseline", help="compare with this earlier result file")
+    ap.add_argument("--save-baseline", metavar="FILE", help="also store the results as the new baseline")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    ap.add_argument("--floor-ms", type=float, default=0.5, help="ignore differences smaller than this")
+    args = ap.parse_args(argv)
+
+    gui, gui_note, xvfb = (False, "disabled", None) if args.no_gui else ensure_display()
+    if not gui:
+        print(f"GUI timings skipped: {gui_note}", file=sys.stderr)
+    backends = BACKENDS if args.backend == "all" else (args.backend,)
+    results, info = {}, {}
+    try:
+        for backend in backends:
+            for n in map(parse_size, args.sizes.split(",")):
+                print(f"{backend} {size_label(n)} ...", file=sys.stderr)
+                out, extra = bench_size(n, backend, args.repeat, gui)
+                for op, r in out.items():
+                    results[f"{backend}/{size_label(n)}/{op}"] = r
+                info[f"{backend}/{size_label(n)}"] = extra
+    finally:
+        if xvfb is not None:
+            xvfb.kill()
+    report = {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                       "machine": platform.machine(), "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "repeat": args.repeat, "gui": gui, "gui_note": gui_note},
+              "results": results, "info": info}
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            f.write(text)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressed = compare(results, json.load(f), args.tolerance, args.floor_ms)
+        if regressed:
+            print(f"{len(regressed)} operation(s) slower than the baseline", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
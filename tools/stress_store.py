@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Multi-process stress test for the storage backends.
+#
+# Starts many worker processes on one data directory. Each does a number of
+# compare-and-swap increments on random users (modify_user) and a few
+# appends. Afterwards every increment must be present, i.e. no update was
+# lost, and the data must load cleanly in a fresh process.
+#
+#   python tools/stress_store.py [--backend journal|json|sqlite|all] [--procs 8] [--ops 200]
+import argparse, multiprocessing, os, random, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dangyar.storage import BACKENDS, CachedStore, open_store
+
+
+def worker(app_dir, backend, uids, ops, seed, compact_every):
+    random.seed(seed)
+    store = CachedStore(open_store(app_dir, backend))
+    if compact_every and backend == "journal":
+        store.store.compact_every = compact_every
+    for i in range(ops):
+        uid = random.choice(uids)
+        store.modify_user(uid, lambda u: {"debt": u["debt"] + 1})
+        if i % 50 == 0:
+            store.add_user({"name": f"p{seed}-{i}", "debt": 0})
+
+
+def run(backend, procs, ops, users, compact_every):
+    app_dir = tempfile.mkdtemp(prefix=f"dangyar-stress-{backend}-")
+    try:
+        store = open_store(app_dir, backend)
+        store.save({"password": "1357", "users": [{"id": f"u{i}", "name": f"u{i}", "debt": 0} for i in range(users)]})
+        uids = [f"u{i}" for i in range(users)]
+        t = time.time()
+        ps = [multiprocessing.Process(target=worker, args=(app_dir, backend, uids, ops, n, compact_every))
+              for n in range(procs)]
+        for p in ps:
+            p.start()
+        for p in ps:
+            p.join()
+        elapsed = time.time() - t
+        failed = [p.exitcode for p in ps if p.exitcode != 0]
+        data = open_store(app_dir, backend).load()
+        total = sum(u["debt"] for u in data["users"])
+        added = len(data["users"]) - users
+        want_added = procs * len(range(0, ops, 50))
+        ok = not failed and total == procs * ops and added == want_added
+        print(f"{backend:8s} procs={procs} ops={ops} time={elapsed:.2f}s "
+              f"increments={total}/{procs * ops} added={added}/{want_added} "
+              f"{'OK' if ok else 'FAILED'}{f' (worker exit codes {failed})' if failed else ''}")
+        return ok
+    finally:
+        shutil.rmtree(app_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--backend", default="all", choices=BACKENDS + ("all",))
+    ap.add_argument("--procs", type=int, default=8)
+    ap.add_argument("--ops", type=int, default=200)
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--compact-every", type=int, default=50,
+                    help="journal compaction interval, small to exercise compaction under load")
+    args = ap.parse_args(argv)
+    backends = BACKENDS if args.backend == "all" else (args.backend,)
+    ok = all([run(b, args.procs, args.ops, args.users, args.compact_every) for b in backends])
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())